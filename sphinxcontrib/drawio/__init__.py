@@ -1,14 +1,23 @@
+import http.client
+import io
+import json
 import os
 import os.path
 import platform
+import shlex
 import shutil
+import signal
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from hashlib import sha1
 from pathlib import Path
-from subprocess import Popen, PIPE
-from tempfile import TemporaryFile
-from time import sleep
-from typing import Dict, Any, List
+from typing import Dict, Any, Iterator, List, NamedTuple, Optional, Set, Tuple
 from xml.etree import ElementTree as ET
 
 from docutils import nodes
@@ -19,12 +28,42 @@ from sphinx.application import Sphinx
 from sphinx.builders import Builder
 from sphinx.config import Config, ENUM
 from sphinx.directives.patches import Figure
+from sphinx.environment import BuildEnvironment
+from sphinx.environment.collectors import EnvironmentCollector
 from sphinx.errors import SphinxError
 from sphinx.transforms.post_transforms.images import ImageConverter, get_filename_for
 from sphinx.util import logging
-from sphinx.util.docutils import SphinxDirective
+from sphinx.util.docutils import SphinxDirective, new_document
 from sphinx.util.fileutil import copy_asset
 
+from .cache import (
+    ExportCache,
+    HTTPExportCache,
+    LocalExportCache,
+    collect_garbage,
+    link_or_copy,
+)
+from .manifest import ExportManifest
+from .metadata import (
+    DrawIOMetadata,
+    extract_page,
+    is_embedding_image,
+    read_embedded_diagram,
+    read_metadata,
+    select_layers,
+)
+from .metrics import RENDER_PHASES, ExportMetrics, write_json
+from . import native, optimize, rasterize
+from .server import ExportServer, ExportServerError
+from .worker import ExportWorker, WorkerError
+from .xvfb import DisplayPool
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
 __version__ = "0.0.17"
 
 logger = logging.getLogger(__name__)
@@ -53,6 +92,297 @@ class DrawIOError(SphinxError):
     category = "DrawIO Error"
 
 
+# Digests of source files, keyed by (path, mtime, size) so that a file is only
+# hashed once per change no matter how many directives reference it.
+_file_digests: Dict[tuple, str] = {}
+
+
+def file_digest(path: Path, chunk_size: int = 1 << 20) -> str:
+    """Return the SHA-1 hex digest of a file's content.
+
+    The file is read in chunks, so that large diagrams with embedded images
+    are never loaded into memory at once.
+    """
+    stat = path.stat()
+    memo_key = (str(path), stat.st_mtime_ns, stat.st_size)
+    digest = _file_digests.get(memo_key)
+    if digest is None:
+        hasher = sha1()
+        with open(path, "rb") as fp:
+            for chunk in iter(lambda: fp.read(chunk_size), b""):
+                hasher.update(chunk)
+        digest = _file_digests[memo_key] = hasher.hexdigest()
+    return digest
+
+
+def drawio_metadata(env: BuildEnvironment, path: Path) -> DrawIOMetadata:
+    """Return the page and layer structure of a draw.io file.
+
+    The result is kept in the environment, so a file is only parsed again once
+    its content changes.
+    """
+    relpath = os.path.relpath(path, env.srcdir)
+    digest = file_digest(path)
+    metadata = env.drawio_metadata.get(relpath)
+    if metadata is None or metadata.digest != digest:
+        metadata = env.drawio_metadata[relpath] = read_metadata(path, digest)
+    return metadata
+
+
+def find_drawio_binary(config: Config) -> Optional[str]:
+    if config.drawio_binary_path:
+        return config.drawio_binary_path
+
+    drawio_in_path = shutil.which("drawio")
+    draw_dot_io_in_path = shutil.which("draw.io")
+    WINDOWS_PATH = r"C:\Program Files\draw.io\draw.io.exe"
+    MACOS_PATH = "/Applications/draw.io.app/Contents/MacOS/draw.io"
+    LINUX_PATH = "/opt/drawio/drawio"
+    LINUX_OLD_PATH = "/opt/draw.io/drawio"
+
+    if drawio_in_path:
+        return drawio_in_path
+    elif draw_dot_io_in_path:
+        return draw_dot_io_in_path
+    elif platform.system() == "Windows" and os.path.isfile(WINDOWS_PATH):
+        return WINDOWS_PATH
+    elif platform.system() == "Darwin" and os.path.isfile(MACOS_PATH):
+        return MACOS_PATH
+    elif platform.system() == "Linux" and os.path.isfile(LINUX_PATH):
+        return LINUX_PATH
+    elif platform.system() == "Linux" and os.path.isfile(LINUX_OLD_PATH):
+        return LINUX_OLD_PATH
+    else:
+        return None
+
+
+def drawio_binary(config: Config) -> Optional[str]:
+    """The draw.io binary of the build, which is only looked up once."""
+    if config._drawio_binary is None:
+        config._drawio_binary = find_drawio_binary(config) or ""
+    return config._drawio_binary or None
+
+
+def drawio_env(display: Optional[str]) -> Dict[str, str]:
+    """The environment draw.io is run with."""
+    new_env = os.environ.copy()
+    if display:
+        new_env["DISPLAY"] = f":{display}"
+
+    # This environment variable prevents the drawio application from starting.
+    # This is automatically set within certain Visual Studio Code contexts,
+    # such as for the reStructuredText (sphinx) preview.
+    new_env.pop("ELECTRON_RUN_AS_NODE", None)
+    return new_env
+
+
+# Only the end of draw.io's output is kept, which is where Electron reports
+# what went wrong; verbose logging can otherwise produce megabytes of it.
+MAX_LOG_SIZE = 64 * 1024
+# How long draw.io's output is read once it exited: a helper process left
+# behind may hold on to the pipes, the build doesn't wait for it
+LOG_READ_TIMEOUT = 5
+
+
+def _keep_tail(pipe, tail: bytearray) -> None:
+    """Read ``pipe`` to its end, keeping its last MAX_LOG_SIZE bytes in ``tail``."""
+    with pipe:
+        for chunk in iter(lambda: pipe.read1(MAX_LOG_SIZE), b""):
+            tail += chunk
+            del tail[:-MAX_LOG_SIZE]
+
+
+def run_drawio(
+    args: List[str], env: Dict[str, str], timeout: Optional[float] = None
+) -> subprocess.CompletedProcess:
+    """Run draw.io, killing it along with all its child processes on timeout.
+
+    Like :func:`subprocess.run` with ``check=True``, except that the output is
+    read by threads which only keep its end, so that a chatty draw.io can never
+    block on a full pipe nor fill up memory or disk.
+    """
+    if os.name == "posix":
+        # in a new process group, to reach the Electron helper processes
+        group = {"start_new_session": True}
+    else:
+        group = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+
+    process = subprocess.Popen(
+        args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, **group
+    )
+    output, errors = bytearray(), bytearray()
+    readers = [
+        threading.Thread(target=_keep_tail, args=(pipe, tail), daemon=True)
+        for pipe, tail in ((process.stdout, output), (process.stderr, errors))
+    ]
+    for reader in readers:
+        reader.start()
+    try:
+        returncode = process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        _kill_process_group(process)
+        for reader in readers:
+            reader.join(LOG_READ_TIMEOUT)
+        raise subprocess.TimeoutExpired(args, timeout, bytes(output), bytes(errors))
+    except BaseException:  # e.g. the build was interrupted
+        _kill_process_group(process)
+        raise
+    for reader in readers:
+        reader.join(LOG_READ_TIMEOUT)
+
+    if returncode:
+        raise subprocess.CalledProcessError(
+            returncode, args, bytes(output), bytes(errors)
+        )
+    return subprocess.CompletedProcess(args, returncode, bytes(output), bytes(errors))
+
+
+def _kill_process_group(process: subprocess.Popen) -> None:
+    if os.name == "posix":
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    else:
+        subprocess.run(
+            ["taskkill", "/F", "/T", "/PID", str(process.pid)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        process.kill()
+    process.wait()
+
+
+@contextmanager
+def export_lock(directory: Path) -> Iterator[None]:
+    """Hold an exclusive lock on an export directory.
+
+    The lock is held on a file, so that it is also honoured by other builds
+    sharing the same doctree directory, e.g. html and latex builds run at the
+    same time.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    with open(directory / ".lock", "a+b") as fp:
+        if fcntl:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        else:
+            fp.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(fp.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after 10 seconds
+                    continue
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+            else:
+                fp.seek(0)
+                msvcrt.locking(fp.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def try_lock(path: Path) -> Iterator[bool]:
+    """Hold an exclusive lock on the file ``path``, unless another one does.
+
+    Yields whether the lock was taken, without waiting for it.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a+b") as fp:
+        try:
+            if fcntl:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                fp.seek(0)
+                msvcrt.locking(fp.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            if fcntl:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+            else:
+                fp.seek(0)
+                msvcrt.locking(fp.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+_displays_lock = threading.Lock()
+
+
+@contextmanager
+def checkout_display(config: Config) -> Iterator[Optional[str]]:
+    """Provide the X display for one draw.io process, if one is needed.
+
+    When headless, displays are taken from a pool of Xvfb servers which are
+    only started once draw.io is about to run. Builds which export nothing,
+    e.g. because all exports are cached, never start an X server.
+    """
+    with _displays_lock:
+        if config._displays is None:
+            if is_headless(config):
+                logger.info("running in headless mode, starting Xvfb")
+                size = config.drawio_xvfb_displays or export_workers(config)
+                config._displays = DisplayPool(size, config.drawio_xvfb_screen)
+            else:
+                logger.info("running in non-headless mode, not starting Xvfb")
+                config._displays = False
+
+    if config._displays:
+        with config._displays.display() as display:
+            yield display
+    else:
+        yield None
+
+
+def drawio_version(app: Sphinx) -> str:
+    """Return the version of the draw.io binary, or "" if there is none.
+
+    Probing the version means starting draw.io, so the result is remembered in
+    ``<doctreedir>/drawio/versions.json`` keyed by the binary's path and
+    modification time. A restored export cache therefore does not need a
+    single draw.io launch to be validated. Only the main process of a build
+    updates that file, parallel writers just use the version they probed.
+    """
+    config = app.config
+    if config._drawio_version is not None:
+        return config._drawio_version
+
+    version = ""
+    binary_path = drawio_binary(config)
+    if binary_path and os.path.isfile(binary_path):
+        stat = os.stat(binary_path)
+        memo_key = f"{os.path.abspath(binary_path)}:{stat.st_mtime_ns}"
+        versions_path = Path(app.doctreedir) / "drawio" / "versions.json"
+        try:
+            versions = json.loads(versions_path.read_text())
+        except (OSError, ValueError):
+            versions = {}
+
+        version = versions.get(memo_key)
+        if version is None:
+            try:
+                with checkout_display(config) as display:
+                    ret = run_drawio(
+                        [binary_path, "--version"],
+                        drawio_env(display),
+                        config.drawio_export_timeout,
+                    )
+                version = ret.stdout.decode(errors="replace").strip()
+            except (OSError, subprocess.SubprocessError):
+                version = ""
+            if version and os.getpid() == config._main_pid:
+                versions[memo_key] = version
+                write_json(versions_path, versions)
+
+    config._drawio_version = version
+    return version
+
+
 def format_spec(argument: Any) -> str:
     return directives.choice(argument, list(VALID_OUTPUT_FORMATS.keys()))
 
@@ -177,7 +507,12 @@ class DrawIOConverter(ImageConverter):
 
         options = node.attributes
         out_filename = get_filename_for(srcpath, _to)
-        destpath = str(self._drawio_export(abs_srcpath, options, out_filename))
+        destpath = self._drawio_export(abs_srcpath, options, out_filename)
+        if destpath is None:
+            # the source is used as it is
+            return
+
+        destpath = str(destpath)
         if "*" in node["candidates"]:
             node["candidates"]["*"] = destpath
         else:
@@ -187,28 +522,261 @@ class DrawIOConverter(ImageConverter):
         self.env.original_image_uri[destpath] = srcpath
         self.env.images.add_file(self.env.docname, destpath)
 
-    @staticmethod
-    def page_name_to_index(input_abspath: str, name: str):
+    def page_name_to_index(self, input_abspath: Path, name: str):
         if name is None:
             return None
 
-        for index, diagram in enumerate(ET.parse(input_abspath).getroot()):
-            if diagram.tag != "diagram":
-                continue
-            if diagram.attrib["name"] == name:
-                return index
+        index = drawio_metadata(self.env, input_abspath).page_index(name)
+        if index is None:
+            raise DrawIOError(
+                f"draw.io file {input_abspath} has no diagram named: {name}"
+            )
+        return index
 
-        raise DrawIOError(f"draw.io file {input_abspath} has no diagram named: {name}")
+    def num_pages_in_file(self, input_abspath: Path) -> int:
+        return len(drawio_metadata(self.env, input_abspath).pages)
 
-    @staticmethod
-    def num_pages_in_file(input_abspath: Path) -> int:
-        # Each diagram/page is a direct child of the root element
-        return len(ET.parse(input_abspath).getroot())
+    def _page_digest(self, input_abspath: Path, page_index: int) -> str:
+        """Hash of the content of the given page, or else of the whole file."""
+        pages = drawio_metadata(self.env, input_abspath).pages
+        if page_index < len(pages) and pages[page_index].digest:
+            return pages[page_index].digest
+        # e.g. an out of range page index, for which draw.io picks a page
+        return file_digest(input_abspath)
 
     def _drawio_export(self, input_abspath, options, out_filename):
+        job = self._resolve_export(input_abspath, options, out_filename)
+        stats = self.config._export_metrics.entry(job)
+        stats["references"] += 1
+        if self._is_passthrough(job):
+            stats["outcome"] = "passthrough"
+            return None
+        if not self._is_export_fresh(job):
+            if self.config.drawio_background_export:
+                previous = self._defer_export(job, options)
+                if previous is not None:
+                    return previous
+            job = self._export(job)
+        return job.export_abspath
+
+    def _defer_export(self, job: "ExportJob", options: Dict[str, Any]):
+        """Serve the previous export of ``job``, leaving the export for later.
+
+        The image node's options are kept for :func:`start_background_export`.
+        Returns None if there is no previous export to serve.
+        """
+        previous = self.config._export_manifest.latest(job.variant)
+        if previous is None:
+            return None
+        previous_abspath = Path(self.app.doctreedir) / previous
+        if not previous_abspath.exists():
+            return None
+
+        logger.info(
+            f"(drawio) '{job.input_relpath}' -> '{previous}'"
+            " (previous export, updating in the background)"
+        )
+        self.config._export_metrics.entry(job)["outcome"] = "deferred"
+        # the candidates of the node are about to point to the previous export
+        self.config._deferred_images[str(job.export_relpath)] = {
+            **options,
+            "candidates": dict(options["candidates"]),
+        }
+        # read again once the export is made, see on_env_get_outdated()
+        docnames = self.config._deferred_docnames
+        docnames.setdefault(str(job.export_relpath), set()).add(self.env.docname)
+        return previous_abspath
+
+    def _resolve_export(self, input_abspath, options, out_filename) -> "ExportJob":
+        start = time.perf_counter()
+        job = self._prepare_export(input_abspath, options, out_filename)
+        self.config._export_metrics.record("resolve", [job], start)
+        return job
+
+    @contextmanager
+    def _exporting(self, job: "ExportJob") -> Iterator[None]:
+        """Emit the export events around the ``with`` block."""
+        self.app.emit("drawio-export-started", job)
+        stats = self.config._export_metrics.entry(job)
+        try:
+            yield
+        except WorkerError:
+            raise  # exported with draw.io instead, see _without_worker
+        except BaseException:
+            stats.setdefault("outcome", "failed")
+            raise
+        finally:
+            outcome = stats.get("outcome")
+            if outcome in ("cached", "rasterized", "exported"):
+                render_time = None
+                if outcome == "exported":
+                    render_time = sum(stats[phase] for phase in RENDER_PHASES)
+                stats["bytes"] = self._record_export(job, render_time)
+            self.app.emit("drawio-export-finished", job, dict(stats))
+
+    def _export(self, job: "ExportJob") -> "ExportJob":
+        """Produce the export, from the shared export caches if possible.
+
+        Returns the job which produced it, which is exported with draw.io
+        instead should the export worker fail.
+        """
+        try:
+            with self._exporting(job):
+                self._produce(job)
+            return job
+        except WorkerError:
+            job = self._without_worker(job)
+        with self._exporting(job):
+            self._produce(job)
+        return job
+
+    def _without_worker(self, job: "ExportJob") -> "ExportJob":
+        """The job exporting with draw.io what the export worker failed to.
+
+        Exports of the worker and of draw.io don't share their keys, the
+        statistics of the worker's job carry over to the new one.
+        """
+        electron_job = self._with_format(
+            job._replace(renderer="electron"), job.output_format
+        )
+        self.config._export_metrics.move(job, electron_job)
+        return electron_job
+
+    def _produce(self, job: "ExportJob") -> None:
+        with export_lock(job.export_abspath.parent):
+            # another build may have made the export while we were waiting
+            if self._is_export_fresh(job):
+                return
+            if not self._fetch_cached(job):
+                if not self._rasterize(job):
+                    self._run_export(job)
+                self._store_produced(job)
+
+    def _fetch_cached(self, job: "ExportJob") -> bool:
+        caches = self.config._export_caches
+        if not caches:
+            return False
+        with self.config._export_metrics.span("cache", [job]):
+            for index, cache in enumerate(caches):
+                if cache.get(job.key, job.output_format, job.export_abspath):
+                    logger.info(
+                        f"(drawio) '{job.input_relpath}' -> '{job.export_relpath}'"
+                        " (cached)"
+                    )
+                    self.config._export_metrics.entry(job)["outcome"] = "cached"
+                    # populate the caches that are checked first
+                    self._store_cached(job, caches[:index])
+                    return True
+        return False
+
+    def _rasterize(self, job: "ExportJob") -> bool:
+        """Render a bitmap export from the SVG export of the same diagram.
+
+        This saves a draw.io launch whenever another builder already exported
+        the page as SVG, with the same options. Returns False if there is no
+        such export or the rasterizer can't render it faithfully.
+        """
+        if not self._is_rasterizable(job, job.output_format):
+            return False
+        svg_job = self._with_format(job, "svg")
+        if not self._is_export_fresh(svg_job):
+            return False
+
+        export_abspath = job.export_abspath
+        tmp_abspath = export_abspath.with_name(
+            f"{export_abspath.stem}.{os.getpid()}-{threading.get_ident()}.tmp"
+            f"{export_abspath.suffix}"
+        )
+        try:
+            with self.config._export_metrics.span("rasterize", [job]):
+                rasterized = rasterize.rasterize_svg(
+                    svg_job.export_abspath,
+                    tmp_abspath,
+                    job.output_format,
+                    job.transparent,
+                )
+            if not rasterized:
+                return False
+            os.replace(str(tmp_abspath), str(export_abspath))
+        finally:
+            if tmp_abspath.exists():
+                tmp_abspath.unlink()
+
+        logger.info(
+            f"(drawio) '{svg_job.export_relpath}' -> '{job.export_relpath}'"
+            " (rasterized)"
+        )
+        self.config._export_metrics.entry(job)["outcome"] = "rasterized"
+        return True
+
+    def _is_rasterizable(self, job: "ExportJob", output_format: str) -> bool:
+        """Whether the export of ``job`` in ``output_format`` may be rasterized."""
+        return (
+            self.config.drawio_rasterize_svg
+            and rasterize.is_available()
+            and output_format in ("png", "jpg")
+            # the size of the SVG is only scaled, not fit into a box
+            and not job.extra_options
+        )
+
+    def _store_produced(self, job: "ExportJob") -> None:
+        """Optimize a newly produced export, then store it in the caches.
+
+        The caches hold the optimized export, so that an export is only ever
+        optimized once.
+        """
+        self._optimize(job)
+        self._store_cached(job)
+
+    def _optimizations(self, output_format: str) -> List[str]:
+        """The optimizations exports in ``output_format`` go through."""
+        config = self.config
+        if output_format == "svg" and config.drawio_optimize_svg:
+            return [
+                f"optimize svg {config.drawio_svg_precision} {optimize.SVG_VERSION}"
+            ]
+        if output_format == "png" and config.drawio_optimize_png:
+            return ["optimize png"]
+        return []
+
+    def _optimize(self, job: "ExportJob") -> None:
+        if not self._optimizations(job.output_format):
+            return
+        export_abspath = job.export_abspath
+        tmp_abspath = export_abspath.with_name(
+            f"{export_abspath.stem}.{os.getpid()}-{threading.get_ident()}.tmp"
+            f"{export_abspath.suffix}"
+        )
+        try:
+            with self.config._export_metrics.span("optimize", [job]):
+                if job.output_format == "svg":
+                    optimize.optimize_svg(
+                        export_abspath, tmp_abspath, self.config.drawio_svg_precision
+                    )
+                else:
+                    optimize.optimize_png(export_abspath, tmp_abspath)
+            if tmp_abspath.exists():
+                # the export may be hard linked, e.g. into a batch's output
+                os.replace(str(tmp_abspath), str(export_abspath))
+        except (OSError, ValueError, zlib.error, ET.ParseError) as exc:
+            logger.warning(f"could not optimize '{job.export_relpath}': {exc}")
+        finally:
+            if tmp_abspath.exists():
+                tmp_abspath.unlink()
+
+    def _store_cached(self, job: "ExportJob", caches=None) -> None:
+        if caches is None:
+            caches = self.config._export_caches
+        if not caches:
+            return
+        with self.config._export_metrics.span("cache", [job]):
+            for cache in caches:
+                cache.put(job.key, job.output_format, job.export_abspath)
+
+    def _prepare_export(self, input_abspath, options, out_filename) -> "ExportJob":
+        """Resolve the directive options into a (not yet executed) export job."""
         builder = self.app.builder
         input_relpath = input_abspath.relative_to(builder.srcdir)
-        input_stem = input_abspath.stem
 
         page_name = options.get("page-name", None)
         page_index = options.get("page-index", None)
@@ -236,92 +804,275 @@ class DrawIOConverter(ImageConverter):
             "transparency", builder.config.drawio_default_transparency
         )
         layer_selection = options.get("layer-selection", None)
-        disable_verbose_electron = builder.config.drawio_disable_verbose_electron
-        disable_dev_shm_usage = builder.config.drawio_disable_dev_shm_usage
-        disable_gpu = builder.config.drawio_disable_gpu
-        no_sandbox = builder.config.drawio_no_sandbox
 
-        # Any directive options which would change the output file would go here
+        job = ExportJob(
+            key="",
+            input_abspath=input_abspath,
+            input_relpath=input_relpath,
+            source_digest=self._page_digest(input_abspath, int(page_index)),
+            export_abspath=Path(out_filename),
+            export_relpath=Path(out_filename),
+            output_format=Path(out_filename).suffix[1:],
+            page_index=page_index,
+            scale=scale,
+            transparent=transparent,
+            layer_selection=layer_selection,
+            extra_options={
+                option: options[option]
+                for option in OPTIONAL_UNIQUES
+                if option in options
+            },
+        )
+        job = job._replace(renderer=self._renderer(job))
+        return self._with_format(job, job.output_format)
+
+    def _renderer(self, job: "ExportJob") -> str:
+        """Whether the job is rendered by draw.io, its export server or worker,
+        or natively.
+
+        The export server or worker, when configured, replaces the draw.io
+        binary. Once the worker failed, jobs are exported with draw.io.
+        """
+        renderer = self.config.drawio_renderer
+        worker = self.config._export_worker
+        if self.config._export_server:
+            fallback = "server"
+        elif worker is not None and not worker.failed:
+            fallback = "worker"
+        else:
+            fallback = "electron"
+        if renderer == "electron":
+            return fallback
+        reason = self._native_unsupported(job)
+        if reason is None:
+            return "native"
+        if renderer == "native":
+            raise DrawIOError(
+                f"draw.io file {job.input_abspath} can't be rendered natively: "
+                f"{reason}"
+            )
+        return fallback
+
+    def _renderer_version(self, job: "ExportJob") -> str:
+        """What identifies the renderer of the job in its export key."""
+        if job.renderer == "native":
+            return f"native {native.VERSION}"
+        if job.renderer == "server":
+            # the server's draw.io can't be asked for its version
+            version = self.config.drawio_export_server_version
+            server = f"server {self.config._export_server.url}"
+            return server if version is None else f"{server} {version}"
+        if job.renderer == "worker":
+            # the worker may run another draw.io than the binary
+            version = self.config.drawio_export_worker_version
+            worker = f"worker {' '.join(self.config._export_worker.command)}"
+            return worker if version is None else f"{worker} {version}"
+        return drawio_version(self.app)
+
+    def _native_unsupported(self, job: "ExportJob") -> Optional[str]:
+        """Why the native renderer can't render the job, if it can't."""
+        if job.output_format != "svg":
+            return f"{job.output_format} output"
+        if job.extra_options:
+            return "export width or height"
+        memo_key = (
+            job.source_digest,
+            job.page_index,
+            job.layer_selection,
+            job.transparent,
+        )
+        memo = self.config._native_support
+        if memo_key not in memo:
+            try:
+                native.render_svg(
+                    *self._native_source(job), transparent=job.transparent
+                )
+            except native.UnsupportedDiagram as exc:
+                memo[memo_key] = str(exc)
+            else:
+                memo[memo_key] = None
+        return memo[memo_key]
+
+    def _native_source(self, job: "ExportJob") -> tuple:
+        """The arguments of :func:`.native.render_svg` for the job's page."""
+        content, page_index = self._export_source(job)
+        source = str(job.input_abspath) if content is None else io.BytesIO(content)
+        layers = None
+        if job.layer_selection:
+            try:
+                layers = [int(layer) for layer in job.layer_selection.split(",")]
+            except ValueError:
+                raise native.UnsupportedDiagram("layer selection")
+        return source, int(page_index), layers
+
+    def _with_format(self, job: "ExportJob", output_format: str) -> "ExportJob":
+        """The job exporting the same as ``job`` in ``output_format``."""
+        # Any directive options which would change the output file would go here.
+        # The source is identified by its content rather than its path, so that
+        # the same hash is generated no matter the project or build directory.
+        # A bitmap rasterized from the SVG export differs from the one draw.io
+        # would export, so it isn't served to builds which don't rasterize.
+        rasterizer = []
+        if self._is_rasterizable(job, output_format):
+            rasterizer.append(rasterize.version())
         unique_values = (
-            # This ensures that the same file hash is generated no matter the build directory
-            # Mainly useful for pytest, as it creates a new build directory every time
-            str(input_relpath),
-            page_index,
-            str(layer_selection) if layer_selection else "",
-            scale,
-            "true" if transparent else "false",
-            *[str(options.get(option)) for option in OPTIONAL_UNIQUES],
+            job.page_index,
+            str(job.layer_selection) if job.layer_selection else "",
+            job.scale,
+            "true" if job.transparent else "false",
+            *[str(job.extra_options.get(option)) for option in OPTIONAL_UNIQUES],
+            # The export is only reused while the source content, the output
+            # format and the draw.io version that produced it are unchanged.
+            job.source_digest,
+            output_format,
+            self._renderer_version(job),
+            *rasterizer,
+            # an optimized export replaces the one it was made from
+            *self._optimizations(output_format),
         )
         hash_key = "\n".join(unique_values)
         sha_key = sha1(hash_key.encode()).hexdigest()
+        out_filename = f"{job.export_abspath.stem}.{output_format}"
         export_abspath = Path(self.imagedir) / sha_key / out_filename
-        export_abspath.parent.mkdir(parents=True, exist_ok=True)
-        export_relpath = export_abspath.relative_to(builder.doctreedir)
-        output_format = export_abspath.suffix[1:]
+        return job._replace(
+            key=sha_key,
+            export_abspath=export_abspath,
+            export_relpath=export_abspath.relative_to(self.app.builder.doctreedir),
+            output_format=output_format,
+        )
 
-        if (
-            export_abspath.exists()
-            and export_abspath.stat().st_mtime > input_abspath.stat().st_mtime
-        ):
-            return export_abspath
-
-        drawio_in_path = shutil.which("drawio")
-        draw_dot_io_in_path = shutil.which("draw.io")
-        WINDOWS_PATH = r"C:\Program Files\draw.io\draw.io.exe"
-        MACOS_PATH = "/Applications/draw.io.app/Contents/MacOS/draw.io"
-        LINUX_PATH = "/opt/drawio/drawio"
-        LINUX_OLD_PATH = "/opt/draw.io/drawio"
-
-        if builder.config.drawio_binary_path:
-            binary_path = builder.config.drawio_binary_path
-        elif drawio_in_path:
-            binary_path = drawio_in_path
-        elif draw_dot_io_in_path:
-            binary_path = draw_dot_io_in_path
-        elif platform.system() == "Windows" and os.path.isfile(WINDOWS_PATH):
-            binary_path = WINDOWS_PATH
-        elif platform.system() == "Darwin" and os.path.isfile(MACOS_PATH):
-            binary_path = MACOS_PATH
-        elif platform.system() == "Linux" and os.path.isfile(LINUX_PATH):
-            binary_path = LINUX_PATH
-        elif platform.system() == "Linux" and os.path.isfile(LINUX_OLD_PATH):
-            binary_path = LINUX_OLD_PATH
-        else:
+    def _is_passthrough(self, job: "ExportJob") -> bool:
+        """Whether the source is an editable image which is the export already.
+
+        draw.io renders the first page into the image, at the default scale and
+        with all layers, on a white background for PNG images.
+        """
+        if not str(job.input_abspath).endswith(f".drawio.{job.output_format}"):
+            return False
+        pages = drawio_metadata(self.env, job.input_abspath).pages
+        return (
+            len(pages) <= 1
+            and job.page_index == "0"
+            and job.scale == "1.0"
+            and not job.layer_selection
+            and not job.extra_options
+            and not (job.output_format == "png" and job.transparent)
+        )
+
+    def _is_extracted(self, job: "ExportJob") -> bool:
+        """Whether draw.io is handed only the exported page of the source."""
+        pages = drawio_metadata(self.env, job.input_abspath).pages
+        return len(pages) > 1 and int(job.page_index) < len(pages)
+
+    def _batch_key(self, job: "ExportJob") -> tuple:
+        """The :attr:`ExportJob.batch_key` of the job as draw.io runs it.
+
+        An extracted page is page 0 of its own file, so the pages of a source
+        share a batch.
+        """
+        if self._is_extracted(job):
+            job = job._replace(page_index="0")
+        return job.batch_key
+
+    def _export_source(self, job: "ExportJob") -> Tuple[Optional[bytes], str]:
+        """The diagram to hand to draw.io and the index of the page to export.
+
+        The diagram is None when draw.io is to read the source file as it is.
+        Of a multi-page diagram, only the exported page is handed to draw.io,
+        which then neither parses nor lays out the other pages.
+        """
+        path = job.input_abspath
+        content = read_embedded_diagram(path) if is_embedding_image(path) else None
+        if self._is_extracted(job):
+            source = str(path) if content is None else io.BytesIO(content)
+            page = extract_page(source, int(job.page_index))
+            if page is not None:
+                return page, "0"
+        return content, job.page_index
+
+    def _is_export_fresh(self, job: "ExportJob") -> bool:
+        # The export path is derived from the source content and all export
+        # options, so an existing export is always up to date.
+        if self.config._export_manifest.exists(str(job.export_relpath)):
+            return True
+        # e.g. made by another build sharing the doctree directory
+        try:
+            self._record_export(job)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _record_export(self, job: "ExportJob", render_time=None) -> int:
+        """Add the export to the manifest, returning its size."""
+        size = job.export_abspath.stat().st_size
+        self.config._export_manifest.add(
+            str(job.export_relpath),
+            job.key,
+            job.source_digest,
+            size,
+            render_time,
+            job.variant,
+        )
+        return size
+
+    def _drawio_args(
+        self,
+        job: "ExportJob",
+        input_path: Path,
+        output_path: Path,
+        page_index: Optional[str] = None,
+    ) -> List[str]:
+        """The command line exporting ``input_path`` with the options of ``job``.
+
+        ``page_index`` overrides the page of ``job``, for an input holding
+        only some of the pages of the source.
+
+        The input and output may also be directories, in which case draw.io
+        exports every file of the input directory.
+        """
+        builder = self.app.builder
+        disable_verbose_electron = builder.config.drawio_disable_verbose_electron
+        disable_dev_shm_usage = builder.config.drawio_disable_dev_shm_usage
+        disable_gpu = builder.config.drawio_disable_gpu
+        no_sandbox = builder.config.drawio_no_sandbox
+
+        binary_path = drawio_binary(builder.config)
+        if binary_path is None:
             raise DrawIOError("No drawio executable found")
 
-        scale_args = ["--scale", scale]
-        if output_format == "pdf" and float(scale) == 1.0:
+        scale_args = ["--scale", job.scale]
+        if job.output_format == "pdf" and float(job.scale) == 1.0:
             # https://github.com/jgraph/drawio-desktop/issues/344 workaround
             # This is fixed now, but is left in for backwards compat.
             scale_args.clear()
 
         extra_args = []
         for option, drawio_arg in OPTIONAL_UNIQUES.items():
-            if option in options:
-                value = options[option]
+            if option in job.extra_options:
+                value = job.extra_options[option]
                 extra_args.append(f"--{drawio_arg}")
                 extra_args.append(str(value))
 
-        if transparent:
+        if job.transparent:
             extra_args.append("--transparent")
 
-        if layer_selection:
+        if job.layer_selection:
             extra_args.append("--layers")
-            extra_args.append(layer_selection)
+            extra_args.append(job.layer_selection)
 
         drawio_args = [
             binary_path,
             "--export",
             "--crop",
             "--page-index",
-            page_index,
+            job.page_index if page_index is None else page_index,
             *scale_args,
             *extra_args,
             "--format",
-            output_format,
+            job.output_format,
             "--output",
-            str(export_abspath),
-            str(input_abspath),
+            str(output_path),
+            str(input_path),
         ]
 
         if not disable_verbose_electron:
@@ -339,72 +1090,606 @@ class DrawIOConverter(ImageConverter):
             # This may be needed for docker support, and it has to be the last argument to work.
             drawio_args.append("--no-sandbox")
 
-        new_env = os.environ.copy()
-        if builder.config._display:
-            new_env["DISPLAY"] = f":{builder.config._display}"
-
-        # This environment variable prevents the drawio application from starting.
-        # This is automatically set within certain Visual Studio Code contexts,
-        # such as for the reStructuredText (sphinx) preview.
-        new_env.pop("ELECTRON_RUN_AS_NODE", None)
+        return drawio_args
+
+    def _run_drawio(
+        self, drawio_args: List[str], files: int = 1
+    ) -> subprocess.CompletedProcess:
+        """Run draw.io, which is given ``drawio_export_timeout`` per exported file."""
+        config = self.app.builder.config
+        timeout = config.drawio_export_timeout
+        if timeout is not None:
+            timeout *= files
+        attempts = config.drawio_export_retries + 1
+        for attempt in range(1, attempts + 1):
+            # a display that can't be had is an Xvfb error, not a draw.io one
+            with checkout_display(config) as display:
+                try:
+                    return run_drawio(drawio_args, drawio_env(display), timeout)
+                except subprocess.TimeoutExpired as exc:
+                    if attempt == attempts:
+                        raise DrawIOError(
+                            "draw.io ({args}) timed out after {timeout}s and was "
+                            "killed:\n[stderr]\n{stderr}\n[stdout]\n{stdout}".format(
+                                args=" ".join(drawio_args),
+                                timeout=timeout,
+                                stderr=exc.stderr,
+                                stdout=exc.stdout,
+                            )
+                        )
+                    reason = f"timed out after {timeout}s"
+                except OSError as exc:
+                    raise DrawIOError(
+                        "draw.io ({args}) exited with error:\n{exc}".format(
+                            args=" ".join(drawio_args), exc=exc
+                        )
+                    )
+                except subprocess.CalledProcessError as exc:
+                    # only a crash is worth another try, draw.io reports any
+                    # problem with the diagram or the options with an exit code
+                    if exc.returncode >= 0 or attempt == attempts:
+                        raise DrawIOError(
+                            "draw.io ({args}) exited with error:\n[stderr]\n{stderr}"
+                            "\n[stdout]\n{stdout}\n[returncode]\n{returncode}".format(
+                                args=" ".join(drawio_args),
+                                stderr=exc.stderr,
+                                stdout=exc.stdout,
+                                returncode=exc.returncode,
+                            )
+                        )
+                    reason = f"was killed by signal {-exc.returncode}"
+            delay = config.drawio_export_retry_delay * 2 ** (attempt - 1)
+            logger.warning(
+                f"draw.io ({' '.join(drawio_args)}) {reason}, "
+                f"retrying in {delay}s ({attempt}/{attempts - 1})"
+            )
+            time.sleep(delay)
 
-        logger.info(f"(drawio) '{input_relpath}' -> '{export_relpath}'")
+    def _render_native(self, job: "ExportJob") -> None:
+        export_abspath = job.export_abspath
+        tmp_abspath = export_abspath.with_name(
+            f"{export_abspath.stem}.{os.getpid()}-{threading.get_ident()}.tmp"
+            f"{export_abspath.suffix}"
+        )
+        logger.info(
+            f"(drawio) '{job.input_relpath}' -> '{job.export_relpath}' (native)"
+        )
+        metrics = self.config._export_metrics
         try:
-            ret = subprocess.run(
-                drawio_args, stderr=PIPE, stdout=PIPE, check=True, env=new_env
+            with metrics.span("native", [job]):
+                svg = native.render_svg(
+                    *self._native_source(job), float(job.scale), job.transparent
+                )
+            tmp_abspath.write_text(svg, encoding="utf-8")
+            os.replace(str(tmp_abspath), str(export_abspath))
+        except native.UnsupportedDiagram as exc:
+            raise DrawIOError(
+                f"draw.io file {job.input_abspath} can't be rendered natively: {exc}"
             )
-        except OSError as exc:
+        finally:
+            if tmp_abspath.exists():
+                tmp_abspath.unlink()
+        metrics.entry(job)["outcome"] = "exported"
+
+    def _server_source(self, job: "ExportJob") -> Tuple[bytes, int]:
+        """The diagram to POST to the export server and the page to export.
+
+        The page is decompressed and its layers are hidden as draw.io's
+        ``--layers`` option would, which the server has no equivalent for.
+        """
+        content, page_index = self._export_source(job)
+        source = str(job.input_abspath) if content is None else io.BytesIO(content)
+        page = extract_page(source, int(page_index))
+        if page is not None:
+            content, page_index = page, "0"
+        elif content is None:
+            content = job.input_abspath.read_bytes()
+        if job.layer_selection:
+            try:
+                layers = [int(layer) for layer in job.layer_selection.split(",")]
+            except ValueError:
+                raise DrawIOError(f"invalid layer selection: {job.layer_selection}")
+            content = select_layers(content, layers)
+        return content, int(page_index)
+
+    def _export_with_server(self, job: "ExportJob", server, phase: str) -> None:
+        """Export with ``server``, an export server or worker, see :mod:`.worker`.
+
+        The time spent is recorded as ``phase``.
+        """
+        config = self.config
+        name = "export server" if phase == "server" else "export worker"
+        export_abspath = job.export_abspath
+        tmp_abspath = export_abspath.with_name(
+            f"{export_abspath.stem}.{os.getpid()}-{threading.get_ident()}.tmp"
+            f"{export_abspath.suffix}"
+        )
+        logger.info(
+            f"(drawio) '{job.input_relpath}' -> '{job.export_relpath}' ({name})"
+        )
+        content, page_index = self._server_source(job)
+        metrics = config._export_metrics
+        attempts = config.drawio_export_retries + 1
+        try:
+            with metrics.span(phase, [job]):
+                for attempt in range(1, attempts + 1):
+                    try:
+                        image = server.export(
+                            content,
+                            job.output_format,
+                            page_index,
+                            float(job.scale),
+                            job.transparent,
+                            job.extra_options.get("export-width"),
+                            job.extra_options.get("export-height"),
+                        )
+                        break
+                    except ExportServerError as exc:
+                        # only a server error is worth another try
+                        if exc.status < 500 or attempt == attempts:
+                            raise
+                        reason = f"answered with status {exc.status}"
+                    except (OSError, http.client.HTTPException) as exc:
+                        if attempt == attempts:
+                            raise
+                        reason = f"failed ({exc})"
+                    delay = config.drawio_export_retry_delay * 2 ** (attempt - 1)
+                    logger.warning(
+                        f"draw.io {name} ({server.url}) {reason}, "
+                        f"retrying in {delay}s ({attempt}/{attempts - 1})"
+                    )
+                    time.sleep(delay)
+        except ExportServerError as exc:
             raise DrawIOError(
-                "draw.io ({args}) exited with error:\n{exc}".format(
-                    args=" ".join(drawio_args), exc=exc
+                "draw.io {name} ({url}) failed to export {path}:"
+                "\n[status]\n{status}\n[response]\n{body}".format(
+                    name=name,
+                    url=server.url,
+                    path=job.input_abspath,
+                    status=exc.status,
+                    body=exc.body.decode(errors="replace"),
                 )
             )
-        except subprocess.CalledProcessError as exc:
+        except (OSError, http.client.HTTPException) as exc:
             raise DrawIOError(
-                "draw.io ({args}) exited with error:\n[stderr]\n{stderr}"
-                "\n[stdout]\n{stdout}\n[returncode]\n{returncode}".format(
-                    args=" ".join(drawio_args),
-                    stderr=exc.stderr,
-                    stdout=exc.stdout,
-                    returncode=exc.returncode,
+                f"draw.io {name} ({server.url}) failed to export "
+                f"{job.input_abspath}:\n{exc}"
+            )
+
+        try:
+            tmp_abspath.write_bytes(image)
+            os.replace(str(tmp_abspath), str(export_abspath))
+        finally:
+            if tmp_abspath.exists():
+                tmp_abspath.unlink()
+        metrics.entry(job)["outcome"] = "exported"
+
+    def _run_export(self, job: "ExportJob") -> None:
+        if job.renderer == "native":
+            self._render_native(job)
+            return
+        if job.renderer == "server":
+            self._export_with_server(job, self.config._export_server, "server")
+            return
+        if job.renderer == "worker":
+            self._export_with_server(job, self.config._export_worker, "worker")
+            return
+
+        # draw.io writes to a temporary file which is renamed once complete, so
+        # that no other build ever sees a partial export
+        export_abspath = job.export_abspath
+        tmp_abspath = export_abspath.with_name(
+            f"{export_abspath.stem}.{os.getpid()}-{threading.get_ident()}.tmp"
+            f"{export_abspath.suffix}"
+        )
+
+        logger.info(f"(drawio) '{job.input_relpath}' -> '{job.export_relpath}'")
+        metrics = self.config._export_metrics
+        with ExitStack() as stack:
+            input_path = job.input_abspath
+            content, page_index = self._export_source(job)
+            if content is not None:
+                tmpdir = stack.enter_context(
+                    tempfile.TemporaryDirectory(prefix="drawio-")
                 )
+                input_path = Path(tmpdir) / f"{job.key}.drawio"
+                input_path.write_bytes(content)
+            drawio_args = self._drawio_args(job, input_path, tmp_abspath, page_index)
+
+            try:
+                with metrics.span("drawio", [job]):
+                    ret = self._run_drawio(drawio_args)
+                if not tmp_abspath.exists():
+                    raise DrawIOError(
+                        "draw.io ({args}) did not produce an output file:"
+                        "\n[stderr]\n{stderr}\n[stdout]\n{stdout}".format(
+                            args=" ".join(drawio_args),
+                            stderr=ret.stderr,
+                            stdout=ret.stdout,
+                        )
+                    )
+                os.replace(str(tmp_abspath), str(export_abspath))
+                metrics.entry(job)["outcome"] = "exported"
+            finally:
+                if tmp_abspath.exists():
+                    tmp_abspath.unlink()
+
+    def _export_batch(self, jobs: List["ExportJob"]) -> None:
+        """Export several sources sharing the same options with one draw.io run.
+
+        The sources are gathered in a temporary directory, which draw.io
+        exports as a whole. Should the batch fail, the jobs are exported one by
+        one so that errors are reported for the offending source.
+        """
+        if jobs[0].renderer != "electron":
+            for job in jobs:
+                self._export(job)
+            return
+        with ExitStack() as stack:
+            for job in jobs:
+                stack.enter_context(self._exporting(job))
+            pending = [job for job in jobs if not self._fetch_cached(job)]
+            if len(pending) <= 1:
+                for job in pending:
+                    self._produce(job)
+            else:
+                self._produce_batch(pending)
+
+    def _produce_batch(self, pending: List["ExportJob"]) -> None:
+        metrics = self.config._export_metrics
+        with ExitStack() as locks, tempfile.TemporaryDirectory(
+            prefix="drawio-"
+        ) as tmpdir:
+            # locks are taken in a fixed order, so builds can't deadlock
+            for job in sorted(pending, key=lambda job: job.export_abspath):
+                locks.enter_context(export_lock(job.export_abspath.parent))
+            pending = [job for job in pending if not self._is_export_fresh(job)]
+            for job in [job for job in pending if self._rasterize(job)]:
+                self._store_produced(job)
+                pending.remove(job)
+            if not pending:
+                return
+
+            input_dir = Path(tmpdir) / "input"
+            output_dir = Path(tmpdir) / "output"
+            input_dir.mkdir()
+            output_dir.mkdir()
+            # draw.io exports the same page of every file of the batch, the
+            # sources whose page could not be extracted are exported on their own
+            sources = [(job, *self._export_source(job)) for job in pending]
+            page_index = sources[0][2]
+            separate = [job for job, _, page in sources if page != page_index]
+            pending = [job for job, _, page in sources if page == page_index]
+            for job, content, _ in sources:
+                if job not in pending:
+                    continue
+                if content is None:
+                    shutil.copyfile(job.input_abspath, input_dir / f"{job.key}.drawio")
+                else:
+                    (input_dir / f"{job.key}.drawio").write_bytes(content)
+
+            drawio_args = self._drawio_args(
+                pending[0], input_dir, output_dir, page_index
             )
-        if not export_abspath.exists():
-            raise DrawIOError(
-                "draw.io ({args}) did not produce an output file:"
-                "\n[stderr]\n{stderr}\n[stdout]\n{stdout}".format(
-                    args=" ".join(drawio_args), stderr=ret.stderr, stdout=ret.stdout
+            for job in pending:
+                logger.info(
+                    f"(drawio) '{job.input_relpath}' -> '{job.export_relpath}'"
+                    f" (batch of {len(pending)})"
                 )
+            try:
+                with metrics.span("drawio", pending):
+                    self._run_drawio(drawio_args, len(pending))
+            except DrawIOError:
+                pending_exports = separate + pending
+            else:
+                pending_exports = separate
+                for job in pending:
+                    output = output_dir / f"{job.key}.{job.output_format}"
+                    if output.exists():
+                        link_or_copy(output, job.export_abspath)
+                        metrics.entry(job)["outcome"] = "exported"
+                        self._store_produced(job)
+                    else:
+                        pending_exports.append(job)
+
+            for job in pending_exports:
+                self._run_export(job)
+                self._store_produced(job)
+
+    def pending_exports(self, images: List[nodes.image]) -> List["ExportJob"]:
+        """The exports the given image nodes need which are not up to date.
+
+        Jobs sharing an export path are only listed once. Errors raised while
+        resolving a node's options are left for :meth:`handle` to report so
+        that they surface exactly as in a sequential build.
+        """
+        jobs = {}
+        for node in images:
+            if not self.match(node):
+                continue
+            _from, _to = self.get_conversion_rule(node)
+            srcpath = node["candidates"].get(_from, node["candidates"].get("*"))
+            abs_srcpath = Path(self.app.srcdir) / srcpath
+            if not os.path.exists(abs_srcpath):
+                continue
+
+            out_filename = get_filename_for(srcpath, _to)
+            try:
+                with logging.suppress_logging():
+                    job = self._resolve_export(
+                        abs_srcpath, node.attributes, out_filename
+                    )
+            except DrawIOError:
+                continue
+            if job.export_abspath in jobs or self._is_passthrough(job):
+                continue
+            if not self._is_export_fresh(job):
+                jobs[job.export_abspath] = job
+        return list(jobs.values())
+
+    def export_keys(self, images: List[nodes.image]) -> Optional[Set[str]]:
+        """The keys of the exports the given image nodes use.
+
+        Returns None if that can't be told for every node, e.g. as a diagram
+        can't be read.
+        """
+        keys = set()
+        for node in images:
+            if not self.match(node):
+                continue
+            _from, _to = self.get_conversion_rule(node)
+            srcpath = node["candidates"].get(_from, node["candidates"].get("*"))
+            abs_srcpath = Path(self.app.srcdir) / srcpath
+            if not os.path.exists(abs_srcpath):
+                continue
+            try:
+                with logging.suppress_logging():
+                    job = self._prepare_export(
+                        abs_srcpath, node.attributes, get_filename_for(srcpath, _to)
+                    )
+            except (DrawIOError, OSError, ET.ParseError):
+                return None
+            keys.add(job.key)
+        return keys
+
+    def export_pending(
+        self, images: List[nodes.image], workers: int, batch: bool
+    ) -> None:
+        """Export the drawio files of all given image nodes through a worker pool.
+
+        With ``batch``, jobs which only differ in their source are exported by
+        a single draw.io run. Nodes are not modified; :meth:`handle` later
+        picks up the (now fresh) exports.
+        """
+        jobs = self.pending_exports(images)
+        if not jobs:
+            return
+
+        if batch:
+            # Each batch holds a single job per key, any other job with the
+            # same key is the same export under another file name.
+            batches: Dict[tuple, Dict[str, ExportJob]] = {}
+            duplicates = []
+            for job in jobs:
+                batch_jobs = batches.setdefault(self._batch_key(job), {})
+                if job.key in batch_jobs:
+                    duplicates.append((batch_jobs[job.key], job))
+                else:
+                    batch_jobs[job.key] = job
+            # Batches are split, so that they are spread over the workers and
+            # a failed draw.io run only affects part of a batch.
+            size = min(self.config.drawio_batch_size, -(-len(jobs) // workers))
+            tasks = []
+            for batch in batches.values():
+                batch_jobs = list(batch.values())
+                for start in range(0, len(batch_jobs), size):
+                    tasks.append((self._export_batch, batch_jobs[start : start + size]))
+        else:
+            duplicates = []
+            tasks = [(self._export, job) for job in jobs]
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(*task) for task in tasks]
+        for future in futures:
+            # re-raise the first failure, in document order
+            future.result()
+
+        for exported, job in duplicates:
+            if not exported.export_abspath.exists():
+                # exported with draw.io instead of the failed export worker,
+                # handle() exports it again under the key of draw.io
+                continue
+            link_or_copy(exported.export_abspath, job.export_abspath)
+            self._record_export(job)
+
+
+class ExportJob(NamedTuple):
+    key: str
+    input_abspath: Path
+    input_relpath: Path
+    source_digest: str
+    export_abspath: Path
+    export_relpath: Path
+    output_format: str
+    page_index: str
+    scale: str
+    transparent: bool
+    layer_selection: Optional[str]
+    extra_options: Dict[str, Any]
+    #: "electron" to export with draw.io, "server" or "worker" to export with
+    #: an export server, see :mod:`.server` and :mod:`.worker`, or "native",
+    #: see :mod:`.native`
+    renderer: str = "electron"
+
+    @property
+    def batch_key(self) -> tuple:
+        """Jobs with the same batch key only differ in their source."""
+        return (
+            self.output_format,
+            self.page_index,
+            self.scale,
+            self.transparent,
+            self.layer_selection,
+            tuple(sorted(self.extra_options.items())),
+            self.renderer,
+        )
+
+    @property
+    def variant(self) -> str:
+        """Jobs of the same variant only differ in the content of their source."""
+        variant = (str(self.input_relpath), self.export_abspath.name, self.batch_key)
+        return sha1(repr(variant).encode()).hexdigest()
+
+
+class DrawIOCollector(EnvironmentCollector):
+    """Remembers the drawio image nodes of each document and their exports.
+
+    This allows all exports of a build to be scheduled up front, before any
+    document is written, and tells the exports documents which a build
+    doesn't read still use.
+    """
+
+    def clear_doc(self, app: Sphinx, env: BuildEnvironment, docname: str) -> None:
+        env.drawio_images.pop(docname, None)
+        env.drawio_export_keys.pop(docname, None)
+
+    def merge_other(
+        self,
+        app: Sphinx,
+        env: BuildEnvironment,
+        docnames: set,
+        other: BuildEnvironment,
+    ) -> None:
+        for docname in docnames:
+            if docname in other.drawio_images:
+                env.drawio_images[docname] = other.drawio_images[docname]
+        env.drawio_metadata.update(other.drawio_metadata)
+
+    def process_doc(self, app: Sphinx, doctree: nodes.document) -> None:
+        # the converter later points the candidates of the node to the export
+        images = [
+            {**node.attributes, "candidates": dict(node["candidates"])}
+            for node in traverse([doctree])
+            if isinstance(node, docutils_image) and "drawio" in node["classes"]
+        ]
+        if images:
+            app.env.drawio_images[app.env.docname] = images
+
+        # Index the referenced files while reading, so that the index is saved
+        # with the environment for the following builds.
+        for image in images:
+            path = Path(app.srcdir) / image["candidates"].get("*", "")
+            is_diagram = path.suffix == ".drawio" or is_embedding_image(path)
+            if is_diagram and path.is_file():
+                drawio_metadata(app.env, path)
+
+
+def on_builder_inited(app: Sphinx) -> None:
+    if not hasattr(app.env, "drawio_images"):
+        app.env.drawio_images = {}
+    if not hasattr(app.env, "drawio_metadata"):
+        app.env.drawio_metadata = {}
+    if not hasattr(app.env, "drawio_export_keys"):
+        app.env.drawio_export_keys = {}
+
+    app.config._export_metrics = ExportMetrics()
+    app.config._deferred_images = {}
+    app.config._deferred_docnames = {}
+    app.config._native_support = {}
+    if app.config.drawio_rasterize_svg and not rasterize.is_available():
+        logger.warning(
+            "drawio_rasterize_svg requires cairosvg, bitmaps are exported by draw.io"
+        )
+    app.config._export_manifest = ExportManifest(Path(app.doctreedir) / "drawio")
+
+    # The caches are checked in order, the fastest one first
+    app.config._export_caches = []
+    if app.config.drawio_cache_dir:
+        confdir = Path(app.confdir or app.srcdir)
+        cache_dir = confdir / os.path.expanduser(app.config.drawio_cache_dir)
+        app.config._export_caches.append(
+            LocalExportCache(cache_dir, app.config.drawio_cache_max_size)
+        )
+    if app.config.drawio_cache_url:
+        app.config._export_caches.append(HTTPExportCache(app.config.drawio_cache_url))
+    for cache in app.config.drawio_export_caches:
+        if not isinstance(cache, ExportCache):
+            raise DrawIOError(
+                f"drawio_export_caches: {cache!r} is not an ExportCache instance"
             )
-        return export_abspath
+        app.config._export_caches.append(cache)
+
+    app.config._export_server = None
+    if app.config.drawio_export_server_url:
+        app.config._export_server = ExportServer(
+            app.config.drawio_export_server_url,
+            export_workers(app.config),
+            app.config.drawio_export_timeout,
+        )
+
+    app.config._export_worker = None
+    command = app.config.drawio_export_worker
+    if command and not app.config._export_server:
+        app.config._export_worker = ExportWorker(
+            shlex.split(command) if isinstance(command, str) else list(command),
+            Path(app.doctreedir) / "drawio" / "worker.log",
+            export_workers(app.config),
+            app.config.drawio_export_timeout,
+            app.config.drawio_export_worker_max_jobs,
+            app.config.drawio_export_worker_max_memory,
+        )
+
+
+def export_workers(config: Config) -> int:
+    if config.drawio_export_workers is None:
+        return os.cpu_count() or 1
+    return config.drawio_export_workers
+
+
+def on_env_updated(app: Sphinx, env: BuildEnvironment) -> None:
+    # forget about the draw.io files which are no longer used
+    referenced = {
+        os.path.relpath(Path(env.srcdir) / image["candidates"].get("*", ""), env.srcdir)
+        for images in env.drawio_images.values()
+        for image in images
+    }
+    for relpath in set(env.drawio_metadata) - referenced:
+        del env.drawio_metadata[relpath]
+
+    if not env.drawio_images:
+        return
+    document = new_document("")
+    document.settings.env = env
+    converter = DrawIOConverter(document)
+
+    # The exports are only resolved for the documents a build reads, see
+    # referenced_exports(). That is done here rather than in process_doc(), as
+    # the draw.io version the keys depend on is probed in the main process
+    # only, not in each parallel reader.
+    for docname in sorted(set(env.drawio_images) - set(env.drawio_export_keys)):
+        env.drawio_export_keys[docname] = converter.export_keys(
+            [docutils_image("", **image) for image in env.drawio_images[docname]]
+        )
+
+    workers = export_workers(app.config)
+    batch = app.config.drawio_batch_export
+    if (workers <= 1 and not batch) or app.config.drawio_background_export:
+        return
+
+    images = [
+        docutils_image("", **attributes)
+        for docname in sorted(env.drawio_images)
+        for attributes in env.drawio_images[docname]
+    ]
+    converter.export_pending(images, workers, batch)
 
 
 def on_config_inited(app: Sphinx, config: Config) -> None:
-    if is_headless(config):
-        logger.info("running in headless mode, starting Xvfb")
-        with TemporaryFile() as fp:
-            fd = fp.fileno()
-            xvfb = Popen(
-                ["Xvfb", "-displayfd", str(fd), "-screen", "0", "1280x768x16"],
-                pass_fds=(fd,),
-                stdout=PIPE,
-                stderr=PIPE,
-            )
-            if xvfb.poll() is not None:
-                raise OSError(
-                    f"Failed to start Xvfb process"
-                    "\n[stdout]\n{}\n[stderr]{*xvfb.communicate()}"
-                )
-            while fp.tell() == 0:
-                sleep(0.01)  # wait for Xvfb to start up
-            fp.seek(0)
-            config._xvfb = xvfb
-            config._display = fp.read().decode("ascii").strip()
-        logger.info(f"Xvfb is running on display :{config._display}")
-    else:
-        logger.info("running in non-headless mode, not starting Xvfb")
-        config._xvfb = None
-        config._display = None
+    # Xvfb is only started once draw.io is about to run, see checkout_display()
+    config._displays = None
+    config._drawio_binary = None
+    config._drawio_version = None
+    config._main_pid = os.getpid()
 
 
 def on_build_finished(app: Sphinx, exc: Exception) -> None:
@@ -414,15 +1699,271 @@ def on_build_finished(app: Sphinx, exc: Exception) -> None:
         dst = os.path.join(app.outdir, "_static")
         copy_asset(src, dst)
 
-    if app.config._xvfb:
-        app.config._xvfb.terminate()
-        stdout, stderr = app.config._xvfb.communicate()
-        if app.config._xvfb.poll() != 0:
-            raise OSError(
-                f"Encountered an issue while terminating Xvfb"
-                "\n[stdout]\n{stdout}\n[stderr]{stderr}"
+    # don't hide the reason the build failed
+    finish_exports(app, check=exc is None)
+
+
+def finish_exports(app: Sphinx, check: bool = True, gc: bool = True) -> None:
+    """Report on the exports, trim the export caches and stop Xvfb.
+
+    With ``gc``, the exports which are no longer used are also removed, see
+    :func:`remove_unused_exports`.
+    """
+    config = app.config
+    report = config._export_metrics.report()
+    if report["exports"]:
+        imagedir = Path(app.doctreedir) / "drawio"
+        write_json(imagedir / "report.json", report)
+        if config.drawio_export_trace:
+            write_json(imagedir / "trace.json", config._export_metrics.trace_events())
+
+        totals = report["totals"]
+        if any(
+            totals[outcome]
+            for outcome in ("cached", "rasterized", "exported", "failed")
+        ):
+            rasterized = totals["rasterized"]
+            logger.info(
+                f"(drawio) {totals['exported']} exported in "
+                f"{sum(totals[phase] for phase in RENDER_PHASES):.1f}s, "
+                + (f"{rasterized} rasterized, " if rasterized else "")
+                + f"{totals['cached']} from cache, {totals['up-to-date']} up to date, "
+                f"{totals['failed']} failed"
+            )
+        exports = report["exports"]
+        slowest = sorted(exports, key=lambda export: export["drawio"], reverse=True)
+        slowest = [export for export in slowest[:5] if export["drawio"]]
+        if slowest:
+            logger.info(
+                "(drawio) slowest exports:\n"
+                + "\n".join(
+                    f"  {export['drawio']:.1f}s '{export['source']}' "
+                    f"-> '{export['export']}'"
+                    for export in slowest
+                )
+            )
+        failed = [export for export in exports if export["outcome"] == "failed"]
+        if failed:
+            logger.info(
+                "(drawio) failed exports:\n"
+                + "\n".join(
+                    f"  '{export['source']}' -> '{export['export']}'"
+                    for export in failed
+                )
             )
 
+    gc_enabled = (
+        config.drawio_gc_grace_period is not None
+        or config.drawio_gc_max_size is not None
+    )
+    if gc and gc_enabled and check:
+        remove_unused_exports(app, report)
+
+    if config._deferred_images and check:
+        start_background_export(app)
+
+    config._export_manifest.flush()
+
+    for cache in config._export_caches:
+        cache.evict()
+
+    if config._export_worker:
+        config._export_worker.close()
+
+    if config._displays:
+        config._displays.close(check=check)
+
+
+#: Held by the background export while it runs, see start_background_export()
+BACKGROUND_LOCK = "background.lock"
+#: Touched by the background export once it has finished
+BACKGROUND_DONE = "background.done"
+#: The documents using a previous export, by the export replacing it
+OUTDATED_DOCS = "outdated.json"
+
+
+def on_env_get_outdated(
+    app: Sphinx, env: BuildEnvironment, added: set, changed: set, removed: set
+) -> List[str]:
+    """The documents to read again as a background export replaced their images.
+
+    Once no background export runs, the documents whose export is still
+    missing, e.g. as the export failed, are read again as well, so that it is
+    made or deferred once more.
+    """
+    imagedir = Path(app.doctreedir) / "drawio"
+    outdated_path = imagedir / OUTDATED_DOCS
+    try:
+        outdated = json.loads(outdated_path.read_text())
+    except (OSError, ValueError):
+        return []
+    with try_lock(imagedir / BACKGROUND_LOCK) as idle:
+        pass
+
+    docnames = set()
+    for export in list(outdated):
+        if idle or os.path.isfile(Path(app.doctreedir) / export):
+            docnames.update(outdated.pop(export))
+    if docnames:
+        write_json(outdated_path, outdated)
+    return sorted(docnames & env.found_docs)
+
+
+def start_background_export(app: Sphinx) -> None:
+    """Export the images whose previous export was served in a detached process.
+
+    The process runs ``python -m sphinxcontrib.drawio``, its output is appended
+    to ``background.log`` in the export directory. The documents using the
+    previous exports are recorded in ``outdated.json``, the following build
+    reads them again once the exports are made, see on_env_get_outdated(). The
+    process touches ``background.done`` when it has finished, for a watching
+    sphinx-autobuild to start that build.
+
+    The process holds ``background.lock`` while it exports, no other one is
+    started meanwhile: the remaining exports are deferred again by the build
+    following it.
+    """
+    config = app.config
+    imagedir = Path(app.doctreedir) / "drawio"
+    outdated_path = imagedir / OUTDATED_DOCS
+    try:
+        outdated = json.loads(outdated_path.read_text())
+    except (OSError, ValueError):
+        outdated = {}
+    for export, docnames in config._deferred_docnames.items():
+        outdated[export] = sorted(docnames.union(outdated.get(export, [])))
+    write_json(outdated_path, outdated)
+
+    lock_path = imagedir / BACKGROUND_LOCK
+    with open(lock_path, "a+b") as lock:
+        # The lock is taken here and handed to the process, so that no other
+        # build starts one before it runs. Without fcntl, the process takes it
+        # itself, and exports nothing if another one was quicker.
+        if fcntl:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                idle = False
+            else:
+                idle = True
+            lock_args = ["--lock-fd", str(lock.fileno())]
+            pass_fds: Tuple[int, ...] = (lock.fileno(),)
+        else:
+            with try_lock(lock_path) as idle:
+                pass
+            lock_args = ["--lock", str(lock_path)]
+            pass_fds = ()
+        if not idle:
+            logger.info(
+                f"(drawio) {len(config._deferred_images)} exports are left for "
+                "the build following the running background export"
+            )
+            return
+        _launch_background_export(app, lock_args, pass_fds)
+    logger.info(
+        f"(drawio) updating {len(config._deferred_images)} exports in the background"
+    )
+
+
+def _launch_background_export(
+    app: Sphinx, lock_args: List[str], pass_fds: Tuple[int, ...]
+) -> None:
+    config = app.config
+    imagedir = Path(app.doctreedir) / "drawio"
+    images_path = imagedir / "deferred.json"
+    write_json(images_path, list(config._deferred_images.values()))
+    # the process reads conf.py itself, but not what overrides it
+    overrides = {}
+    for name, value in config.overrides.items():
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            logger.warning(
+                f"(drawio) {name} can't be passed on to the background export, "
+                "which uses the value of conf.py instead"
+            )
+            continue
+        overrides[name] = value
+    overrides_path = imagedir / "overrides.json"
+    write_json(overrides_path, overrides)
+
+    args = [
+        sys.executable,
+        "-m",
+        "sphinxcontrib.drawio",
+        "-b",
+        app.builder.name,
+        "-c",
+        str(app.confdir),
+        "-d",
+        str(app.doctreedir),
+        "-j",
+        str(export_workers(config)),
+        "--images",
+        str(images_path),
+        "--overrides",
+        str(overrides_path),
+        *lock_args,
+        "--touch",
+        str(imagedir / BACKGROUND_DONE),
+        "-q",
+        str(app.srcdir),
+        str(app.outdir),
+    ]
+
+    with open(imagedir / "background.log", "ab") as log:
+        subprocess.Popen(
+            args,
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+            pass_fds=pass_fds,
+        )
+
+
+def referenced_exports(app: Sphinx) -> Optional[Set[str]]:
+    """The keys of the exports the documents of the environment use.
+
+    These are resolved once the documents a build reads are collected, see
+    :func:`on_env_updated`, so that an incremental build keeps the exports of
+    the documents it doesn't read, without resolving their exports again.
+    Returns None if the keys can't be told, e.g. as no document was read into
+    the environment.
+    """
+    env = app.env
+    if not env.all_docs:
+        return None
+    referenced = set()
+    for docname in env.drawio_images:
+        keys = env.drawio_export_keys.get(docname)
+        if keys is None:
+            # e.g. read by a version which didn't record the keys
+            return None
+        referenced.update(keys)
+    return referenced
+
+
+def remove_unused_exports(app: Sphinx, report: Dict[str, Any]) -> None:
+    """Remove the exports none of the recent builds referenced.
+
+    Nothing is removed unless all exports the environment uses are known.
+    """
+    config = app.config
+    referenced = referenced_exports(app)
+    if referenced is None:
+        logger.info("(drawio) unused exports are kept, the documents are unknown")
+        return
+    referenced.update(export["key"] for export in report["exports"])
+    removed, freed = collect_garbage(
+        Path(app.doctreedir) / "drawio",
+        referenced,
+        config.drawio_gc_grace_period,
+        config.drawio_gc_max_size,
+    )
+    if removed:
+        logger.info(f"(drawio) removed {removed} unused exports ({freed // 1024} KiB)")
+
 
 def setup(app: Sphinx) -> Dict[str, Any]:
     app.add_post_transform(DrawIOConverter)
@@ -437,6 +1978,8 @@ def setup(app: Sphinx) -> Dict[str, Any]:
     app.add_config_value("drawio_binary_path", None, "html")
     # noinspection PyTypeChecker
     app.add_config_value("drawio_headless", "auto", "html", ENUM("auto", True, False))
+    app.add_config_value("drawio_xvfb_screen", "1280x768x16", "", str)
+    app.add_config_value("drawio_xvfb_displays", None, "", [int, type(None)])
     # noinspection PyTypeChecker
     app.add_config_value(
         "drawio_disable_verbose_electron", False, "html", ENUM(True, False)
@@ -446,10 +1989,52 @@ def setup(app: Sphinx) -> Dict[str, Any]:
     )
     app.add_config_value("drawio_disable_gpu", False, "html", ENUM(True, False))
     app.add_config_value("drawio_no_sandbox", False, "html", ENUM(True, False))
+    app.add_config_value("drawio_export_workers", 1, "", [int, type(None)])
+    app.add_config_value("drawio_batch_export", False, "", ENUM(True, False))
+    app.add_config_value("drawio_batch_size", 100, "", int)
+    app.add_config_value("drawio_cache_dir", None, "", [str, type(None)])
+    app.add_config_value("drawio_cache_max_size", 1024**3, "", [int, type(None)])
+    app.add_config_value("drawio_cache_url", None, "", [str, type(None)])
+    app.add_config_value("drawio_export_caches", [], "", list)
+    app.add_config_value("drawio_export_trace", False, "", ENUM(True, False))
+    app.add_config_value(
+        "drawio_gc_grace_period", 7 * 24 * 3600, "", [int, float, type(None)]
+    )
+    app.add_config_value("drawio_gc_max_size", None, "", [int, type(None)])
+    app.add_config_value("drawio_export_timeout", 300, "", [int, float, type(None)])
+    app.add_config_value("drawio_export_retries", 1, "", int)
+    app.add_config_value("drawio_export_retry_delay", 1, "", [int, float])
+    app.add_config_value("drawio_background_export", False, "", ENUM(True, False))
+    app.add_config_value("drawio_rasterize_svg", False, "", ENUM(True, False))
+    # noinspection PyTypeChecker
+    app.add_config_value(
+        "drawio_renderer", "electron", "", ENUM("electron", "native", "auto")
+    )
+    app.add_config_value("drawio_export_server_url", None, "", [str, type(None)])
+    app.add_config_value("drawio_export_server_version", None, "", [str, type(None)])
+    app.add_config_value("drawio_export_worker", None, "", [str, list, type(None)])
+    app.add_config_value("drawio_export_worker_version", None, "", [str, type(None)])
+    app.add_config_value("drawio_optimize_svg", False, "", ENUM(True, False))
+    app.add_config_value("drawio_svg_precision", 2, "", [int, type(None)])
+    app.add_config_value("drawio_optimize_png", False, "", ENUM(True, False))
+    app.add_config_value("drawio_export_worker_max_jobs", 500, "", [int, type(None)])
+    app.add_config_value(
+        "drawio_export_worker_max_memory", 2 * 1024**3, "", [int, type(None)]
+    )
+    app.add_event("drawio-export-started")
+    app.add_event("drawio-export-finished")
+    app.add_env_collector(DrawIOCollector)
 
     # Add CSS file to the HTML static path for add_css_file
     app.connect("build-finished", on_build_finished)
     app.connect("config-inited", on_config_inited)
+    app.connect("builder-inited", on_builder_inited)
+    app.connect("env-updated", on_env_updated)
+    app.connect("env-get-outdated", on_env_get_outdated)
     app.add_css_file("drawio.css")
 
-    return {"version": __version__, "parallel_read_safe": True}
+    return {
+        "version": __version__,
+        "parallel_read_safe": True,
+        "parallel_write_safe": True,
+    }
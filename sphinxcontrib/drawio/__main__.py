@@ -0,0 +1,264 @@
+"""Export the draw.io diagrams of a Sphinx project without building it.
+
+The source tree is scanned for ``drawio-image`` and ``drawio-figure``
+directives, whose options are resolved against the project's ``conf.py``
+exactly as in a build. The diagrams are then exported into the same cache a
+build uses, so that the following ``sphinx-build`` with the same builder and
+doctree directory finds all of them up to date::
+
+    python -m sphinxcontrib.drawio -b html docs docs/_build/html
+
+Only reStructuredText sources are scanned, and only for directives written
+with their options on the lines directly following them. Diagrams the scan
+misses are exported by the build as usual.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+from docutils import nodes
+from docutils.nodes import image as docutils_image
+from sphinx.application import Sphinx
+from sphinx.util import logging
+from sphinx.util.docutils import docutils_namespace, new_document
+
+from . import (
+    DrawIOConverter,
+    DrawIOError,
+    DrawIOFigure,
+    DrawIOImage,
+    finish_exports,
+    try_lock,
+)
+from .xvfb import XvfbError
+
+logger = logging.getLogger(__name__)
+
+DIRECTIVE_RE = re.compile(r"^(?P<indent>\s*)\.\.\s+drawio-(?P<type>image|figure)::")
+OPTION_RE = re.compile(r"^\s+:(?P<name>[\w-]+):\s*(?P<value>.*?)\s*$")
+
+OPTION_SPECS = {"image": DrawIOImage.option_spec, "figure": DrawIOFigure.option_spec}
+
+
+def scan_directives(text: str) -> Iterator[Tuple[int, str, str, dict]]:
+    """Find the drawio directives of a reStructuredText document.
+
+    Yields the line number, directive type, argument and the raw options of
+    each directive.
+    """
+    lines = text.splitlines()
+    for lineno, line in enumerate(lines):
+        match = DIRECTIVE_RE.match(line)
+        if not match:
+            continue
+        argument = line[match.end() :].strip()
+        options = {}
+        for option_line in lines[lineno + 1 :]:
+            if not option_line.strip():
+                if argument:
+                    break
+                continue
+            option = OPTION_RE.match(option_line)
+            if option:
+                options[option.group("name")] = option.group("value")
+            elif not argument and len(option_line) - len(option_line.lstrip()) > len(
+                match.group("indent")
+            ):
+                # the argument is on the following line
+                argument = option_line.strip()
+            else:
+                break
+        if argument:
+            yield lineno + 1, match.group("type"), argument, options
+
+
+def collect_images(app: Sphinx) -> List[nodes.image]:
+    """Image nodes as the drawio directives of the project would create them."""
+    env = app.env
+    env.find_files(app.config, app.builder)
+
+    images = []
+    for docname in sorted(env.found_docs):
+        path = Path(env.doc2path(docname))
+        if path.suffix != ".rst":
+            continue
+        text = path.read_text(encoding=app.config.source_encoding)
+        for lineno, type, argument, raw_options in scan_directives(text):
+            location = (docname, lineno)
+            option_spec = OPTION_SPECS[type]
+            options = {}
+            for name, value in raw_options.items():
+                if name not in option_spec:
+                    continue
+                try:
+                    options[name] = option_spec[name](value or None)
+                except (ValueError, TypeError) as exc:
+                    logger.warning(
+                        f'invalid option value for "{name}": {exc}', location=location
+                    )
+            relpath, _ = env.relfn2path(argument, docname)
+            image = docutils_image(
+                "", uri=relpath, candidates={"*": relpath}, **options
+            )
+            image["classes"].append("drawio")
+            images.append(image)
+    return images
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m sphinxcontrib.drawio",
+        description="Export the draw.io diagrams of a Sphinx project "
+        "into the cache used by sphinx-build.",
+    )
+    parser.add_argument("sourcedir", help="path to the documentation source files")
+    parser.add_argument("outputdir", help="path to the output directory of the build")
+    parser.add_argument(
+        "-b", dest="builder", default="html", help="builder to export for"
+    )
+    parser.add_argument(
+        "-c", dest="confdir", help="directory containing conf.py (default: sourcedir)"
+    )
+    parser.add_argument(
+        "-d",
+        dest="doctreedir",
+        help="path of the build's doctree cache (default: outputdir/.doctrees)",
+    )
+    parser.add_argument(
+        "-j",
+        dest="jobs",
+        default="auto",
+        help="number of draw.io processes to run in parallel (default: auto)",
+    )
+    parser.add_argument(
+        "-D",
+        dest="define",
+        action="append",
+        default=[],
+        metavar="setting=value",
+        help="override a setting in conf.py",
+    )
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="only list the exports which are missing or out of date",
+    )
+    parser.add_argument(
+        "--gc",
+        action="store_true",
+        help="only remove the exports which are no longer used by the documents "
+        "of the last build, see drawio_gc_grace_period and drawio_gc_max_size",
+    )
+    parser.add_argument(
+        "--images",
+        metavar="FILE",
+        help="export the image nodes listed in this JSON file instead of those "
+        "found in the sources, see drawio_background_export",
+    )
+    parser.add_argument(
+        "--overrides",
+        metavar="FILE",
+        help="override the settings in conf.py with those of this JSON file, "
+        "before those of -D, see drawio_background_export",
+    )
+    parser.add_argument(
+        "--lock",
+        metavar="FILE",
+        help="hold a lock on this file while exporting, exporting nothing if "
+        "another process holds it, see drawio_background_export",
+    )
+    parser.add_argument(
+        "--lock-fd",
+        type=int,
+        metavar="FD",
+        help="the inherited file descriptor of a lock taken for this process, "
+        "which is closed once done, see drawio_background_export",
+    )
+    parser.add_argument(
+        "--touch",
+        metavar="FILE",
+        help="touch this file once done, e.g. for sphinx-autobuild to watch, "
+        "see drawio_background_export",
+    )
+    parser.add_argument("-q", dest="quiet", action="store_true", help="no output")
+    args = parser.parse_args(argv)
+
+    if args.jobs == "auto":
+        workers = os.cpu_count() or 1
+    else:
+        try:
+            workers = int(args.jobs)
+        except ValueError:
+            parser.error(f"-j: expected a number or 'auto', got {args.jobs!r}")
+        if workers < 1:
+            parser.error("-j: expected a positive number")
+
+    confoverrides = {}
+    if args.overrides:
+        with open(args.overrides) as fp:
+            confoverrides.update(json.load(fp))
+    for setting in args.define:
+        name, _, value = setting.partition("=")
+        confoverrides[name] = value
+
+    doctreedir = args.doctreedir or os.path.join(args.outputdir, ".doctrees")
+    status = None if args.quiet or args.dry_run else sys.stdout
+    with docutils_namespace(), ExitStack() as lock:
+        if args.lock_fd is not None:
+            lock.callback(os.close, args.lock_fd)
+        if args.lock and not lock.enter_context(try_lock(Path(args.lock))):
+            print("another export holds the lock, nothing exported", file=sys.stderr)
+            return 0
+        app = Sphinx(
+            args.sourcedir,
+            args.confdir or args.sourcedir,
+            args.outputdir,
+            doctreedir,
+            args.builder,
+            confoverrides,
+            status=status,
+            warning=sys.stderr,
+        )
+        document = new_document("")
+        document.settings.env = app.env
+        converter = DrawIOConverter(document)
+        if args.images:
+            with open(args.images) as fp:
+                images = [
+                    docutils_image("", **attributes) for attributes in json.load(fp)
+                ]
+        else:
+            images = collect_images(app)
+
+        try:
+            if args.dry_run:
+                for job in converter.pending_exports(images):
+                    print(
+                        f"{job.input_relpath} (page {job.page_index}) "
+                        f"-> {job.export_relpath}"
+                    )
+            elif not args.gc:
+                batch = app.config.drawio_batch_export
+                converter.export_pending(images, workers, batch)
+        except (DrawIOError, XvfbError) as exc:
+            logger.error(str(exc))
+            return 1
+        finally:
+            # the scanned or listed images may not be all of the project's,
+            # unused exports are only told from the build environment
+            finish_exports(app, gc=args.gc)
+            # the build the file triggers may start the next export
+            lock.close()
+            if args.touch:
+                Path(args.touch).touch()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,345 @@
+import http.client
+import json
+import os
+import re
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Iterable, Optional, Tuple
+from urllib.parse import urlsplit
+
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ExportCache:
+    """Interface of a store of draw.io exports, shared between builds.
+
+    Entries are identified by the export hash computed by the converter and
+    the output format. A cache must never raise for a missing or unreachable
+    entry, it reports a miss instead and the diagram is exported by draw.io.
+    Caches are configured with ``drawio_export_caches``, as they are part of
+    the configuration they must be picklable.
+    """
+
+    def exists(self, key: str, format: str) -> bool:
+        raise NotImplementedError
+
+    def get(self, key: str, format: str, destination: Path) -> bool:
+        """Place the entry at ``destination``, returning whether it existed."""
+        raise NotImplementedError
+
+    def put(self, key: str, format: str, source: Path) -> None:
+        raise NotImplementedError
+
+    def evict(self) -> None:
+        """Called at the end of the build, to trim the cache if needed."""
+
+
+class LocalExportCache(ExportCache):
+    """A content-addressed store of draw.io exports on the local file system.
+
+    Entries are stored as ``<directory>/<key[:2]>/<key>.<format>`` where the
+    key is the export hash computed by the converter. Entries are never
+    modified once written, so their modification time is used to record the
+    last access, and the least recently used entries are evicted once the
+    store grows past ``max_size`` bytes.
+
+    All operations are safe to run from several builds at the same time:
+    entries are written to a temporary file and renamed into place, and an
+    entry removed by a concurrent eviction is simply reported as missing.
+    """
+
+    def __init__(self, directory: Path, max_size: Optional[int] = None) -> None:
+        self.directory = Path(directory)
+        self.max_size = max_size
+
+    def _entry_path(self, key: str, format: str) -> Path:
+        return self.directory / key[:2] / f"{key}.{format}"
+
+    def exists(self, key: str, format: str) -> bool:
+        return self._entry_path(key, format).exists()
+
+    def get(self, key: str, format: str, destination: Path) -> bool:
+        entry = self._entry_path(key, format)
+        try:
+            os.utime(entry)
+            link_or_copy(entry, destination)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, key: str, format: str, source: Path) -> None:
+        entry = self._entry_path(key, format)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=str(entry.parent), suffix=".tmp")
+        os.close(fd)
+        try:
+            shutil.copyfile(str(source), tmp_path)
+            os.replace(tmp_path, str(entry))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def evict(self) -> None:
+        # Remove the least recently used entries until within ``max_size``
+        if self.max_size is None or not self.directory.exists():
+            return
+
+        entries = []
+        total_size = 0
+        for entry in self.directory.glob("*/*"):
+            if entry.suffix == ".tmp":
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+            total_size += stat.st_size
+
+        entries.sort()
+        for _, size, entry in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                entry.unlink()
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+class ConnectionPool:
+    """Keep-alive HTTP connections to a server, shared between threads.
+
+    At most ``max_connections`` requests are in flight at once, further ones
+    wait for a connection to be returned to the pool.
+    """
+
+    def __init__(self, url: str, max_connections: int = 8, timeout: float = 30):
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError(f"unsupported URL: {url}")
+        self.url = url
+        self.path = parts.path.rstrip("/")
+        self._connection_class = (
+            http.client.HTTPSConnection
+            if parts.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        self._netloc = parts.netloc
+        self._timeout = timeout
+        self._pool = queue.LifoQueue(maxsize=max_connections)
+        self._slots = threading.BoundedSemaphore(max_connections)
+
+    def request(self, method: str, path: str, body=None, headers=None):
+        """Perform a request, returning the response status and body."""
+        with self._slots:
+            try:
+                connection = self._pool.get_nowait()
+            except queue.Empty:
+                connection = self._connection_class(self._netloc, timeout=self._timeout)
+            try:
+                connection.request(method, path, body=body, headers=headers or {})
+                response = connection.getresponse()
+                content = response.read()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._pool.put_nowait(connection)
+            return response.status, content
+
+
+class HTTPExportCache(ExportCache):
+    """A remote store of draw.io exports, accessed through HTTP GET and PUT.
+
+    Entries are located at ``<url>/<key>.<format>``. Any server which stores
+    the body of a PUT request and serves it back on GET will do, e.g. nginx
+    with WebDAV enabled. Keep-alive connections are pooled, so that they can
+    be shared by the concurrent export workers.
+    """
+
+    def __init__(self, url: str, max_connections: int = 8, timeout: float = 30):
+        if urlsplit(url).scheme not in ("http", "https"):
+            raise ValueError(f"unsupported export cache URL: {url}")
+        self.url = url
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._connections = ConnectionPool(url, max_connections, timeout)
+        # once the server failed to answer, it is no longer asked
+        self._reachable = True
+        self._reachable_lock = threading.Lock()
+
+    def __getstate__(self):
+        # connections and locks can't be pickled, e.g. with the configuration
+        return self.url, self.max_connections, self.timeout
+
+    def __setstate__(self, state) -> None:
+        self.__init__(*state)
+
+    def _request(self, method: str, key: str, format: str, body=None, headers=None):
+        """Perform a request, returning the response status and body."""
+        path = f"{self._connections.path}/{key}.{format}"
+        return self._connections.request(method, path, body, headers)
+
+    def _unreachable(self, exc: Exception) -> None:
+        with self._reachable_lock:
+            if self._reachable:
+                self._reachable = False
+                logger.warning(
+                    f"drawio export cache {self.url} is unreachable, it is not "
+                    f"used for the rest of the build: {exc}"
+                )
+
+    def exists(self, key: str, format: str) -> bool:
+        if not self._reachable:
+            return False
+        try:
+            status, _ = self._request("HEAD", key, format)
+        except (OSError, http.client.HTTPException) as exc:
+            self._unreachable(exc)
+            return False
+        return status == 200
+
+    def get(self, key: str, format: str, destination: Path) -> bool:
+        if not self._reachable:
+            return False
+        try:
+            status, content = self._request("GET", key, format)
+        except (OSError, http.client.HTTPException) as exc:
+            self._unreachable(exc)
+            return False
+        if status != 200:
+            return False
+
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=str(destination.parent), suffix=".tmp")
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(content)
+        os.replace(tmp_path, str(destination))
+        return True
+
+    def put(self, key: str, format: str, source: Path) -> None:
+        if not self._reachable:
+            return
+        try:
+            with open(source, "rb") as fp:
+                headers = {"Content-Length": str(os.fstat(fp.fileno()).st_size)}
+                status, _ = self._request("PUT", key, format, fp, headers)
+        except (OSError, http.client.HTTPException) as exc:
+            self._unreachable(exc)
+            return
+        if status >= 300:
+            logger.warning(
+                f"drawio export cache {self.url} refused {key}.{format}: {status}"
+            )
+
+
+def link_or_copy(source: Path, destination: Path) -> None:
+    """Atomically place a hardlink to, or else a copy of, ``source``."""
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    # unique per process and thread, so concurrent builds never collide
+    tmp_path = destination.with_name(
+        f"{destination.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+    )
+    try:
+        os.link(str(source), str(tmp_path))
+    except OSError:
+        # e.g. the store is on another file system
+        shutil.copyfile(str(source), str(tmp_path))
+    os.replace(str(tmp_path), str(destination))
+
+
+EXPORT_KEY_RE = re.compile(r"^[0-9a-f]{40}$")
+
+
+def collect_garbage(
+    imagedir: Path,
+    referenced: Iterable[str],
+    grace_period: Optional[float],
+    max_size: Optional[int] = None,
+) -> Tuple[int, int]:
+    """Remove the exports of the build directory which are no longer used.
+
+    The time each export was last referenced by a build is kept in
+    ``usage.json`` in ``imagedir``. Exports which were not referenced within
+    ``grace_period`` seconds are removed, and then, while the exports take up
+    more than ``max_size`` bytes, the least recently used ones. The exports of
+    the keys in ``referenced``, those of the current build, are always kept.
+
+    Only the export directories are listed, and their files only measured
+    with ``max_size``, so the cost does not depend on the size of the project.
+    Returns the number of removed exports and the bytes they took up.
+    """
+    now = time.time()
+    usage_path = imagedir / "usage.json"
+    try:
+        usage = json.loads(usage_path.read_text())
+    except (OSError, ValueError):
+        usage = {}
+    referenced = set(referenced)
+    for key in referenced:
+        usage[key] = now
+
+    try:
+        keys = [name for name in os.listdir(imagedir) if EXPORT_KEY_RE.match(name)]
+    except FileNotFoundError:
+        return 0, 0
+    # exports which predate the usage records get the full grace period
+    usage = {key: usage.get(key, now) for key in keys}
+
+    sizes = {}
+    if max_size is not None:
+        sizes = {key: _export_size(imagedir / key) for key in keys}
+
+    garbage = set()
+    if grace_period is not None:
+        garbage.update(
+            key
+            for key in keys
+            if key not in referenced and now - usage[key] > grace_period
+        )
+    if max_size is not None:
+        total_size = sum(size for key, size in sizes.items() if key not in garbage)
+        for key in sorted(usage, key=usage.get):
+            if total_size <= max_size:
+                break
+            if key not in garbage and key not in referenced:
+                garbage.add(key)
+                total_size -= sizes[key]
+
+    removed = freed = 0
+    for key in garbage:
+        # moved out of the way first, so a concurrent build never sees a
+        # partially removed export
+        trash = imagedir / f"{key}.{os.getpid()}.trash"
+        try:
+            os.replace(str(imagedir / key), str(trash))
+        except OSError:
+            continue
+        if key not in sizes:
+            sizes[key] = _export_size(trash)
+        shutil.rmtree(str(trash), ignore_errors=True)
+        del usage[key]
+        removed += 1
+        freed += sizes[key]
+
+    tmp_path = usage_path.with_name(f"{usage_path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(json.dumps(usage, indent=1, sort_keys=True))
+    os.replace(str(tmp_path), str(usage_path))
+    return removed, freed
+
+
+def _export_size(directory: Path) -> int:
+    try:
+        with os.scandir(directory) as entries:
+            return sum(entry.stat().st_size for entry in entries)
+    except FileNotFoundError:
+        return 0
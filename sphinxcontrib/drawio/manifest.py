@@ -0,0 +1,126 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional, Set
+
+
+class ExportManifest:
+    """An index of the exports kept with the doctrees of a build.
+
+    The manifest maps the path of each export, relative to the doctree
+    directory, to the key, variant and source digest it was made for, its size
+    and the time draw.io took to render it. It is loaded once at the start of
+    a build, so that telling whether an export is up to date does not require
+    a single file system operation, and written back at the end.
+
+    Entries whose export directory has gone missing, e.g. as it was removed by
+    hand, are dropped when loading. Whether the export file itself is still
+    there is only checked once an entry is used, see :meth:`exists`.
+    """
+
+    FILENAME = "manifest.json"
+
+    def __init__(self, imagedir: Path) -> None:
+        self.imagedir = Path(imagedir)
+        self.path = self.imagedir / self.FILENAME
+        self.entries = self._load()
+        self._added: Dict[str, Dict[str, Any]] = {}
+        self._checked: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            entries = json.loads(self.path.read_text())
+            keys = set(os.listdir(self.imagedir))
+        except (OSError, ValueError):
+            return {}
+        return {
+            export: entry for export, entry in entries.items() if entry["key"] in keys
+        }
+
+    def __contains__(self, export: str) -> bool:
+        return export in self.entries
+
+    def exists(self, export: str) -> bool:
+        """Whether the export is in the manifest and its file is still there.
+
+        The file is only checked the first time an export is asked for, e.g. as
+        it was removed by hand or an interrupted copy left none. The entries of
+        missing exports are dropped.
+        """
+        with self._lock:
+            if export not in self.entries:
+                return False
+            if export in self._checked:
+                return True
+        # the exports are relative to the doctree directory
+        found = os.path.isfile(self.imagedir.parent / export)
+        with self._lock:
+            if found:
+                self._checked.add(export)
+            else:
+                self.entries.pop(export, None)
+                self._added.pop(export, None)
+        return found
+
+    def get(self, export: str) -> Optional[Dict[str, Any]]:
+        return self.entries.get(export)
+
+    def add(
+        self,
+        export: str,
+        key: str,
+        digest: str,
+        size: int,
+        render_time: Optional[float] = None,
+        variant: Optional[str] = None,
+    ) -> None:
+        entry = {
+            "key": key,
+            "digest": digest,
+            "size": size,
+            "render_time": render_time,
+            "variant": variant,
+            "created": time.time(),
+        }
+        with self._lock:
+            self.entries[export] = entry
+            self._added[export] = entry
+            self._checked.add(export)
+
+    def latest(self, variant: str) -> Optional[str]:
+        """The export of the given variant which was made last, if any.
+
+        Exports of the same variant were made from the same source file with
+        the same options, from other versions of its content.
+        """
+        with self._lock:
+            exports = [
+                (entry["created"], export)
+                for export, entry in self.entries.items()
+                if entry.get("variant") == variant
+            ]
+        return max(exports)[1] if exports else None
+
+    def flush(self) -> None:
+        """Atomically write the manifest, if it changed.
+
+        The manifest is read again first, so that the entries added by another
+        build sharing the doctree directory are kept.
+        """
+        with self._lock:
+            if not self._added:
+                return
+            entries = self._load()
+            entries.update(self._added)
+            self.entries = entries
+            self._added = {}
+
+        self.imagedir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(
+            f"{self.FILENAME}.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        tmp_path.write_text(json.dumps(entries, indent=1, sort_keys=True))
+        os.replace(str(tmp_path), str(self.path))
@@ -0,0 +1,282 @@
+import base64
+import io
+import struct
+import zlib
+from hashlib import sha1
+from pathlib import Path
+from typing import IO, List, NamedTuple, Optional, Union
+from urllib.parse import unquote
+from xml.etree import ElementTree as ET
+
+
+class DrawIOLayer(NamedTuple):
+    id: str
+    name: str
+
+
+class DrawIOPage(NamedTuple):
+    id: Optional[str]
+    name: Optional[str]
+    width: Optional[float]
+    height: Optional[float]
+    layers: List[DrawIOLayer]
+    #: Hash of the page's normalized ``<mxGraphModel>``, see :func:`_read_model`
+    digest: Optional[str] = None
+
+
+class DrawIOMetadata(NamedTuple):
+    """The page and layer structure of a draw.io file."""
+
+    digest: str
+    pages: List[DrawIOPage]
+
+    def page_index(self, name: str) -> Optional[int]:
+        for index, page in enumerate(self.pages):
+            if page.name == name:
+                return index
+        return None
+
+
+def decompress_diagram(text: str) -> str:
+    """Decode the body of a compressed ``<diagram>`` element.
+
+    draw.io compresses a page as URL-encoded XML, deflated without a zlib
+    header and base64 encoded.
+    """
+    data = zlib.decompress(base64.b64decode(text), -zlib.MAX_WBITS)
+    return unquote(data.decode("utf-8"))
+
+
+#: The suffixes of images which also hold the diagram they show, as saved by
+#: draw.io as an editable SVG or PNG image
+EMBEDDING_SUFFIXES = (".drawio.svg", ".drawio.png")
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def is_embedding_image(path: Union[str, Path]) -> bool:
+    return str(path).endswith(EMBEDDING_SUFFIXES)
+
+
+def read_embedded_diagram(path: Path) -> Optional[bytes]:
+    """Extract the ``<mxfile>`` embedded in an editable SVG or PNG image.
+
+    draw.io stores the diagram in the ``content`` attribute of the ``<svg>``
+    element, or in a text chunk with the ``mxfile`` keyword of the PNG image,
+    URL-encoded. Returns None if the image holds no diagram.
+    """
+    if str(path).endswith(".svg"):
+        for _, element in ET.iterparse(str(path), events=("start",)):
+            content = element.get("content")
+            break
+        else:
+            content = None
+        if content and not content.lstrip().startswith("<"):
+            # saved by older versions of draw.io
+            content = decompress_diagram(content)
+        return content.encode("utf-8") if content else None
+
+    with open(path, "rb") as fp:
+        if fp.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+            return None
+        while True:
+            header = fp.read(8)
+            if len(header) < 8:
+                return None
+            length, type = struct.unpack(">I4s", header)
+            if type == b"IDAT":
+                # text chunks which matter come before the image data
+                fp.seek(length + 4, io.SEEK_CUR)
+                continue
+            if type == b"IEND":
+                return None
+            data = fp.read(length)
+            fp.seek(4, io.SEEK_CUR)  # the CRC
+            keyword, _, text = data.partition(b"\0")
+            if keyword != b"mxfile":
+                continue
+            if type == b"zTXt":
+                text = zlib.decompress(text[1:])
+            elif type == b"iTXt":
+                # compression flag and method, language tag, translated keyword
+                compressed, text = text[0], text[2:]
+                text = text.split(b"\0", 2)[2]
+                if compressed:
+                    text = zlib.decompress(text)
+            elif type != b"tEXt":
+                continue
+            return unquote(text.decode("latin-1")).encode("utf-8")
+
+
+# Attributes which record the editor's view rather than the diagram itself
+VOLATILE_MODEL_ATTRIBUTES = {"dx", "dy"}
+
+
+def _float(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _read_model(source: Union[str, Path, IO[bytes]], pages: List[DrawIOPage]):
+    """Incrementally parse ``source``, appending its pages to ``pages``.
+
+    ``source`` is either a draw.io file or a single ``<mxGraphModel>``. Cells
+    are discarded as soon as they are parsed, so that embedded images never
+    accumulate in memory.
+
+    Each page is hashed from its ``<mxGraphModel>`` only, decompressed if need
+    be, with the attributes sorted and the view state left out. The page's
+    digest therefore does not change when another page is edited, when the
+    file is saved again (updating ``modified``, ``etag``, ``agent`` and
+    ``version`` on ``<mxfile>``) or when it is saved with(out) compression.
+    """
+    page = None
+    root_cell = None
+    hasher = None
+    # the elements enclosing the current one, to find the wrapper of a cell
+    stack = []
+    for event, element in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            stack.append(element)
+            if element.tag == "diagram":
+                page = DrawIOPage(
+                    element.get("id"), element.get("name"), None, None, []
+                )
+                root_cell = None
+            elif element.tag == "mxGraphModel":
+                if page is None:
+                    # an uncompressed single page file
+                    page = DrawIOPage(None, None, None, None, [])
+                page = page._replace(
+                    width=_float(element.get("pageWidth")),
+                    height=_float(element.get("pageHeight")),
+                )
+                hasher = sha1()
+            elif element.tag == "mxCell" and page is not None:
+                parent = element.get("parent")
+                # layers may be wrapped in an <object> holding their properties
+                wrapper = stack[-2] if len(stack) > 1 else None
+                if wrapper is not None and wrapper.tag in ("object", "UserObject"):
+                    cell_id = wrapper.get("id")
+                    label = wrapper.get("label", "")
+                else:
+                    cell_id = element.get("id")
+                    label = element.get("value", "")
+                if parent is None:
+                    if root_cell is None:
+                        root_cell = cell_id
+                elif parent == root_cell:
+                    page.layers.append(DrawIOLayer(cell_id, label))
+
+            if hasher is not None:
+                attributes = sorted(element.attrib.items())
+                if element.tag == "mxGraphModel":
+                    attributes = [
+                        (name, value)
+                        for name, value in attributes
+                        if name not in VOLATILE_MODEL_ATTRIBUTES
+                    ]
+                hasher.update(repr((element.tag, attributes)).encode())
+            continue
+
+        stack.pop()
+        if hasher is not None:
+            hasher.update(repr((element.text or "").strip()).encode())
+        if element.tag == "mxGraphModel":
+            page = page._replace(digest=hasher.hexdigest())
+            hasher = None
+            if not stack:
+                pages.append(page)
+        elif element.tag == "diagram":
+            text = (element.text or "").strip()
+            if page.digest is None and text:
+                compressed = []
+                _read_model(io.BytesIO(decompress_diagram(text).encode()), compressed)
+                if compressed:
+                    model = compressed[0]
+                    page = page._replace(
+                        width=model.width,
+                        height=model.height,
+                        layers=model.layers,
+                        digest=model.digest,
+                    )
+            pages.append(page)
+            page = None
+        element.clear()
+
+
+def extract_page(source: Union[str, IO[bytes]], index: int) -> Optional[bytes]:
+    """Make a draw.io file holding only the page at ``index`` of ``source``.
+
+    The attributes and any other children of ``<mxfile>`` are kept, so are
+    the page's own, and the page is decompressed. The other pages are dropped
+    as soon as they are parsed. Returns None if ``source`` has no such page.
+    """
+    root = None
+    selected = None
+    count = 0
+    depth = 0
+    for event, element in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = element
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1 and element.tag == "diagram":
+            if count == index:
+                selected = element
+            else:
+                root.remove(element)
+            count += 1
+    if root is None or root.tag != "mxfile" or selected is None:
+        return None
+
+    text = (selected.text or "").strip()
+    if len(selected) == 0 and text:
+        selected.text = None
+        selected.append(ET.fromstring(decompress_diagram(text)))
+    return ET.tostring(root, encoding="utf-8")
+
+
+def select_layers(content: bytes, layers: List[int]) -> bytes:
+    """Show only the layers at the given indexes of each page of ``content``.
+
+    This is what draw.io's ``--layers`` option does, for exports which don't
+    go through the draw.io command line. Compressed pages are left as they
+    are, see :func:`extract_page`.
+    """
+    root = ET.fromstring(content)
+    for model in root.iter("mxGraphModel"):
+        cells = model.find("root")
+        if cells is None:
+            continue
+        root_cell = None
+        index = 0
+        for element in cells:
+            # layers may be wrapped in an <object> holding their properties
+            cell = element if element.tag == "mxCell" else element.find("mxCell")
+            if cell is None:
+                continue
+            parent = cell.get("parent")
+            if parent is None:
+                if root_cell is None:
+                    root_cell = element.get("id")
+            elif parent == root_cell:
+                cell.set("visible", "1" if index in layers else "0")
+                index += 1
+    return ET.tostring(root, encoding="utf-8")
+
+
+def read_metadata(path: Path, digest: str) -> DrawIOMetadata:
+    """Read the page and layer structure of the draw.io file at ``path``."""
+    pages = []
+    if is_embedding_image(path):
+        content = read_embedded_diagram(path)
+        if content:
+            _read_model(io.BytesIO(content), pages)
+    else:
+        _read_model(str(path), pages)
+    return DrawIOMetadata(digest, pages)
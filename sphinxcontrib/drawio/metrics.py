@@ -0,0 +1,164 @@
+import json
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, NamedTuple, Sequence
+
+#: The phases of an export which are timed, in the order they happen
+PHASES = (
+    "resolve",
+    "cache",
+    "rasterize",
+    "native",
+    "drawio",
+    "server",
+    "worker",
+    "optimize",
+)
+
+#: The phases rendering a diagram, one of which an exported diagram went through
+RENDER_PHASES = ("native", "drawio", "server", "worker")
+
+#: What became of an export, an export nothing was done for is up to date
+OUTCOMES = (
+    "up-to-date",
+    "passthrough",
+    "deferred",
+    "cached",
+    "rasterized",
+    "exported",
+    "failed",
+)
+
+
+class Span(NamedTuple):
+    phase: str
+    exports: List[str]
+    start: float
+    end: float
+    thread: int
+
+
+class ExportMetrics:
+    """Timings and counters of the draw.io exports of a build.
+
+    Exports are identified by their path relative to the doctree directory.
+    For each of them, the time spent in every phase is summed up: resolving
+    the directive options (once per referencing node), looking up and storing
+    the export in the shared caches, rasterizing an SVG export, rendering the
+    diagram natively, running draw.io and waiting for the draw.io export
+    server or worker, and optimizing the export. A draw.io run exporting a
+    batch of diagrams is shared evenly between them.
+
+    All methods may be called from the export worker threads.
+    """
+
+    def __init__(self) -> None:
+        self.exports: Dict[str, Dict[str, Any]] = {}
+        self.spans: List[Span] = []
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def entry(self, job) -> Dict[str, Any]:
+        """The statistics of the export of ``job``."""
+        export = str(job.export_relpath)
+        with self._lock:
+            if export not in self.exports:
+                self.exports[export] = {
+                    "source": str(job.input_relpath),
+                    "key": job.key,
+                    "references": 0,
+                    **{phase: 0.0 for phase in PHASES},
+                    "bytes": 0,
+                }
+            return self.exports[export]
+
+    def move(self, job, other_job) -> None:
+        """Carry the statistics of ``job`` over to ``other_job``."""
+        with self._lock:
+            entry = self.exports.pop(str(job.export_relpath), None)
+            if entry is not None:
+                entry["key"] = other_job.key
+                self.exports[str(other_job.export_relpath)] = entry
+
+    def record(self, phase: str, jobs: Sequence, start: float) -> None:
+        """Account the time since ``start`` to the given phase of ``jobs``."""
+        end = time.perf_counter()
+        entries = [self.entry(job) for job in jobs]
+        with self._lock:
+            for entry in entries:
+                entry[phase] += (end - start) / len(entries)
+            self.spans.append(
+                Span(
+                    phase,
+                    [str(job.export_relpath) for job in jobs],
+                    start,
+                    end,
+                    threading.get_ident(),
+                )
+            )
+
+    @contextmanager
+    def span(self, phase: str, jobs: Sequence) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, jobs, start)
+
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            exports = [
+                {"export": export, "outcome": "up-to-date", **entry}
+                for export, entry in sorted(self.exports.items())
+            ]
+            spans = list(self.spans)
+
+        outcomes = Counter(entry["outcome"] for entry in exports)
+        totals = {
+            "exports": len(exports),
+            **{outcome: outcomes[outcome] for outcome in OUTCOMES},
+            "references": sum(entry["references"] for entry in exports),
+            **{phase: sum(entry[phase] for entry in exports) for phase in PHASES},
+            "bytes": sum(entry["bytes"] for entry in exports),
+            # from the first to the last timed phase, across all threads
+            "elapsed": (
+                max(span.end for span in spans) - min(span.start for span in spans)
+                if spans
+                else 0.0
+            ),
+        }
+        return {"totals": totals, "exports": exports}
+
+    def trace_events(self) -> Dict[str, Any]:
+        """The timed phases in the Chrome trace event format."""
+        with self._lock:
+            spans = list(self.spans)
+        pid = os.getpid()
+        return {
+            "traceEvents": [
+                {
+                    "name": span.phase,
+                    "cat": "drawio",
+                    "ph": "X",
+                    "ts": (span.start - self._origin) * 1e6,
+                    "dur": (span.end - span.start) * 1e6,
+                    "pid": pid,
+                    "tid": span.thread,
+                    "args": {"exports": span.exports},
+                }
+                for span in spans
+            ],
+            "displayTimeUnit": "ms",
+        }
+
+
+def write_json(path: Path, data: Any) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as fp:
+        json.dump(data, fp, indent=1)
+    os.replace(str(tmp_path), str(path))
@@ -0,0 +1,628 @@
+"""Render draw.io diagrams as SVG without draw.io.
+
+Only the most common parts of mxGraph are supported: rectangles, ellipses and
+rhombuses with plain text labels, and straight or orthogonal edges between
+them. Anything else, from HTML labels to shadows or custom shapes, raises
+:class:`UnsupportedDiagram`, so that the diagram is exported by draw.io rather
+than rendered wrongly.
+"""
+import html
+import math
+import re
+from typing import IO, Dict, Iterable, List, Optional, Tuple, Union
+from xml.etree import ElementTree as ET
+
+from .metadata import extract_page
+
+#: Part of the export key of rendered diagrams, in place of the draw.io version
+VERSION = "2"
+
+DEFAULT_FONT_SIZE = 12
+DEFAULT_FONT_FAMILY = "Helvetica"
+LINE_HEIGHT = 1.2
+LABEL_SPACING = 2
+# an estimate of the width of a character, relative to the font size
+CHARACTER_WIDTH = 0.6
+ARC_SIZE = 15
+ARROW_SIZE = 6
+
+VERTEX_SHAPES = {"rect", "ellipse", "rhombus", "text", "group"}
+ARROWS = {"none", "classic", "block", "open"}
+
+# Style keys which are rendered, or which don't change the rendering
+LABEL_STYLE = {
+    "fontColor",
+    "fontSize",
+    "fontFamily",
+    "fontStyle",
+    "align",
+    "verticalAlign",
+    "labelBackgroundColor",
+    "html",
+    "whiteSpace",
+}
+VERTEX_STYLE = LABEL_STYLE | {
+    "shape",
+    "rounded",
+    "arcSize",
+    "fillColor",
+    "strokeColor",
+    "strokeWidth",
+    "dashed",
+    "aspect",
+    "perimeter",
+    "points",
+    "resizable",
+    "connectable",
+    "container",
+    "autosize",
+}
+EDGE_STYLE = LABEL_STYLE | {
+    "edgeStyle",
+    "rounded",
+    "orthogonalLoop",
+    "jettySize",
+    "strokeColor",
+    "strokeWidth",
+    "dashed",
+    "endArrow",
+    "startArrow",
+    "endFill",
+    "startFill",
+    "exitX",
+    "exitY",
+    "exitDx",
+    "exitDy",
+    "entryX",
+    "entryY",
+    "entryDx",
+    "entryDy",
+}
+
+COLOR_RE = re.compile(r"#[0-9a-fA-F]{3}|#[0-9a-fA-F]{6}|[a-zA-Z]+")
+BREAK_RE = re.compile(r"<br\s*/?>", re.IGNORECASE)
+
+Point = Tuple[float, float]
+Box = Tuple[float, float, float, float]
+
+
+class UnsupportedDiagram(Exception):
+    """The diagram uses features the native renderer does not support."""
+
+
+def parse_style(style: str) -> Dict[str, str]:
+    """Parse a cell style, taking its leading name, if any, as the shape."""
+    parsed = {}
+    for index, item in enumerate(filter(None, style.split(";"))):
+        name, sep, value = item.partition("=")
+        if sep:
+            parsed[name] = value
+        elif index == 0:
+            parsed["shape"] = name
+        else:
+            raise UnsupportedDiagram(f"style {name!r}")
+    return parsed
+
+
+def read_model(source: Union[str, IO[bytes]], page_index: int) -> ET.Element:
+    """Read the ``<mxGraphModel>`` of the given page of a draw.io file."""
+    page = extract_page(source, page_index)
+    if page is not None:
+        model = ET.fromstring(page).find("diagram/mxGraphModel")
+    elif page_index == 0:
+        # a single uncompressed page, without <mxfile>
+        if not isinstance(source, str):
+            source.seek(0)
+        model = ET.parse(source).getroot()
+    else:
+        model = None
+    if model is None or model.tag != "mxGraphModel":
+        raise UnsupportedDiagram(f"no page {page_index}")
+    return model
+
+
+def _float(value: Optional[str], name: str, default: float = 0.0) -> float:
+    try:
+        return float(default if value is None else value)
+    except ValueError:
+        raise UnsupportedDiagram(f"{name}={value!r}")
+
+
+def _color(value: Optional[str], default: str) -> str:
+    if value in (None, "default"):
+        return default
+    if value == "none" or COLOR_RE.fullmatch(value):
+        return value
+    raise UnsupportedDiagram(f"color {value!r}")
+
+
+def _number(x: float) -> str:
+    return f"{x:.2f}".rstrip("0").rstrip(".")
+
+
+class Cell:
+    def __init__(self, element: ET.Element, wrapper: Optional[ET.Element]) -> None:
+        if wrapper is not None:
+            if wrapper.get("placeholders") == "1":
+                raise UnsupportedDiagram("placeholders")
+            self.id = wrapper.get("id")
+            self.value = wrapper.get("label", "")
+        else:
+            self.id = element.get("id")
+            self.value = element.get("value", "")
+        self.parent = element.get("parent")
+        self.source = element.get("source")
+        self.target = element.get("target")
+        self.vertex = element.get("vertex") == "1"
+        self.edge = element.get("edge") == "1"
+        self.visible = element.get("visible") != "0"
+        self.style = parse_style(element.get("style", ""))
+        self.geometry = element.find("mxGeometry")
+
+    def get(self, name: str, default: float = 0.0) -> float:
+        """A number of the cell's geometry."""
+        if self.geometry is None:
+            return default
+        return _float(self.geometry.get(name), name, default)
+
+    def style_float(self, name: str, default: float) -> float:
+        return _float(self.style.get(name), name, default)
+
+
+class Renderer:
+    """Render the cells of an ``<mxGraphModel>`` as SVG.
+
+    ``layers`` are the indexes of the layers to render, by default all of the
+    visible ones.
+    """
+
+    def __init__(
+        self, model: ET.Element, layers: Optional[Iterable[int]] = None
+    ) -> None:
+        self.background = model.get("background")
+        self.cells: List[Cell] = list(self._read_cells(model))
+        self.by_id = {cell.id: cell for cell in self.cells}
+
+        roots = [cell for cell in self.cells if cell.parent is None]
+        if len(roots) != 1:
+            raise UnsupportedDiagram("no single root cell")
+        all_layers = [cell for cell in self.cells if cell.parent == roots[0].id]
+        if layers is None:
+            self.layers = {layer.id for layer in all_layers if layer.visible}
+        else:
+            try:
+                self.layers = {all_layers[index].id for index in layers}
+            except IndexError:
+                raise UnsupportedDiagram("no such layer")
+        self.bounds: Optional[Box] = None
+
+    @staticmethod
+    def _read_cells(model: ET.Element) -> Iterable[Cell]:
+        root = model.find("root")
+        for child in root if root is not None else []:
+            if child.tag == "mxCell":
+                yield Cell(child, None)
+            elif child.tag in ("object", "UserObject"):
+                cell = child.find("mxCell")
+                if cell is None:
+                    raise UnsupportedDiagram(f"empty <{child.tag}>")
+                yield Cell(cell, child)
+            else:
+                raise UnsupportedDiagram(f"<{child.tag}>")
+
+    def _ancestors(self, cell: Cell) -> List[Cell]:
+        """The parents of ``cell``, up to the root cell."""
+        ancestors = []
+        while cell.parent is not None:
+            cell = self.by_id.get(cell.parent)
+            if cell is None or len(ancestors) > len(self.cells):
+                raise UnsupportedDiagram("broken cell hierarchy")
+            ancestors.append(cell)
+        return ancestors
+
+    def _origin(self, cell: Cell) -> Point:
+        """The position of the coordinate system of ``cell``, i.e. its group."""
+        x = y = 0.0
+        for ancestor in self._ancestors(cell):
+            if ancestor.edge:
+                raise UnsupportedDiagram("edge label cell")
+            if ancestor.vertex:
+                x += ancestor.get("x")
+                y += ancestor.get("y")
+        return x, y
+
+    def _box(self, cell: Cell) -> Box:
+        if cell.geometry is None or cell.geometry.get("relative") == "1":
+            raise UnsupportedDiagram("relative vertex geometry")
+        x, y = self._origin(cell)
+        return (
+            x + cell.get("x"),
+            y + cell.get("y"),
+            cell.get("width"),
+            cell.get("height"),
+        )
+
+    def _extend(self, *points: Point) -> None:
+        for x, y in points:
+            if self.bounds is None:
+                self.bounds = (x, y, x, y)
+            else:
+                x0, y0, x1, y1 = self.bounds
+                self.bounds = (min(x0, x), min(y0, y), max(x1, x), max(y1, y))
+
+    def render(self, scale: float = 1.0, transparent: bool = True) -> str:
+        elements = []
+        for cell in self.cells:
+            if not cell.visible or not (cell.vertex or cell.edge):
+                continue
+            ancestors = self._ancestors(cell)
+            if len(ancestors) < 2 or ancestors[-2].id not in self.layers:
+                continue
+            if cell.vertex:
+                elements.extend(self._vertex(cell))
+            else:
+                elements.extend(self._edge(cell))
+
+        # cropped to the diagram, leaving room for the strokes on the border
+        x0, y0, x1, y1 = self.bounds or (0, 0, 0, 0)
+        x0, y0, x1, y1 = x0 - 1, y0 - 1, x1 + 1, y1 + 1
+        if not transparent:
+            # the page background of the diagram, as draw.io fills it
+            fill = _color(self.background, "#ffffff")
+            if fill == "none":
+                fill = "#ffffff"
+            elements.insert(
+                0,
+                f'<rect x="{_number(x0)}" y="{_number(y0)}" '
+                f'width="{_number(x1 - x0)}" height="{_number(y1 - y0)}" '
+                f'fill="{fill}"/>',
+            )
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<svg xmlns="http://www.w3.org/2000/svg" version="1.1" '
+            f'width="{_number((x1 - x0) * scale)}px" '
+            f'height="{_number((y1 - y0) * scale)}px" '
+            f'viewBox="{_number(x0)} {_number(y0)} '
+            f'{_number(x1 - x0)} {_number(y1 - y0)}">'
+            f"<g>{''.join(elements)}</g></svg>\n"
+        )
+
+    def _check_style(self, cell: Cell, supported: set) -> None:
+        unsupported = set(cell.style) - supported
+        if unsupported:
+            raise UnsupportedDiagram(f"style {', '.join(sorted(unsupported))}")
+
+    def _stroke(self, cell: Cell) -> str:
+        stroke = _color(cell.style.get("strokeColor"), "#000000")
+        width = cell.style_float("strokeWidth", 1)
+        attributes = f'stroke="{stroke}" stroke-width="{_number(width)}"'
+        if cell.style.get("dashed") == "1":
+            attributes += ' stroke-dasharray="3 3"'
+        return attributes
+
+    def _vertex(self, cell: Cell) -> List[str]:
+        self._check_style(cell, VERTEX_STYLE)
+        shape = cell.style.get("shape", "rect")
+        if shape not in VERTEX_SHAPES:
+            raise UnsupportedDiagram(f"shape {shape!r}")
+        x, y, w, h = box = self._box(cell)
+        self._extend((x, y), (x + w, y + h))
+
+        elements = []
+        if shape not in ("text", "group"):
+            fill = _color(cell.style.get("fillColor"), "#ffffff")
+            paint = f'fill="{fill}" {self._stroke(cell)}'
+            if shape == "ellipse":
+                elements.append(
+                    f'<ellipse cx="{_number(x + w / 2)}" cy="{_number(y + h / 2)}" '
+                    f'rx="{_number(w / 2)}" ry="{_number(h / 2)}" {paint}/>'
+                )
+            elif shape == "rhombus":
+                corners = [
+                    (x + w / 2, y),
+                    (x + w, y + h / 2),
+                    (x + w / 2, y + h),
+                    (x, y + h / 2),
+                ]
+                elements.append(f'<path d="{_path(corners, close=True)}" {paint}/>')
+            else:
+                rounding = ""
+                if cell.style.get("rounded") == "1":
+                    arc_size = cell.style_float("arcSize", ARC_SIZE)
+                    radius = _number(min(w, h) * arc_size / 100)
+                    rounding = f' rx="{radius}" ry="{radius}"'
+                elements.append(
+                    f'<rect x="{_number(x)}" y="{_number(y)}" width="{_number(w)}" '
+                    f'height="{_number(h)}"{rounding} {paint}/>'
+                )
+        elements.extend(self._label(cell, box))
+        return elements
+
+    def _label(self, cell: Cell, box: Box) -> List[str]:
+        text = cell.value
+        if not text:
+            return []
+        if cell.style.get("html") == "1":
+            text = BREAK_RE.sub("\n", text)
+            if "<" in text:
+                raise UnsupportedDiagram("HTML label")
+            text = html.unescape(text)
+        lines = text.split("\n")
+
+        size = cell.style_float("fontSize", DEFAULT_FONT_SIZE)
+        font_style = int(cell.style_float("fontStyle", 0))
+        family = cell.style.get("fontFamily", DEFAULT_FONT_FAMILY)
+        color = _color(cell.style.get("fontColor"), "#000000")
+        background = _color(cell.style.get("labelBackgroundColor"), "none")
+        align = cell.style.get("align", "center")
+        valign = cell.style.get("verticalAlign", "middle")
+        if align not in ("left", "center", "right"):
+            raise UnsupportedDiagram(f"align={align!r}")
+        if valign not in ("top", "middle", "bottom"):
+            raise UnsupportedDiagram(f"verticalAlign={valign!r}")
+
+        x, y, w, h = box
+        anchor, tx = {
+            "left": ("start", x + LABEL_SPACING),
+            "center": ("middle", x + w / 2),
+            "right": ("end", x + w - LABEL_SPACING),
+        }[align]
+        height = size * LINE_HEIGHT * len(lines)
+        top = {
+            "top": y + LABEL_SPACING,
+            "middle": y + (h - height) / 2,
+            "bottom": y + h - LABEL_SPACING - height,
+        }[valign]
+        width = max(len(line) for line in lines) * size * CHARACTER_WIDTH
+        if cell.style.get("whiteSpace") == "wrap" and width > w - 2 * LABEL_SPACING:
+            # text isn't measured, so where draw.io breaks the lines is unknown
+            raise UnsupportedDiagram("wrapped label")
+        left = {"start": tx, "middle": tx - width / 2, "end": tx - width}[anchor]
+        self._extend((left, top), (left + width, top + height))
+
+        elements = []
+        if background != "none":
+            elements.append(
+                f'<rect x="{_number(left)}" y="{_number(top)}" '
+                f'width="{_number(width)}" height="{_number(height)}" '
+                f'fill="{background}"/>'
+            )
+        attributes = (
+            f'font-family="{html.escape(family)}" font-size="{_number(size)}px" '
+            f'fill="{color}" text-anchor="{anchor}"'
+        )
+        if font_style & 1:
+            attributes += ' font-weight="bold"'
+        if font_style & 2:
+            attributes += ' font-style="italic"'
+        if font_style & 4:
+            attributes += ' text-decoration="underline"'
+        spans = "".join(
+            f'<tspan x="{_number(tx)}" '
+            f'y="{_number(top + size * (LINE_HEIGHT * index + 1))}">'
+            f"{html.escape(line, quote=False)}</tspan>"
+            for index, line in enumerate(lines)
+        )
+        elements.append(f"<text {attributes}>{spans}</text>")
+        return elements
+
+    def _terminal(self, cell_id: Optional[str]) -> Optional[Cell]:
+        if cell_id is None:
+            return None
+        terminal = self.by_id.get(cell_id)
+        if terminal is None or not terminal.vertex:
+            raise UnsupportedDiagram("edge not connected to a vertex")
+        return terminal
+
+    def _port(self, cell: Cell, kind: str, terminal: Optional[Cell]):
+        """The fixed point the edge connects to on ``terminal``, if any."""
+        if terminal is None or f"{kind}X" not in cell.style:
+            return None
+        x, y, w, h = self._box(terminal)
+        return (
+            x + cell.style_float(f"{kind}X", 0) * w + cell.style_float(f"{kind}Dx", 0),
+            y + cell.style_float(f"{kind}Y", 0) * h + cell.style_float(f"{kind}Dy", 0),
+        )
+
+    def _edge(self, cell: Cell) -> List[str]:
+        self._check_style(cell, EDGE_STYLE)
+        edge_style = cell.style.get("edgeStyle", "none")
+        if edge_style not in ("none", "orthogonalEdgeStyle"):
+            raise UnsupportedDiagram(f"edgeStyle={edge_style!r}")
+
+        ox, oy = self._origin(cell)
+        waypoints = []
+        loose = {}
+        if cell.geometry is not None:
+            for point in cell.geometry.findall("Array[@as='points']/mxPoint"):
+                waypoints.append(
+                    (ox + _float(point.get("x"), "x"), oy + _float(point.get("y"), "y"))
+                )
+            for point in cell.geometry.findall("mxPoint"):
+                loose[point.get("as")] = (
+                    ox + _float(point.get("x"), "x"),
+                    oy + _float(point.get("y"), "y"),
+                )
+
+        source = self._terminal(cell.source)
+        target = self._terminal(cell.target)
+        start = self._port(cell, "exit", source)
+        end = self._port(cell, "entry", target)
+        if source is None:
+            start = loose.get("sourcePoint")
+        if target is None:
+            end = loose.get("targetPoint")
+        if (source is None and start is None) or (target is None and end is None):
+            raise UnsupportedDiagram("dangling edge")
+
+        if edge_style == "orthogonalEdgeStyle":
+            points = self._orthogonal(source, target, start, end, waypoints)
+        else:
+            points = self._straight(source, target, start, end, waypoints)
+        self._extend(*points)
+
+        stroke = _color(cell.style.get("strokeColor"), "#000000")
+        elements = [f'<path d="{_path(points)}" fill="none" {self._stroke(cell)}/>']
+        for position, default, base, tip in (
+            ("start", "none", points[1], points[0]),
+            ("end", "classic", points[-2], points[-1]),
+        ):
+            arrow = cell.style.get(f"{position}Arrow", default)
+            if arrow not in ARROWS:
+                raise UnsupportedDiagram(f"{position}Arrow={arrow!r}")
+            if arrow != "none":
+                filled = arrow != "open" and cell.style.get(f"{position}Fill") != "0"
+                elements.append(_arrow(base, tip, filled, stroke))
+
+        if cell.value:
+            elements.extend(self._label(cell, (*_middle(points), 0, 0)))
+        return elements
+
+    def _straight(self, source, target, start, end, waypoints) -> List[Point]:
+        if start is None:
+            towards = waypoints[0] if waypoints else end or _center(self._box(target))
+            start = self._perimeter(source, towards)
+        if end is None:
+            end = self._perimeter(target, waypoints[-1] if waypoints else start)
+        return [start, *waypoints, end]
+
+    def _perimeter(self, terminal: Cell, towards: Point) -> Point:
+        """Where the line from the center of ``terminal`` to ``towards`` leaves it."""
+        box = self._box(terminal)
+        cx, cy = _center(box)
+        dx, dy = towards[0] - cx, towards[1] - cy
+        if not dx and not dy:
+            return cx, cy
+        rx, ry = box[2] / 2 or 1, box[3] / 2 or 1
+        shape = terminal.style.get("shape", "rect")
+        if shape == "ellipse":
+            t = 1 / math.hypot(dx / rx, dy / ry)
+        elif shape == "rhombus":
+            t = 1 / (abs(dx) / rx + abs(dy) / ry)
+        else:
+            t = min(rx / abs(dx) if dx else math.inf, ry / abs(dy) if dy else math.inf)
+        t = min(t, 1)
+        return cx + dx * t, cy + dy * t
+
+    def _orthogonal(self, source, target, start, end, waypoints) -> List[Point]:
+        if not waypoints and start is None and end is None:
+            return _connect(self._box(source), self._box(target))
+        if start is None:
+            start = _side(self._box(source), waypoints[0] if waypoints else end)
+        if end is None:
+            end = _side(self._box(target), waypoints[-1] if waypoints else start)
+
+        # leave the source horizontally from its left or right side
+        horizontal = True
+        if source is not None:
+            x, _, w, _ = self._box(source)
+            horizontal = start[0] in (x, x + w)
+        points = [start]
+        for point in [*waypoints, end]:
+            last = points[-1]
+            if last[0] != point[0] and last[1] != point[1]:
+                if horizontal:
+                    points.append((point[0], last[1]))
+                else:
+                    points.append((last[0], point[1]))
+            else:
+                # turn at the next point
+                horizontal = last[0] == point[0]
+            points.append(point)
+        return points
+
+
+def _center(box: Box) -> Point:
+    x, y, w, h = box
+    return x + w / 2, y + h / 2
+
+
+def _distance(a: Point, b: Point) -> float:
+    return math.hypot(b[0] - a[0], b[1] - a[1])
+
+
+def _middle(points: List[Point]) -> Point:
+    """The point halfway along the line through ``points``."""
+    segments = list(zip(points, points[1:]))
+    remaining = sum(_distance(a, b) for a, b in segments) / 2
+    for a, b in segments:
+        length = _distance(a, b)
+        if length and remaining <= length:
+            t = remaining / length
+            return a[0] + (b[0] - a[0]) * t, a[1] + (b[1] - a[1]) * t
+        remaining -= length
+    return points[-1]
+
+
+def _side(box: Box, towards: Point) -> Point:
+    """The point of a side of ``box`` facing ``towards``, in line with it if
+    possible, else the middle of the side."""
+    x, y, w, h = box
+    cx, cy = _center(box)
+    px, py = towards
+    if x <= px <= x + w:
+        return px, (y if py < cy else y + h)
+    if y <= py <= y + h:
+        return (x if px < cx else x + w), py
+    if abs(px - cx) * h >= abs(py - cy) * w:
+        return (x if px < cx else x + w), cy
+    return cx, (y if py < cy else y + h)
+
+
+def _connect(source: Box, target: Box) -> List[Point]:
+    """An orthogonal route between the facing sides of two boxes."""
+    sx, sy, sw, sh = source
+    tx, ty, tw, th = target
+    (scx, scy), (tcx, tcy) = _center(source), _center(target)
+    if sx + sw <= tx or tx + tw <= sx:
+        # side by side, leave and enter horizontally
+        start = (sx + sw if tcx > scx else sx, scy)
+        end = (tx if tcx > scx else tx + tw, tcy)
+        if start[1] == end[1]:
+            return [start, end]
+        middle = (start[0] + end[0]) / 2
+        return [start, (middle, start[1]), (middle, end[1]), end]
+    start = (scx, sy + sh if tcy > scy else sy)
+    end = (tcx, ty if tcy > scy else ty + th)
+    if start[0] == end[0]:
+        return [start, end]
+    middle = (start[1] + end[1]) / 2
+    return [start, (start[0], middle), (end[0], middle), end]
+
+
+def _path(points: List[Point], close: bool = False) -> str:
+    path = " ".join(
+        f"{'L' if index else 'M'} {_number(x)} {_number(y)}"
+        for index, (x, y) in enumerate(points)
+    )
+    return path + " Z" if close else path
+
+
+def _arrow(base: Point, tip: Point, filled: bool, color: str) -> str:
+    length = _distance(base, tip)
+    if not length:
+        return ""
+    ux, uy = (tip[0] - base[0]) / length, (tip[1] - base[1]) / length
+    back = (tip[0] - ux * ARROW_SIZE * 1.5, tip[1] - uy * ARROW_SIZE * 1.5)
+    left = (back[0] - uy * ARROW_SIZE / 2, back[1] + ux * ARROW_SIZE / 2)
+    right = (back[0] + uy * ARROW_SIZE / 2, back[1] - ux * ARROW_SIZE / 2)
+    if filled:
+        return f'<path d="{_path([left, tip, right], close=True)}" fill="{color}"/>'
+    return f'<path d="{_path([left, tip, right])}" fill="none" stroke="{color}"/>'
+
+
+def render_svg(
+    source: Union[str, IO[bytes]],
+    page_index: int = 0,
+    layers: Optional[Iterable[int]] = None,
+    scale: float = 1.0,
+    transparent: bool = True,
+) -> str:
+    """Render a page of the draw.io file ``source`` as SVG.
+
+    Unless ``transparent``, the page background is filled, white by default.
+    Raises :class:`UnsupportedDiagram` if the page can't be rendered
+    faithfully.
+    """
+    model = read_model(source, page_index)
+    return Renderer(model, layers).render(scale, transparent)
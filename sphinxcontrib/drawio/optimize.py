@@ -0,0 +1,171 @@
+"""Shrink the SVG and PNG images exported by draw.io.
+
+Both optimizations are lossless as far as the rendered image goes: SVG
+exports lose what only draw.io reads (the embedded diagram, comments) and the
+precision of their coordinates beyond what a screen shows, PNG exports have
+their image data deflated again at the highest compression level.
+"""
+
+import re
+import struct
+import zlib
+from pathlib import Path
+from typing import Dict, Optional
+from xml.etree import ElementTree as ET
+
+#: Part of the export key of optimized SVG images, changed along with their
+#: output
+SVG_VERSION = "2"
+
+SVG_NS = "http://www.w3.org/2000/svg"
+XLINK_NS = "http://www.w3.org/1999/xlink"
+
+#: The prefixes of the namespaces in exports, rather than the ns0: ElementTree
+#: would make up
+NAMESPACES = {SVG_NS: "", XLINK_NS: "xlink"}
+
+NUMBER_RE = re.compile(r"-?\d*\.\d+(?:[eE][-+]?\d+)?")
+#: Attributes whose values are no coordinates, even where they look like ones
+NON_NUMERIC_ATTRIBUTES = {"id", "class", "href", f"{{{XLINK_NS}}}href", "version"}
+REFERENCE_RE = re.compile(r"url\(#([^)]+)\)")
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def _round(match: "re.Match", precision: int) -> str:
+    number = f"{float(match.group()):.{precision}f}".rstrip("0").rstrip(".")
+    return "0" if number in ("", "-0") else number
+
+
+def _dedupe_defs(root: ET.Element) -> None:
+    """Drop definitions identical but for their id, pointing to the first."""
+    seen: Dict[bytes, str] = {}
+    aliases: Dict[str, str] = {}
+    for defs in root.iter(f"{{{SVG_NS}}}defs"):
+        for definition in list(defs):
+            definition_id = definition.get("id")
+            if definition_id is None:
+                continue
+            del definition.attrib["id"]
+            signature = ET.tostring(definition)
+            definition.set("id", definition_id)
+            if signature in seen:
+                aliases[definition_id] = seen[signature]
+                defs.remove(definition)
+            else:
+                seen[signature] = definition_id
+    if not aliases:
+        return
+
+    def alias(match: "re.Match") -> str:
+        return f"url(#{aliases.get(match.group(1), match.group(1))})"
+
+    for element in root.iter():
+        for name, value in element.attrib.items():
+            if name in ("href", f"{{{XLINK_NS}}}href") and value[1:] in aliases:
+                element.set(name, f"#{aliases[value[1:]]}")
+            elif "url(#" in value:
+                element.set(name, REFERENCE_RE.sub(alias, value))
+
+
+def _prefixed(root: ET.Element) -> None:
+    """Spell the names in :data:`NAMESPACES` with their prefixes.
+
+    The namespaces are declared on the root, other ones are left for
+    ElementTree to serialize. Unlike :func:`ET.register_namespace`, this
+    leaves the prefixes used elsewhere in the process alone.
+    """
+    used = set()
+
+    def prefixed(name: str) -> str:
+        uri, brace, local = name[1:].partition("}")
+        if not name.startswith("{") or not brace or uri not in NAMESPACES:
+            return name
+        used.add(uri)
+        return f"{NAMESPACES[uri]}:{local}" if NAMESPACES[uri] else local
+
+    for element in root.iter():
+        if isinstance(element.tag, str):
+            element.tag = prefixed(element.tag)
+        element.attrib = {prefixed(name): value for name, value in element.items()}
+    declarations = {
+        f"xmlns:{prefix}" if prefix else "xmlns": uri
+        for uri, prefix in NAMESPACES.items()
+        if uri in used
+    }
+    root.attrib = {**declarations, **root.attrib}
+
+
+def optimize_svg(source: Path, destination: Path, precision: Optional[int]) -> None:
+    """Minify the SVG image at ``source``, writing it to ``destination``.
+
+    The diagram draw.io embeds in the ``content`` attribute is dropped, so are
+    comments and the document type, and so are duplicate definitions. Unless
+    ``precision`` is None, the numbers in attributes are rounded to as many
+    decimals; text is left as it is.
+    """
+    root = ET.parse(str(source)).getroot()
+    root.attrib.pop("content", None)
+    _dedupe_defs(root)
+    if precision is not None:
+
+        def rounded(match: "re.Match") -> str:
+            number = _round(match, precision)
+            # In compact lists such as "1.5.5" the next number follows without
+            # a separator, which either rounded number may no longer provide.
+            if match.string.startswith(".", match.end()):
+                number += " "
+            return number
+
+        for element in root.iter():
+            for name, value in element.attrib.items():
+                if name not in NON_NUMERIC_ATTRIBUTES and "." in value:
+                    element.set(name, NUMBER_RE.sub(rounded, value))
+    _prefixed(root)
+    svg = ET.tostring(root, encoding="unicode")
+    # ">" is escaped everywhere else, so this only matches empty elements
+    destination.write_text(svg.replace(" />", "/>"), encoding="utf-8")
+
+
+def _chunk(type: bytes, data: bytes) -> bytes:
+    crc = zlib.crc32(data, zlib.crc32(type))
+    return struct.pack(">I", len(data)) + type + data + struct.pack(">I", crc)
+
+
+def optimize_png(source: Path, destination: Path) -> bool:
+    """Deflate the image data of the PNG image at ``source`` again.
+
+    The pixels and every other chunk are kept as they are. Returns False,
+    writing nothing, if that would not make the image any smaller.
+    """
+    data = source.read_bytes()
+    if not data.startswith(PNG_SIGNATURE):
+        return False
+    chunks = []
+    image_data = []
+    offset = len(PNG_SIGNATURE)
+    while offset + 8 <= len(data):
+        length, type = struct.unpack(">I4s", data[offset : offset + 8])
+        chunk = data[offset : offset + 12 + length]
+        if type == b"IDAT":
+            if not image_data:
+                chunks.append(None)  # where the image data goes
+            image_data.append(data[offset + 8 : offset + 8 + length])
+        else:
+            chunks.append(chunk)
+        offset += 12 + length
+    if not image_data:
+        return False
+
+    compressed = b"".join(image_data)
+    recompressed = zlib.compress(zlib.decompress(compressed), 9)
+    if len(recompressed) >= len(compressed):
+        return False
+    destination.write_bytes(
+        PNG_SIGNATURE
+        + b"".join(
+            _chunk(b"IDAT", recompressed) if chunk is None else chunk
+            for chunk in chunks
+        )
+    )
+    return True
@@ -0,0 +1,71 @@
+import io
+import re
+from pathlib import Path
+from typing import Optional
+from xml.etree import ElementTree as ET
+
+try:
+    import cairosvg
+except (ImportError, OSError):  # OSError: cairo itself is missing
+    cairosvg = None
+
+# Elements draw.io uses for HTML labels and the like, which a plain SVG
+# renderer either ignores or replaces by a "not supported" placeholder
+UNSUPPORTED_ELEMENTS = {"foreignObject"}
+
+BACKGROUND_RE = re.compile(r"background(?:-color)?\s*:\s*([^;]+)")
+
+
+def is_available() -> bool:
+    return cairosvg is not None
+
+
+def version() -> str:
+    """What identifies the rasterizer in the key of the exports it makes."""
+    return f"cairosvg {cairosvg.__version__}"
+
+
+def svg_background(svg_path: Path) -> Optional[str]:
+    """The background color draw.io gave the ``<svg>`` element, if any.
+
+    Returns None if the SVG can't be rasterized faithfully.
+    """
+    background = ""
+    for event, element in ET.iterparse(str(svg_path), events=("start",)):
+        tag = element.tag.rpartition("}")[2]
+        if tag in UNSUPPORTED_ELEMENTS:
+            return None
+        if tag == "svg" and not background:
+            match = BACKGROUND_RE.search(element.get("style", ""))
+            background = match.group(1).strip() if match else "none"
+    return background
+
+
+def rasterize_svg(
+    svg_path: Path, output_path: Path, format: str, transparent: bool
+) -> bool:
+    """Render the SVG exported by draw.io as a PNG or JPEG image.
+
+    The image has the size of the SVG, which draw.io already scaled, on the
+    diagram's background or, unless ``transparent``, on white as draw.io's own
+    PNG exports. Returns False if the SVG uses features the rasterizer does
+    not support, in which case nothing is written.
+    """
+    background = svg_background(svg_path)
+    if background is None:
+        return False
+    if transparent and format == "png":
+        background = None
+    elif background in ("none", "transparent"):
+        background = "white"
+
+    png = cairosvg.svg2png(url=str(svg_path), background_color=background)
+    if format == "png":
+        output_path.write_bytes(png)
+    else:
+        # cairosvg depends on Pillow
+        from PIL import Image
+
+        with Image.open(io.BytesIO(png)) as image:
+            image.convert("RGB").save(str(output_path), "JPEG", quality=90)
+    return True
@@ -0,0 +1,72 @@
+"""Exports through a long-running draw.io export server.
+
+The server is the ``jgraph/export-server`` (draw-image-export2) container or
+anything speaking its protocol: the diagram XML and the export options are
+POSTed as a form, the response body is the exported image. Unlike the draw.io
+desktop app, the server is started once and keeps its browser warm, so an
+export costs a round trip rather than an Electron launch.
+"""
+from typing import Optional
+from urllib.parse import urlencode
+
+from .cache import ConnectionPool
+
+
+class ExportServerError(Exception):
+    """The server answered with an error status."""
+
+    def __init__(self, status: int, body: bytes) -> None:
+        super().__init__(f"HTTP {status}")
+        self.status = status
+        self.body = body
+
+
+class ExportServer:
+    """A client of the export server at ``url``.
+
+    Connections are kept alive and shared between the export workers, at
+    most ``max_connections`` requests are sent at once.
+    """
+
+    def __init__(
+        self, url: str, max_connections: int = 8, timeout: Optional[float] = 300
+    ):
+        self.url = url
+        self._connections = ConnectionPool(url, max_connections, timeout)
+
+    def export(
+        self,
+        xml: bytes,
+        format: str,
+        page_index: int = 0,
+        scale: float = 1.0,
+        transparent: bool = False,
+        width: Optional[int] = None,
+        height: Optional[int] = None,
+    ) -> bytes:
+        """Export a page of the diagram ``xml``, returning the image.
+
+        Raises :class:`ExportServerError` if the server rejects the export, or
+        OSError and :class:`http.client.HTTPException` if it can't be reached.
+        """
+        fields = {
+            "format": format,
+            "xml": xml.decode("utf-8"),
+            "from": page_index,
+            "scale": scale,
+            "border": 0,
+            "bg": "none" if transparent else "#ffffff",
+        }
+        if width is not None:
+            fields["w"] = width
+        if height is not None:
+            fields["h"] = height
+        status, body = self._connections.request(
+            "POST",
+            self._connections.path or "/",
+            body=urlencode(fields).encode(),
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+        )
+        if status != 200:
+            raise ExportServerError(status, body)
+        return body
@@ -0,0 +1,235 @@
+"""A draw.io export server started by the build and reused across exports.
+
+Launching draw.io costs most of the time of an export, a worker pays for it
+once: it runs a command starting an export server, e.g. draw-image-export2
+with the draw.io bundle of the desktop app, and exports are then sent to it as
+to any other :class:`.ExportServer`. To contain leaks, the worker is replaced
+after a number of exports or once its processes use too much memory.
+"""
+import atexit
+import os
+import signal
+import socket
+import subprocess
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional
+
+from sphinx.util import logging
+
+from .server import ExportServer
+
+logger = logging.getLogger(__name__)
+
+#: How long a worker may take to accept connections, in seconds
+STARTUP_TIMEOUT = 60
+
+
+class WorkerError(Exception):
+    """The worker can't be started."""
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _accepts_connections(port: int) -> bool:
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=1):
+            return True
+    except OSError:
+        return False
+
+
+def session_memory(session: int) -> Optional[int]:
+    """The resident memory of all processes of a session, in bytes.
+
+    The worker runs in a session of its own, so this includes the browser
+    processes the export server starts. Returns None where there is no
+    ``/proc`` file system to read it from.
+    """
+    proc = Path("/proc")
+    if not proc.is_dir():
+        return None
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    total = 0
+    for entry in proc.iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            stat = (entry / "stat").read_text()
+            statm = (entry / "statm").read_text()
+        except OSError:  # the process has exited meanwhile
+            continue
+        # the fields following the command name: state, ppid, pgrp, session
+        fields = stat.rpartition(")")[2].split()
+        if int(fields[3]) == session:
+            total += int(statm.split()[1]) * page_size
+    return total
+
+
+def _terminate(process: subprocess.Popen) -> None:
+    """Stop the worker and whatever processes it started."""
+    if os.name == "posix":
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    elif process.poll() is None:
+        process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        if os.name == "posix":
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+        process.wait()
+
+
+class ExportWorker:
+    """An export server process, shared by the export threads.
+
+    ``{port}`` in ``command`` is replaced by the port the server is to listen
+    on, which is also in the ``PORT`` environment variable. The worker is only
+    started once the first export is sent to it, and it is restarted, once
+    the exports in flight are done, after ``max_jobs`` exports, above
+    ``max_memory`` bytes or when it has exited.
+
+    Should the worker fail to start, :class:`WorkerError` is raised for this
+    and every later export.
+    """
+
+    def __init__(
+        self,
+        command: List[str],
+        log_path: Path,
+        max_connections: int = 8,
+        timeout: Optional[float] = 300,
+        max_jobs: Optional[int] = None,
+        max_memory: Optional[int] = None,
+    ) -> None:
+        self.command = command
+        self.log_path = log_path
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.max_jobs = max_jobs
+        self.max_memory = max_memory
+        #: Why the worker can't be started, if it can't
+        self.failed: Optional[str] = None
+        #: How many times the worker was started
+        self.starts = 0
+        self._process: Optional[subprocess.Popen] = None
+        self._server: Optional[ExportServer] = None
+        self._jobs = 0
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    @property
+    def url(self) -> str:
+        return self._server.url if self._server else " ".join(self.command)
+
+    def export(self, *args, **kwargs) -> bytes:
+        """Export as :meth:`.ExportServer.export` does."""
+        server = self._acquire()
+        try:
+            return server.export(*args, **kwargs)
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    def _acquire(self) -> ExportServer:
+        with self._condition:
+            while True:
+                if self.failed:
+                    raise WorkerError(self.failed)
+                reason = self._recycle_reason()
+                if reason is None:
+                    break
+                if self._in_flight == 0:
+                    self._restart(reason)
+                else:
+                    self._condition.wait()
+            self._in_flight += 1
+            self._jobs += 1
+            return self._server
+
+    def _recycle_reason(self) -> Optional[str]:
+        """Why the worker has to be (re)started, if it has to be."""
+        process = self._process
+        if process is None:
+            return "not running"
+        if process.poll() is not None:
+            return f"exited with code {process.returncode}"
+        if self.max_jobs is not None and self._jobs >= self.max_jobs:
+            return f"{self._jobs} exports"
+        # a worker is only measured once it exported, should it start above
+        # the limit, it would otherwise never get to export anything
+        if self.max_memory is not None and self._jobs:
+            memory = session_memory(process.pid)
+            if memory is not None and memory > self.max_memory:
+                return f"{memory >> 20} MiB in use"
+        return None
+
+    def _restart(self, reason: str) -> None:
+        if self._process is not None:
+            logger.info(f"(drawio) recycling the export worker ({reason})")
+            _terminate(self._process)
+            self._process = self._server = None
+
+        port = free_port()
+        args = [arg.format(port=port) for arg in self.command]
+        if os.name == "posix":
+            # in a new session, to reach and measure the browser processes
+            group = {"start_new_session": True}
+        else:
+            group = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+        if self.starts == 0:
+            # in case the build is aborted before the worker is closed
+            atexit.register(self.close)
+        self.log_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.log_path, "ab") as log:
+            try:
+                process = subprocess.Popen(
+                    args,
+                    stdin=subprocess.DEVNULL,
+                    stdout=log,
+                    stderr=subprocess.STDOUT,
+                    env={**os.environ, "PORT": str(port)},
+                    **group,
+                )
+            except OSError as exc:
+                self._fail(f"{' '.join(args)} could not be started: {exc}")
+
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while not _accepts_connections(port):
+            if process.poll() is not None or time.monotonic() > deadline:
+                _terminate(process)
+                self._fail(
+                    f"{' '.join(args)} did not listen on port {port}, "
+                    f"see {self.log_path}"
+                )
+            time.sleep(0.1)
+
+        self._process = process
+        self._server = ExportServer(
+            f"http://127.0.0.1:{port}/", self.max_connections, self.timeout
+        )
+        self._jobs = 0
+        self.starts += 1
+        logger.info(f"(drawio) export worker is running on port {port}")
+
+    def _fail(self, reason: str) -> None:
+        self.failed = reason
+        logger.warning(f"draw.io export worker {reason}, exporting with draw.io")
+        raise WorkerError(reason)
+
+    def close(self) -> None:
+        with self._condition:
+            if self._process is not None:
+                _terminate(self._process)
+            self._process = self._server = None
@@ -0,0 +1,132 @@
+import atexit
+import os
+import threading
+from contextlib import contextmanager
+from subprocess import Popen, PIPE
+from typing import Iterator, List, Tuple
+
+from sphinx.errors import SphinxError
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
+
+
+class XvfbError(SphinxError):
+    """An Xvfb server could not be started."""
+
+    category = "Xvfb Error"
+
+
+def start_xvfb(screen: str) -> Tuple[Popen, str]:
+    """Start an Xvfb server, returning once it accepts connections.
+
+    Xvfb writes the number of the display it picked to the ``-displayfd`` file
+    descriptor when it is ready, so reading from a pipe blocks exactly until
+    then, or until Xvfb exits. Raises :class:`XvfbError` if it doesn't start.
+    """
+    read_fd, write_fd = os.pipe()
+    args = ["Xvfb", "-displayfd", str(write_fd), "-screen", "0", screen]
+    try:
+        xvfb = Popen(args, pass_fds=(write_fd,), stdout=PIPE, stderr=PIPE)
+    except OSError as exc:
+        os.close(read_fd)
+        raise XvfbError(f"Xvfb ({' '.join(args)}) could not be started: {exc}")
+    finally:
+        os.close(write_fd)
+    with os.fdopen(read_fd, "rb") as fp:
+        display = fp.readline().decode("ascii").strip()
+    if not display:
+        stdout, stderr = xvfb.communicate()
+        raise XvfbError(
+            f"Xvfb ({' '.join(args)}) exited with code {xvfb.returncode}:"
+            f"\n[stderr]\n{stderr}\n[stdout]\n{stdout}"
+        )
+    # in case the build is aborted before the pool is closed
+    atexit.register(_terminate_xvfb, xvfb)
+    return xvfb, display
+
+
+def stop_xvfb(xvfb: Popen) -> None:
+    xvfb.terminate()
+    stdout, stderr = xvfb.communicate()
+    if xvfb.poll() != 0:
+        raise OSError(
+            "Encountered an issue while terminating Xvfb"
+            f"\n[stdout]\n{stdout}\n[stderr]\n{stderr}"
+        )
+
+
+def _terminate_xvfb(xvfb: Popen) -> None:
+    if xvfb.poll() is None:
+        xvfb.terminate()
+        xvfb.wait()
+
+
+class DisplayPool:
+    """Xvfb servers handed out to draw.io processes, one at a time.
+
+    Servers are only started when no free one is left, up to ``size`` of them,
+    so concurrent draw.io processes never share a display. A server which has
+    exited is started again before its display is handed out.
+    """
+
+    def __init__(self, size: int, screen: str) -> None:
+        self.size = size
+        self.screen = screen
+        self.servers: List[Tuple[Popen, str]] = []
+        self._free: List[Tuple[Popen, str]] = []
+        self._starting = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def display(self) -> Iterator[str]:
+        """Check out a display for the duration of the ``with`` block."""
+        server = self._acquire()
+        try:
+            yield server[1]
+        finally:
+            with self._condition:
+                self._free.append(server)
+                self._condition.notify()
+
+    def _acquire(self) -> Tuple[Popen, str]:
+        with self._condition:
+            while not self._free and len(self.servers) + self._starting >= self.size:
+                self._condition.wait()
+            if self._free:
+                server = self._free.pop()
+                if server[0].poll() is None:
+                    return server
+                logger.warning(
+                    f"Xvfb on display :{server[1]} exited with code "
+                    f"{server[0].returncode}, restarting it"
+                )
+                self.servers.remove(server)
+            self._starting += 1
+
+        try:
+            server = start_xvfb(self.screen)
+        except BaseException:
+            with self._condition:
+                self._starting -= 1
+                self._condition.notify()
+            raise
+        logger.info(f"Xvfb is running on display :{server[1]}")
+        with self._condition:
+            self._starting -= 1
+            self.servers.append(server)
+        return server
+
+    def close(self, check: bool = True) -> None:
+        """Stop all servers. With ``check``, raise if one did not exit cleanly."""
+        with self._condition:
+            servers, self.servers, self._free = self.servers, [], []
+        for xvfb, display in servers:
+            if xvfb.poll() is not None:
+                logger.warning(
+                    f"Xvfb on display :{display} exited with code {xvfb.returncode}"
+                )
+            elif check:
+                stop_xvfb(xvfb)
+            else:
+                _terminate_xvfb(xvfb)
@@ -2,8 +2,13 @@ import json
 import os
 import re
 import sphinx
+import sys
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
-from typing import List
+from typing import Dict, Iterator, List
+from urllib.parse import parse_qs
 
 import pytest
 from bs4 import BeautifulSoup, Tag
@@ -44,8 +49,6 @@ def _set_config_options_from_json_path(app: Sphinx, config_path: str) -> None:
 def _setup_local_user_config(app):
     """Sets the local user's conf.py values for all tests
 
-    **Note**: This will not work for the `drawio_headless` config option.
-
     Useful for when a developer needs to configure values for a device-specific
     change. The file is .gitignore'd so it will not appear in git.
     Stored in tests/local_user_config.json"""
@@ -114,5 +117,132 @@ def tex_images(content: Sphinx) -> List[Path]:
     return [content.outdir / (m.group(1) + ".pdf") for m in matches]
 
 
+def read_report(app: Sphinx) -> dict:
+    """The export report of the app's last build."""
+    report = Path(app.doctreedir) / "drawio" / "report.json"
+    return json.loads(report.read_text())
+
+
+class ExportRequestHandler(BaseHTTPRequestHandler):
+    """A draw.io export server, answering every export with ``b"image"``.
+
+    The forms it was sent are kept in ``requests``, it answers with ``status``.
+    """
+
+    protocol_version = "HTTP/1.1"
+    requests: List[Dict[str, str]] = []
+    status = 200
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        form = parse_qs(self.rfile.read(length).decode())
+        self.requests.append({name: values[0] for name, values in form.items()})
+        content = b"image" if self.status == 200 else b"Error: invalid diagram"
+        self.send_response(self.status)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class CacheRequestHandler(BaseHTTPRequestHandler):
+    """An HTTP export cache, keeping its ``entries`` by path."""
+
+    protocol_version = "HTTP/1.1"
+    entries: Dict[str, bytes] = {}
+
+    def do_HEAD(self):
+        self.send_response(200 if self.path in self.entries else 404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        content = self.entries.get(self.path)
+        if content is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+    def do_PUT(self):
+        length = int(self.headers["Content-Length"])
+        self.entries[self.path] = self.rfile.read(length)
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@contextmanager
+def _serving(handler) -> Iterator[str]:
+    """Serve ``handler`` from a thread, providing the URL of the server."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture()
+def export_server():
+    """The URL of an export server, see :class:`ExportRequestHandler`."""
+    ExportRequestHandler.requests = []
+    ExportRequestHandler.status = 200
+    with _serving(ExportRequestHandler) as url:
+        yield url
+
+
+@pytest.fixture()
+def cache_server():
+    """The URL of an HTTP export cache, see :class:`CacheRequestHandler`."""
+    CacheRequestHandler.entries = {}
+    with _serving(CacheRequestHandler) as url:
+        yield f"{url}drawio"
+
+
+WORKER = """\
+import sys
+from http.server import ThreadingHTTPServer
+
+sys.path.insert(0, {tests_dir!r})
+from conftest import ExportRequestHandler
+
+ThreadingHTTPServer(("127.0.0.1", int(sys.argv[1])), ExportRequestHandler).serve_forever()
+"""
+
+
+@pytest.fixture()
+def export_worker(tmp_path: Path) -> List[str]:
+    """The command of an export worker, serving :class:`ExportRequestHandler`."""
+    script = tmp_path / "worker.py"
+    script.write_text(WORKER.format(tests_dir=str(Path(__file__).parent)))
+    return [sys.executable, str(script), "{port}"]
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--benchmark", action="store_true", help="run the benchmarks of the exports"
+    )
+
+
 def pytest_configure(config):
     config.addinivalue_line("markers", "sphinx")
+    config.addinivalue_line("markers", "benchmark: only runs with --benchmark")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmark"):
+        return
+    skip = pytest.mark.skip(reason="benchmarks only run with --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
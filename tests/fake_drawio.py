@@ -0,0 +1,50 @@
+"""A stand-in for the draw.io command line, for the benchmarks.
+
+It accepts the arguments the extension passes to draw.io, sleeps for
+``FAKE_DRAWIO_LATENCY`` seconds to emulate the start up and rendering time of
+Electron and writes a placeholder image in the requested format. Folders are
+exported as draw.io does, one output file per input file. Every run is
+appended to the file named by ``FAKE_DRAWIO_LOG``, if set.
+"""
+import os
+import sys
+import time
+from pathlib import Path
+
+# a 1x1 transparent image
+PLACEHOLDERS = {
+    "png": bytes.fromhex(
+        "89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c489"
+        "0000000b49444154789c6360000200000500017a5eab3f0000000049454e44ae426082"
+    ),
+    "jpg": bytes.fromhex("ffd8ffe000104a46494600010100000100010000ffd9"),
+    "svg": b'<svg xmlns="http://www.w3.org/2000/svg" width="1" height="1"/>',
+    "pdf": b"%PDF-1.4\n%%EOF\n",
+}
+
+
+def main(args):
+    if "--version" in args:
+        print("0.0.0-fake")
+        return 0
+
+    output = Path(args[args.index("--output") + 1])
+    source = Path(args[args.index("--output") + 2])
+    format = args[args.index("--format") + 1] if "--format" in args else "pdf"
+
+    time.sleep(float(os.environ.get("FAKE_DRAWIO_LATENCY", "0.05")))
+    if source.is_dir():
+        for input in sorted(source.iterdir()):
+            (output / f"{input.stem}.{format}").write_bytes(PLACEHOLDERS[format])
+    else:
+        output.write_bytes(PLACEHOLDERS[format])
+
+    log = os.environ.get("FAKE_DRAWIO_LOG")
+    if log:
+        with open(log, "a") as fp:
+            fp.write(" ".join(args) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
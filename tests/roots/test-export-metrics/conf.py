@@ -0,0 +1,24 @@
+extensions = ["sphinxcontrib.drawio"]
+
+master_doc = "index"
+exclude_patterns = ["_build"]
+
+# removes most of the HTML
+html_theme = "basic"
+
+drawio_export_workers = 2
+drawio_export_trace = True
+
+
+def setup(app):
+    app.drawio_events = []
+    app.connect(
+        "drawio-export-started",
+        lambda app, job: app.drawio_events.append(("started", job.key)),
+    )
+    app.connect(
+        "drawio-export-finished",
+        lambda app, job, stats: app.drawio_events.append(
+            ("finished", job.key, stats["outcome"])
+        ),
+    )
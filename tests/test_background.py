@@ -0,0 +1,97 @@
+import io
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+from sphinx.application import Sphinx
+from sphinx.util.docutils import docutils_namespace
+
+from conftest import read_report
+from sphinxcontrib.drawio.__main__ import main
+
+
+def build(srcdir: Path, outdir: Path) -> Sphinx:
+    with docutils_namespace():
+        app = Sphinx(
+            str(srcdir),
+            str(srcdir),
+            str(outdir),
+            str(outdir / ".doctrees"),
+            "html",
+            {
+                "drawio_background_export": True,
+                # passed on to the background export, as any other override
+                "drawio_builder_export_format": {"html": "png"},
+            },
+            status=None,
+            warning=io.StringIO(),
+        )
+        app.build()
+    assert app.statuscode == 0, app._warning.getvalue()
+    return app
+
+
+def test_background_export(rootdir, tmp_path: Path, monkeypatch):
+    import sphinxcontrib.drawio
+
+    launched = []
+    popen = sphinxcontrib.drawio.subprocess.Popen
+
+    def launch(args, **kwargs):
+        if "sphinxcontrib.drawio" not in args:
+            return popen(args, **kwargs)
+        # the process inherits the lock the build took for it
+        (fd,) = kwargs["pass_fds"]
+        index = args.index("--lock-fd") + 1
+        launched.append(args[:index] + [str(os.dup(fd))] + args[index + 1 :])
+
+    monkeypatch.setattr(sphinxcontrib.drawio.subprocess, "Popen", launch)
+    srcdir = tmp_path / "src"
+    outdir = tmp_path / "out"
+    shutil.copytree(str(rootdir / "test-image"), str(srcdir))
+    diagram = srcdir / "box.drawio"
+
+    # without a previous export, the diagram is exported by the build
+    (export,) = read_report(build(srcdir, outdir))["exports"]
+    assert export["outcome"] == "exported"
+    assert launched == []
+
+    shutil.copyfile(str(rootdir / "test-layer-selection" / "layers.drawio"), diagram)
+    app = build(srcdir, outdir)
+    (deferred,) = read_report(app)["exports"]
+    assert deferred["outcome"] == "deferred"
+    # the previous export is served meanwhile
+    assert any(export["key"] in image for image in app.env.images)
+    assert not any(deferred["key"] in image for image in app.env.images)
+
+    (args,) = launched
+    assert args[1:3] == ["-m", "sphinxcontrib.drawio"]
+    imagedir = app.doctreedir / "drawio"
+    assert args[args.index("--touch") + 1] == str(imagedir / "background.done")
+
+    # while the background export runs, no other one is started
+    time.sleep(0.01)
+    diagram.touch()
+    (deferred_again,) = read_report(build(srcdir, outdir))["exports"]
+    assert deferred_again["outcome"] == "deferred"
+    assert len(launched) == 1
+    # and one started meanwhile exports nothing
+    index = args.index("--lock-fd")
+    lock_args = ["--lock", str(imagedir / "background.lock")]
+    assert main(args[3:index] + lock_args + args[index + 2 :]) == 0
+    assert not (imagedir / "background.done").exists()
+
+    mtime = diagram.stat().st_mtime_ns
+    assert main(args[3:]) == 0
+    assert (imagedir / "background.done").exists()
+    # the diagram is left alone, the documents using it are read again
+    assert diagram.stat().st_mtime_ns == mtime
+    app = build(srcdir, outdir)
+    (updated,) = read_report(app)["exports"]
+    assert updated["outcome"] == "up-to-date"
+    assert updated["key"] == deferred["key"]
+    assert any(deferred["key"] in image for image in app.env.images)
+    assert len(launched) == 1
+    assert json.loads((imagedir / "outdated.json").read_text()) == {}
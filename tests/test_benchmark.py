@@ -0,0 +1,181 @@
+"""Benchmarks of the exports, against a fake draw.io binary.
+
+These only run with ``pytest --benchmark``. A synthetic project is generated
+with many multi-page draw.io files referenced by many directives, and built
+with ``tests/fake_drawio.py`` standing in for draw.io, so that the overhead of
+the extension itself is measured reproducibly and without Xvfb.
+
+The number of draw.io runs and exports of each build must match the baseline
+stored in ``benchmark_baseline.json`` exactly. Durations depend on the machine,
+so they are only compared relative to the cold build of the same run: that of
+each later build must not exceed the baseline by more than
+``DRAWIO_BENCHMARK_TOLERANCE`` (a factor, 2 by default). The durations in
+seconds are only reported. Run with ``DRAWIO_BENCHMARK_UPDATE=1`` to store new
+baseline values instead.
+"""
+import io
+import json
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Dict
+
+import pytest
+
+from sphinx.application import Sphinx
+from sphinx.util.docutils import docutils_namespace
+
+pytestmark = [
+    pytest.mark.benchmark,
+    pytest.mark.skipif(os.name != "posix", reason="uses a shebang"),
+]
+
+BASELINE_PATH = Path(__file__).parent / "benchmark_baseline.json"
+FAKE_DRAWIO = Path(__file__).parent / "fake_drawio.py"
+
+DRAWIO_FILES = 40
+PAGES_PER_FILE = 5
+DOCUMENTS = 50
+DIRECTIVES_PER_DOCUMENT = 20
+LATENCY = 0.02
+
+CONF = """\
+extensions = ["sphinxcontrib.drawio"]
+master_doc = "index"
+html_theme = "basic"
+drawio_binary_path = {binary!r}
+drawio_headless = False
+drawio_export_workers = 4
+"""
+
+
+def drawio_file(number: int) -> str:
+    pages = []
+    for page in range(PAGES_PER_FILE):
+        pages.append(
+            f'<diagram id="d{page}" name="Page-{page}"><mxGraphModel>'
+            '<root><mxCell id="0"/><mxCell id="1" parent="0"/>'
+            f'<mxCell id="2" value="File {number}, page {page}" vertex="1" '
+            'parent="1"><mxGeometry x="0" y="0" width="120" height="60" '
+            'as="geometry"/></mxCell></root></mxGraphModel></diagram>'
+        )
+    return f"<mxfile>{''.join(pages)}</mxfile>"
+
+
+def document(number: int) -> str:
+    lines = [f"Document {number}", "=" * 20, ""]
+    for directive in range(DIRECTIVES_PER_DOCUMENT):
+        index = number * DIRECTIVES_PER_DOCUMENT + directive
+        lines.append(f".. drawio-image:: diagram{index % DRAWIO_FILES}.drawio")
+        # exports are shared between several directives, as in real projects
+        page = (index // DRAWIO_FILES) % PAGES_PER_FILE
+        if index % 2:
+            lines.append(f"   :page-index: {page}")
+        else:
+            lines.append(f"   :page-name: Page-{page}")
+        if index % 3 == 0:
+            lines.append("   :export-scale: 200")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def generate_project(srcdir: Path, binary: Path) -> None:
+    srcdir.mkdir()
+    (srcdir / "conf.py").write_text(CONF.format(binary=str(binary)))
+    toctree = "\n".join(f"   doc{number}" for number in range(DOCUMENTS))
+    (srcdir / "index.rst").write_text(f"Index\n=====\n\n.. toctree::\n\n{toctree}\n")
+    for number in range(DOCUMENTS):
+        (srcdir / f"doc{number}.rst").write_text(document(number))
+    for number in range(DRAWIO_FILES):
+        (srcdir / f"diagram{number}.drawio").write_text(drawio_file(number))
+
+
+class Project:
+    def __init__(self, path: Path) -> None:
+        self.srcdir = path / "src"
+        self.outdir = path / "out"
+        self.doctreedir = path / "doctrees"
+        self.log = path / "drawio.log"
+        #: The results of the builds so far, by scenario
+        self.results: Dict[str, dict] = {}
+
+        binary = path / "drawio"
+        binary.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_DRAWIO}" "$@"\n')
+        binary.chmod(0o755)
+        generate_project(self.srcdir, binary)
+
+    def build(self, freshenv: bool = False) -> dict:
+        """Build the project, returning the duration and number of draw.io runs."""
+        self.log.write_text("")
+        start = time.perf_counter()
+        with docutils_namespace():
+            app = Sphinx(
+                str(self.srcdir),
+                str(self.srcdir),
+                str(self.outdir),
+                str(self.doctreedir),
+                "html",
+                status=None,
+                warning=io.StringIO(),
+                freshenv=freshenv,
+            )
+            app.build()
+        seconds = time.perf_counter() - start
+        assert app.statuscode == 0, app._warning.getvalue()
+
+        report = json.loads((self.doctreedir / "drawio" / "report.json").read_text())
+        totals = report["totals"]
+        return {
+            "seconds": seconds,
+            "launches": len(self.log.read_text().splitlines()),
+            "exports": totals["exports"],
+            # the time spent by the converter per image node, draw.io aside
+            "node_overhead": (totals["resolve"] + totals["cache"])
+            / max(totals["references"], 1),
+        }
+
+
+def check(project: "Project", scenario: str, result: dict) -> None:
+    project.results[scenario] = result
+    result["relative"] = result["seconds"] / project.results["cold"]["seconds"]
+    print(f"\n{scenario}: {json.dumps(result)}")
+    if os.environ.get("DRAWIO_BENCHMARK_UPDATE"):
+        stored = json.loads(BASELINE_PATH.read_text()) if BASELINE_PATH.exists() else {}
+        stored[scenario] = result
+        BASELINE_PATH.write_text(json.dumps(stored, indent=2, sort_keys=True) + "\n")
+        return
+
+    expected = json.loads(BASELINE_PATH.read_text())[scenario]
+    tolerance = float(os.environ.get("DRAWIO_BENCHMARK_TOLERANCE", "2"))
+    assert result["launches"] == expected["launches"]
+    assert result["exports"] == expected["exports"]
+    assert result["relative"] <= expected["relative"] * tolerance, (
+        f"{scenario}: the duration relative to the cold build regressed from "
+        f"{expected['relative']:.4f} to {result['relative']:.4f}"
+    )
+
+
+@pytest.fixture(scope="module")
+def project(tmp_path_factory):
+    project = Project(tmp_path_factory.mktemp("benchmark"))
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setenv("FAKE_DRAWIO_LATENCY", str(LATENCY))
+        monkeypatch.setenv("FAKE_DRAWIO_LOG", str(project.log))
+        yield project
+
+
+# The scenarios build upon each other and run in the order they are defined
+def test_cold_build(project: Project):
+    check(project, "cold", project.build())
+
+
+def test_cached_rebuild(project: Project):
+    # all documents are read and converted again, all exports are up to date
+    check(project, "cached", project.build(freshenv=True))
+
+
+def test_single_file_edit(project: Project):
+    path = project.srcdir / "diagram0.drawio"
+    path.write_text(path.read_text().replace("File 0, page 1", "File 0, edited"))
+    check(project, "single-file-edit", project.build())
@@ -1,4 +1,7 @@
+import json
+import os
 import shutil
+import time
 
 from pathlib import Path
 from typing import List
@@ -7,6 +10,17 @@ import pytest
 import sphinx
 
 from sphinx.application import Sphinx
+from sphinx.util.docutils import docutils_namespace
+from conftest import CacheRequestHandler
+from sphinxcontrib.drawio import (
+    DrawIOConverter,
+    ExportCache,
+    HTTPExportCache,
+    LocalExportCache,
+)
+from sphinxcontrib.drawio import cache as cache_module
+from sphinxcontrib.drawio.cache import collect_garbage
+from sphinxcontrib.drawio.manifest import ExportManifest
 
 
 @pytest.mark.sphinx("latex", testroot="image", srcdir="image_latex_then_html")
@@ -23,3 +37,240 @@ def test_image_latex_then_html(
     html_app.build()
     box_svg = html_app.outdir / "_images" / "box.svg"
     assert box_svg.exists()
+
+
+@pytest.mark.sphinx("html", testroot="image", srcdir="image_shared_cache")
+def test_shared_cache(make_app_with_local_user_config, app_params, tmp_path: Path):
+    cache_dir = tmp_path / "cache"
+    args, kwargs = app_params
+    app = make_app_with_local_user_config(
+        *args, confoverrides={"drawio_cache_dir": str(cache_dir)}, **kwargs
+    )
+    app.build()
+    (entry,) = cache_dir.glob("*/*.svg")
+
+    # a different project with the same diagram reuses the stored export
+    other_srcdir = tmp_path / "other"
+    shutil.copytree(str(app.srcdir), str(other_srcdir))
+    shutil.rmtree(str(other_srcdir / "_build"))
+    other_app = make_app_with_local_user_config(
+        srcdir=type(app.srcdir)(str(other_srcdir)),
+        confoverrides={"drawio_cache_dir": str(cache_dir)},
+    )
+    other_app.build()
+    (export,) = Path(other_app.doctreedir, "drawio").glob("*/box.svg")
+    assert export.read_bytes() == entry.read_bytes()
+    assert (other_app.outdir / "_images" / "box.svg").exists()
+
+
+def test_cache_eviction(tmp_path: Path):
+    cache = LocalExportCache(tmp_path / "cache", max_size=10)
+    for index, key in enumerate(["aaaa", "bbbb", "cccc"]):
+        source = tmp_path / f"{key}.png"
+        source.write_bytes(b"12345")
+        cache.put(key, "png", source)
+        entry = tmp_path / "cache" / key[:2] / f"{key}.png"
+        os.utime(entry, (index, index))
+
+    # accessing an entry marks it as recently used
+    assert cache.get("aaaa", "png", tmp_path / "build" / "aaaa.png")
+    cache.evict()
+    assert cache.exists("aaaa", "png")
+    assert not cache.exists("bbbb", "png")
+    assert cache.exists("cccc", "png")
+    assert (tmp_path / "build" / "aaaa.png").read_bytes() == b"12345"
+
+
+def test_collect_garbage(tmp_path: Path):
+    keys = [character * 40 for character in "abcd"]
+    for key in keys:
+        (tmp_path / key).mkdir()
+        (tmp_path / key / "box.png").write_bytes(b"12345")
+    (tmp_path / "versions.json").write_text("{}")
+    day = 24 * 3600
+    now = time.time()
+    usage = {keys[0]: now - 3 * day, keys[1]: now - 2 * day, keys[2]: now - day}
+    (tmp_path / "usage.json").write_text(json.dumps(usage))
+
+    # the export without a usage record is new to the collector
+    assert collect_garbage(tmp_path, [keys[1]], 1.5 * day) == (1, 5)
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        *keys[1:],
+        "usage.json",
+        "versions.json",
+    ]
+
+    # the exports of the build are kept even when over the size
+    assert collect_garbage(tmp_path, [keys[1]], None, max_size=5) == (2, 10)
+    assert (tmp_path / keys[1]).exists()
+    assert list(json.loads((tmp_path / "usage.json").read_text())) == [keys[1]]
+
+
+@pytest.mark.sphinx("html", testroot="image", srcdir="unused_exports")
+def test_remove_unused_exports(make_app_with_local_user_config, app_params):
+    args, kwargs = app_params
+    kwargs["confoverrides"] = {"drawio_gc_grace_period": 0}
+    app = make_app_with_local_user_config(*args, **kwargs)
+    app.build()
+    imagedir = Path(app.doctreedir) / "drawio"
+    (export,) = imagedir.glob("*/box.svg")
+    unused = imagedir / ("0" * 40)
+    unused.mkdir()
+    usage = json.loads((imagedir / "usage.json").read_text())
+    usage[unused.name] = 0
+    (imagedir / "usage.json").write_text(json.dumps(usage))
+
+    app = make_app_with_local_user_config(*args, **kwargs)
+    app.build(force_all=True)
+    assert export.exists()
+    assert not unused.exists()
+
+
+@pytest.mark.sphinx("html", testroot="image", srcdir="export_manifest")
+def test_export_manifest(make_app_with_local_user_config, app_params, monkeypatch):
+    args, kwargs = app_params
+    app = make_app_with_local_user_config(*args, **kwargs)
+    app.build()
+    imagedir = Path(app.doctreedir) / "drawio"
+    (export,) = imagedir.glob("*/box.svg")
+    manifest = ExportManifest(imagedir)
+    entry = manifest.get(f"drawio/{export.parent.name}/box.svg")
+    assert entry["key"] == export.parent.name
+    assert entry["size"] == export.stat().st_size
+    assert entry["render_time"] > 0
+
+    # up to date exports are found in the manifest, not on disk
+    recorded = []
+    monkeypatch.setattr(DrawIOConverter, "_record_export", recorded.append)
+    app = make_app_with_local_user_config(*args, **kwargs)
+    app.build(force_all=True)
+    assert recorded == []
+
+    # a missing export is only noticed once it is used, and exported again
+    export.unlink()
+    relpath = f"drawio/{export.parent.name}/box.svg"
+    manifest = ExportManifest(imagedir)
+    assert relpath in manifest
+    assert not manifest.exists(relpath) and relpath not in manifest
+    monkeypatch.undo()
+    app = make_app_with_local_user_config(*args, **kwargs)
+    app.build(force_all=True)
+    assert export.exists()
+
+    shutil.rmtree(export.parent)
+    assert ExportManifest(imagedir).entries == {}
+
+
+def test_http_cache(cache_server: str, tmp_path: Path):
+    cache = HTTPExportCache(cache_server)
+    source = tmp_path / "box.svg"
+    source.write_bytes(b"<svg/>")
+    assert not cache.exists("abcd", "svg")
+    assert not cache.get("abcd", "svg", tmp_path / "missing.svg")
+    assert not (tmp_path / "missing.svg").exists()
+    cache.put("abcd", "svg", source)
+    assert cache.exists("abcd", "svg")
+    assert cache.get("abcd", "svg", tmp_path / "build" / "box.svg")
+    assert (tmp_path / "build" / "box.svg").read_bytes() == b"<svg/>"
+
+
+def test_http_cache_unreachable(tmp_path: Path, monkeypatch):
+    warnings = []
+    monkeypatch.setattr(cache_module.logger, "warning", warnings.append)
+    # nothing listens on the discard port
+    cache = HTTPExportCache("http://127.0.0.1:9")
+    source = tmp_path / "box.svg"
+    source.write_bytes(b"<svg/>")
+    assert not cache.exists("abcd", "svg")
+    assert not cache.get("abcd", "svg", tmp_path / "box.svg")
+    cache.put("abcd", "svg", source)
+    assert not cache.get("efgh", "svg", tmp_path / "box.svg")
+    assert len(warnings) == 1
+
+
+@pytest.mark.sphinx("html", testroot="image", srcdir="image_http_cache")
+def test_http_cache_build(make_app_with_local_user_config, app_params, cache_server):
+    args, kwargs = app_params
+    overrides = {"drawio_cache_url": cache_server}
+    app = make_app_with_local_user_config(*args, confoverrides=overrides, **kwargs)
+    app.build()
+    (content,) = CacheRequestHandler.entries.values()
+
+    # another node starting from scratch fetches the export from the cache
+    shutil.rmtree(str(app.doctreedir))
+    CacheRequestHandler.entries = {
+        path: b"cached" for path in CacheRequestHandler.entries
+    }
+    other_app = make_app_with_local_user_config(
+        *args, confoverrides=overrides, **kwargs
+    )
+    other_app.build()
+    assert (other_app.outdir / "_images" / "box.svg").read_bytes() == b"cached"
+
+
+class DictExportCache(ExportCache):
+    def __init__(self) -> None:
+        self.entries = {}
+
+    def exists(self, key: str, format: str) -> bool:
+        return (key, format) in self.entries
+
+    def get(self, key: str, format: str, destination: Path) -> bool:
+        if (key, format) not in self.entries:
+            return False
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        destination.write_bytes(self.entries[key, format])
+        return True
+
+    def put(self, key: str, format: str, source: Path) -> None:
+        self.entries[key, format] = source.read_bytes()
+
+
+@pytest.mark.sphinx("html", testroot="image", srcdir="image_custom_cache")
+def test_custom_cache(make_app_with_local_user_config, app_params):
+    args, kwargs = app_params
+    cache = DictExportCache()
+    overrides = {"drawio_export_caches": [cache]}
+    app = make_app_with_local_user_config(*args, confoverrides=overrides, **kwargs)
+    app.build()
+    assert len(cache.entries) == 1
+
+    shutil.rmtree(str(app.doctreedir))
+    cache.entries = {entry: b"cached" for entry in cache.entries}
+    other_app = make_app_with_local_user_config(
+        *args, confoverrides=overrides, **kwargs
+    )
+    other_app.build()
+    assert (other_app.outdir / "_images" / "box.svg").read_bytes() == b"cached"
+
+
+def test_keep_exports_of_unchanged_documents(rootdir: Path, tmp_path: Path):
+    srcdir = tmp_path / "src"
+    outdir = tmp_path / "out"
+    shutil.copytree(str(rootdir / "test-image"), str(srcdir))
+    (srcdir / "index.rst").write_text(".. toctree::\n\n   a\n   b\n")
+    (srcdir / "a.rst").write_text("A\n=\n\n.. drawio-image:: box.drawio\n")
+    (srcdir / "b.rst").write_text("B\n=\n\n.. drawio-image:: circle.drawio\n")
+
+    def build() -> Sphinx:
+        with docutils_namespace():
+            app = Sphinx(
+                str(srcdir),
+                str(srcdir),
+                str(outdir),
+                str(outdir / ".doctrees"),
+                "html",
+                {"drawio_gc_grace_period": 0},
+                status=None,
+                warning=None,
+            )
+            app.build()
+        return app
+
+    imagedir = build().doctreedir / "drawio"
+    (circle,) = imagedir.glob("*/circle.*")
+    time.sleep(0.01)
+    (srcdir / "a.rst").write_text("A\n=\n\nEdited.\n\n.. drawio-image:: box.drawio\n")
+    # only a.rst is read and written, b.rst still uses its export
+    build()
+    assert circle.exists()
@@ -0,0 +1,166 @@
+import io
+import os
+import shutil
+import threading
+import time
+
+from pathlib import Path
+from typing import List
+
+import pytest
+
+from sphinx.application import Sphinx
+from sphinx.util.docutils import docutils_namespace
+from sphinx.util.images import get_image_size
+from sphinxcontrib.drawio import export_lock
+
+
+@pytest.mark.sphinx("html", testroot="export-workers")
+def test_export_workers(content: Sphinx, images: List[Path]):
+    assert [image.name for image in images] == [
+        "pages.png",
+        "pages1.png",
+        "pages1.png",
+        "pages2.png",
+    ]
+    assert get_image_size(images[0]) == (125, 65)
+    assert get_image_size(images[1]) == (65, 65)
+    assert get_image_size(images[2]) == (65, 65)
+
+    # warnings are reported once per directive, as in a sequential build
+    warnings = content._warning.getvalue()
+    assert warnings.count("selected page 6 is out of range [0,1]") == 1
+
+
+@pytest.mark.sphinx("html", testroot="batch-export")
+def test_batch_export(images: List[Path]):
+    assert [image.name for image in images] == [
+        "box.png",
+        "circle.png",
+        "box1.png",
+        "box.svg",
+    ]
+    assert get_image_size(images[0]) == (125, 65)
+    assert get_image_size(images[2]) == (245, 125)
+    assert all(image.exists() for image in images)
+
+
+def test_batch_chunks(rootdir: Path, tmp_path: Path, monkeypatch):
+    import sphinxcontrib.drawio
+
+    runs = []
+    run_drawio = sphinxcontrib.drawio.run_drawio
+
+    def run(args, env, timeout=None):
+        if "--export" not in args:
+            return run_drawio(args, env, timeout)
+        source = Path(args[args.index("--output") + 2])
+        runs.append((len(list(source.iterdir())) if source.is_dir() else 1, timeout))
+        return run_drawio(args, env, timeout)
+
+    monkeypatch.setattr(sphinxcontrib.drawio, "run_drawio", run)
+    srcdir = tmp_path / "src"
+    srcdir.mkdir()
+    shutil.copyfile(str(rootdir / "test-image" / "conf.py"), srcdir / "conf.py")
+    diagrams = [f"box{number}.drawio" for number in range(5)]
+    for diagram in diagrams:
+        (srcdir / diagram).write_text(
+            '<mxfile><diagram name="Page-1"><mxGraphModel><root><mxCell id="0"/>'
+            f'<mxCell id="1" parent="0"/><mxCell id="2" value="{diagram}" '
+            'vertex="1" parent="1"><mxGeometry width="80" height="40" '
+            'as="geometry"/></mxCell></root></mxGraphModel></diagram></mxfile>'
+        )
+    (srcdir / "index.rst").write_text(
+        "".join(f".. drawio-image:: {diagram}\n\n" for diagram in diagrams)
+    )
+    with docutils_namespace():
+        app = Sphinx(
+            str(srcdir),
+            str(srcdir),
+            str(tmp_path / "out"),
+            str(tmp_path / "out" / ".doctrees"),
+            "html",
+            {
+                "drawio_batch_export": True,
+                "drawio_batch_size": 2,
+                "drawio_export_timeout": 10,
+            },
+            status=None,
+            warning=io.StringIO(),
+        )
+        app.build()
+    assert app.statuscode == 0
+    # the batch of 5 diagrams is exported by several draw.io runs, which are
+    # given the time of as many exports as they make
+    assert sorted(runs) == [(1, 10), (2, 20), (2, 20)]
+
+
+@pytest.mark.sphinx("html", testroot="page-index", parallel=2)
+def test_parallel_build(content: Sphinx, images: List[Path]):
+    assert [image.name for image in images] == [
+        "pages.png",
+        "pages1.png",
+        "pages2.png",
+        "pages.png",
+    ]
+    assert "not safe for parallel" not in content._warning.getvalue()
+
+
+def test_parallel_read(rootdir: Path, tmp_path: Path, monkeypatch):
+    import sphinxcontrib.drawio
+
+    probes = []
+    run_drawio = sphinxcontrib.drawio.run_drawio
+
+    def run(args, env, timeout=None):
+        if "--version" in args:
+            probes.append(os.getpid())
+        return run_drawio(args, env, timeout)
+
+    monkeypatch.setattr(sphinxcontrib.drawio, "run_drawio", run)
+    srcdir = tmp_path / "src"
+    srcdir.mkdir()
+    shutil.copyfile(str(rootdir / "test-image" / "conf.py"), srcdir / "conf.py")
+    shutil.copyfile(str(rootdir / "test-image" / "box.drawio"), srcdir / "box.drawio")
+    # enough documents for Sphinx to read them in parallel
+    docnames = [f"doc{number}" for number in range(8)]
+    for docname in docnames:
+        (srcdir / f"{docname}.rst").write_text(
+            f"{docname}\n====\n\n.. drawio-image:: box.drawio\n"
+        )
+    (srcdir / "index.rst").write_text(
+        ".. toctree::\n\n" + "".join(f"   {name}\n" for name in docnames)
+    )
+    with docutils_namespace():
+        app = Sphinx(
+            str(srcdir),
+            str(srcdir),
+            str(tmp_path / "out"),
+            str(tmp_path / "out" / ".doctrees"),
+            "html",
+            status=None,
+            warning=io.StringIO(),
+            parallel=2,
+        )
+        app.build()
+    assert app.statuscode == 0
+    # draw.io is only probed by the main process, once the documents are read
+    assert probes == [os.getpid()]
+    keys = app.env.drawio_export_keys
+    assert sorted(keys) == docnames and len(set.union(*keys.values())) == 1
+
+
+def test_export_lock(tmp_path: Path):
+    events = []
+
+    def export():
+        with export_lock(tmp_path):
+            events.append("acquired")
+
+    with export_lock(tmp_path):
+        thread = threading.Thread(target=export)
+        thread.start()
+        time.sleep(0.2)
+        events.append("released")
+    thread.join()
+    assert events == ["released", "acquired"]
@@ -0,0 +1,198 @@
+import base64
+import json
+import zlib
+from xml.etree import ElementTree as ET
+
+from pathlib import Path
+from typing import List
+from urllib.parse import quote
+
+import pytest
+
+from sphinx.application import Sphinx
+from sphinxcontrib.drawio.metadata import (
+    DrawIOLayer,
+    extract_page,
+    read_embedded_diagram,
+    read_metadata,
+)
+
+ROOTS = Path(__file__).parent / "roots"
+
+
+def test_pages():
+    metadata = read_metadata(ROOTS / "test-page-name" / "pages.drawio", "digest")
+    assert metadata.digest == "digest"
+    assert [page.name for page in metadata.pages] == ["Page-1", "Page-2"]
+    assert metadata.page_index("Page-2") == 1
+    assert metadata.page_index("missing") is None
+    assert (metadata.pages[0].width, metadata.pages[0].height) == (827, 1169)
+
+
+def test_layers():
+    metadata = read_metadata(ROOTS / "test-layer-selection" / "layers.drawio", "")
+    (page,) = metadata.pages
+    assert [layer.name for layer in page.layers] == ["", "layer 1", "layer 2"]
+
+
+def test_uncompressed(tmp_path: Path):
+    path = tmp_path / "uncompressed.drawio"
+    path.write_text(
+        '<mxfile><diagram id="a" name="First">'
+        '<mxGraphModel pageWidth="100" pageHeight="50"><root>'
+        '<mxCell id="0"/><mxCell id="1" parent="0"/>'
+        '<object label="Labels" id="2"><mxCell parent="0"/></object>'
+        '<mxCell id="3" style="shape=image;image=data:image/png,AAAA" parent="1"/>'
+        "</root></mxGraphModel></diagram></mxfile>"
+    )
+    (page,) = read_metadata(path, "").pages
+    assert (page.id, page.name, page.width, page.height) == ("a", "First", 100, 50)
+    assert page.layers == [DrawIOLayer("1", ""), DrawIOLayer("2", "Labels")]
+
+
+@pytest.mark.sphinx("html", testroot="page-name")
+def test_metadata_in_env(content: Sphinx):
+    (metadata,) = content.env.drawio_metadata.values()
+    assert len(metadata.pages) == 2
+
+
+def test_page_digests(tmp_path: Path):
+    pages_path = ROOTS / "test-page-name" / "pages.drawio"
+    first, second = read_metadata(pages_path, "").pages
+    assert first.digest != second.digest
+
+    # saving again only changes the attributes of <mxfile>
+    resaved = tmp_path / "resaved.drawio"
+    content = pages_path.read_text()
+    resaved.write_text(content.replace('etag="', 'etag="changed-'))
+    assert read_metadata(resaved, "").pages == [first, second]
+
+
+def test_page_digest_compression(tmp_path: Path):
+    model = (
+        '<mxGraphModel dx="{dx}" pageWidth="100" pageHeight="50"><root>'
+        '<mxCell id="0"/><mxCell id="1" parent="0"/>'
+        "</root></mxGraphModel>"
+    )
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    compressed = compressor.compress(quote(model.format(dx=10)).encode())
+    compressed += compressor.flush()
+    compressed_path = tmp_path / "compressed.drawio"
+    compressed_path.write_text(
+        '<mxfile><diagram id="a" name="First">{}</diagram></mxfile>'.format(
+            base64.b64encode(compressed).decode()
+        )
+    )
+    uncompressed_path = tmp_path / "uncompressed.drawio"
+    uncompressed_path.write_text(
+        '<mxfile><diagram id="a" name="First">{}</diagram></mxfile>'.format(
+            model.format(dx=20)
+        )
+    )
+    assert read_metadata(compressed_path, "") == read_metadata(uncompressed_path, "")
+
+
+def test_embedded_diagrams():
+    root = ROOTS / "test-embedded"
+    box = read_embedded_diagram(root / "box.drawio.svg")
+    assert box.startswith(b"<mxfile ")
+    pages = read_embedded_diagram(root / "pages.drawio.png")
+    assert pages.startswith(b"<mxfile ")
+
+    metadata = read_metadata(root / "pages.drawio.png", "")
+    assert [page.name for page in metadata.pages] == ["Page-1", "Page-2"]
+    assert read_embedded_diagram(root / "index.rst") is None
+
+
+@pytest.mark.sphinx("html", testroot="embedded")
+def test_embedded_passthrough(content: Sphinx, images: List[Path]):
+    assert [image.name for image in images] == [
+        "box.drawio.svg",
+        "box.drawio.png",
+        "pages.drawio1.png",
+        "pages.drawio2.png",
+    ]
+    # the editable SVG image is used as it is
+    source = Path(content.srcdir) / "box.drawio.svg"
+    assert images[0].read_bytes() == source.read_bytes()
+    # a page other than the first one of a multi-page file is exported
+    report = json.loads((Path(content.doctreedir) / "drawio/report.json").read_text())
+    outcomes = sorted(
+        (export["source"], export["outcome"]) for export in report["exports"]
+    )
+    assert outcomes == [
+        ("box.drawio.svg", "exported"),
+        ("box.drawio.svg", "passthrough"),
+        ("pages.drawio.png", "exported"),
+        ("pages.drawio.png", "exported"),
+    ]
+
+
+def test_extract_page(tmp_path: Path):
+    pages_path = str(ROOTS / "test-page-name" / "pages.drawio")
+    first, second = read_metadata(pages_path, "").pages
+
+    extracted = extract_page(pages_path, 1)
+    root = ET.fromstring(extracted)
+    assert root.tag == "mxfile" and root.get("pages") == "2"
+    (diagram,) = root
+    assert diagram.get("name") == "Page-2"
+    # the page is decompressed, and hashes the same
+    assert diagram[0].tag == "mxGraphModel"
+    extracted_path = tmp_path / "extracted.drawio"
+    extracted_path.write_bytes(extracted)
+    (page,) = read_metadata(extracted_path, "").pages
+    assert page == second
+
+    assert extract_page(pages_path, 2) is None
+
+
+@pytest.mark.sphinx("html", testroot="page-index", srcdir="page_extraction")
+def test_page_extraction(app_with_local_user_config: Sphinx, monkeypatch):
+    import sphinxcontrib.drawio
+
+    exported = []
+    run_drawio = sphinxcontrib.drawio.run_drawio
+
+    def record(args, env, timeout):
+        if "--export" not in args:
+            return run_drawio(args, env, timeout)
+        page_index = args[args.index("--page-index") + 1]
+        input_path = Path(args[args.index("--output") + 2])
+        pages = read_metadata(input_path, "").pages
+        exported.append((page_index, [page.name for page in pages]))
+        return run_drawio(args, env, timeout)
+
+    monkeypatch.setattr(sphinxcontrib.drawio, "run_drawio", record)
+    app_with_local_user_config.build()
+
+    assert sorted(exported) == [
+        ("0", ["Page-1"]),
+        ("0", ["Page-2"]),
+        # draw.io picks a page for an index out of range
+        ("2", ["Page-1", "Page-2"]),
+    ]
+
+
+@pytest.mark.sphinx(
+    "html",
+    testroot="page-index",
+    srcdir="page_extraction_batch",
+    confoverrides={"drawio_batch_export": True, "drawio_export_workers": 2},
+)
+def test_page_extraction_batch(app_with_local_user_config: Sphinx, monkeypatch):
+    import sphinxcontrib.drawio
+
+    launches = []
+    run_drawio = sphinxcontrib.drawio.run_drawio
+
+    def record(args, env, timeout):
+        if "--export" in args:
+            launches.append(args[args.index("--page-index") + 1])
+        return run_drawio(args, env, timeout)
+
+    monkeypatch.setattr(sphinxcontrib.drawio, "run_drawio", record)
+    app_with_local_user_config.build()
+
+    # both extracted pages are exported by one draw.io run
+    assert sorted(launches) == ["0", "2"]
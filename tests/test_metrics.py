@@ -0,0 +1,49 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from sphinx.application import Sphinx
+
+from conftest import read_report
+
+
+@pytest.mark.sphinx("html", testroot="export-metrics")
+def test_export_report(content: Sphinx):
+    imagedir = Path(content.doctreedir) / "drawio"
+    report = read_report(content)
+
+    totals = report["totals"]
+    assert totals["exports"] == 2
+    assert totals["exported"] == 2
+    assert totals["references"] == 3
+    assert totals["drawio"] > 0
+    assert totals["bytes"] == sum(export["bytes"] for export in report["exports"])
+
+    exports = {export["source"]: export for export in report["exports"]}
+    box = exports["box.drawio"]
+    assert box["outcome"] == "exported"
+    assert box["references"] == 2
+    assert box["bytes"] == (Path(content.doctreedir) / box["export"]).stat().st_size
+    assert exports["circle.drawio"]["references"] == 1
+
+    trace = json.loads((imagedir / "trace.json").read_text())
+    phases = {event["name"] for event in trace["traceEvents"]}
+    assert phases == {"resolve", "drawio"}
+
+    events = content.drawio_events
+    assert sorted(event[0] for event in events) == ["finished"] * 2 + ["started"] * 2
+    assert {event[2] for event in events if event[0] == "finished"} == {"exported"}
+
+
+@pytest.mark.sphinx("html", testroot="export-metrics", freshenv=True)
+def test_export_report_rebuild(make_app_with_local_user_config, app_params):
+    args, kwargs = app_params
+    make_app_with_local_user_config(*args, **kwargs).build()
+
+    app = make_app_with_local_user_config(*args, **kwargs)
+    app.build(force_all=True)
+    report = read_report(app)
+    assert report["totals"]["up-to-date"] == 2
+    assert report["totals"]["exported"] == 0
+    assert app.drawio_events == []
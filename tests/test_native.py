@@ -0,0 +1,152 @@
+from pathlib import Path
+
+import pytest
+
+from sphinx.application import Sphinx
+
+from conftest import read_report
+from sphinxcontrib.drawio import DrawIOError, native
+from sphinxcontrib.drawio.native import UnsupportedDiagram, render_svg
+
+ROOT = Path(__file__).parent / "roots" / "test-native"
+
+MODEL = (
+    '<mxGraphModel><root><mxCell id="0"/><mxCell id="1" parent="0"/>{}'
+    "</root></mxGraphModel>"
+)
+
+
+def diagram(tmp_path: Path, cells: str) -> str:
+    path = tmp_path / "diagram.drawio"
+    path.write_text(MODEL.format(cells))
+    return str(path)
+
+
+def test_render_svg():
+    svg = render_svg(str(ROOT / "flow.drawio"))
+    assert 'viewBox="39 39 322 182"' in svg
+    assert '<ellipse cx="100" cy="70" rx="60" ry="30" fill="#dae8fc"' in svg
+    assert '<path d="M 100 140 L 160 180 L 100 220 L 40 180 Z"' in svg
+    # the HTML line break and entity of the label
+    assert '<tspan x="300" y="192">&amp; saved</tspan>' in svg
+    # the orthogonal edge from the ellipse down to the rhombus
+    assert '<path d="M 100 100 L 100 140" fill="none"' in svg
+
+    scaled = render_svg(str(ROOT / "flow.drawio"), scale=2)
+    assert 'width="644px" height="364px" viewBox="39 39 322 182"' in scaled
+
+
+def test_orthogonal_route(tmp_path: Path):
+    path = diagram(
+        tmp_path,
+        '<mxCell id="a" vertex="1" parent="1">'
+        '<mxGeometry x="0" y="0" width="40" height="20" as="geometry"/></mxCell>'
+        '<mxCell id="b" vertex="1" parent="1">'
+        '<mxGeometry x="100" y="100" width="40" height="20" as="geometry"/></mxCell>'
+        '<mxCell id="e" style="edgeStyle=orthogonalEdgeStyle;endArrow=none;" '
+        'edge="1" parent="1" source="a" target="b">'
+        '<mxGeometry relative="1" as="geometry"/></mxCell>',
+    )
+    assert '<path d="M 40 10 L 70 10 L 70 110 L 100 110"' in render_svg(path)
+
+
+def test_default_style(tmp_path: Path):
+    # the styles draw.io gives a new rectangle and a new connector
+    path = diagram(
+        tmp_path,
+        '<mxCell id="a" value="Start" style="rounded=0;whiteSpace=wrap;html=1;" '
+        'vertex="1" parent="1">'
+        '<mxGeometry x="0" y="0" width="120" height="60" as="geometry"/></mxCell>'
+        '<mxCell id="b" value="End" style="rounded=0;whiteSpace=wrap;html=1;" '
+        'vertex="1" parent="1">'
+        '<mxGeometry x="0" y="100" width="120" height="60" as="geometry"/></mxCell>'
+        '<mxCell id="e" style="edgeStyle=orthogonalEdgeStyle;rounded=0;'
+        'orthogonalLoop=1;jettySize=auto;html=1;" edge="1" parent="1" '
+        'source="a" target="b"><mxGeometry relative="1" as="geometry"/></mxCell>',
+    )
+    svg = render_svg(path)
+    assert '<rect x="0" y="0" width="120" height="60" fill="#ffffff"' in svg
+    assert '<tspan x="60" y="' in svg and ">Start</tspan>" in svg
+    assert '<path d="M 60 60 L 60 100" fill="none"' in svg
+    assert 'fill="#ffffff"/>' not in svg
+
+    # opaque exports are filled with the page background
+    opaque = render_svg(path, transparent=False)
+    assert '<g><rect x="-1" y="-1" width="122" height="162" fill="#ffffff"/>' in opaque
+
+
+@pytest.mark.parametrize(
+    "cell, reason",
+    [
+        ('value="&lt;b&gt;x&lt;/b&gt;" style="html=1;"', "HTML label"),
+        ('style="shape=cylinder3;"', "shape 'cylinder3'"),
+        ('style="shadow=1;"', "style shadow"),
+        ('style="fillColor=#fff;gradientColor=#000;"', "style gradientColor"),
+        ('value="too long" style="whiteSpace=wrap;"', "wrapped label"),
+    ],
+)
+def test_unsupported(tmp_path: Path, cell: str, reason: str):
+    path = diagram(
+        tmp_path,
+        f'<mxCell id="a" {cell} vertex="1" parent="1">'
+        '<mxGeometry x="0" y="0" width="40" height="20" as="geometry"/></mxCell>',
+    )
+    with pytest.raises(UnsupportedDiagram) as exc:
+        render_svg(path)
+    assert str(exc.value) == reason
+
+
+@pytest.mark.sphinx("html", testroot="native")
+def test_native_renderer(content: Sphinx):
+    report = read_report(content)
+    exports = {export["source"]: export for export in report["exports"]}
+    flow, labels = exports["flow.drawio"], exports["labels.drawio"]
+    assert flow["drawio"] == 0 and flow["native"] > 0
+    # HTML labels are left to draw.io
+    assert labels["drawio"] > 0 and labels["native"] == 0
+
+
+@pytest.mark.sphinx(
+    "html",
+    testroot="native",
+    srcdir="native_opaque",
+    confoverrides={"drawio_default_transparency": False},
+)
+def test_native_renderer_opaque(app_with_local_user_config: Sphinx):
+    app = app_with_local_user_config
+    app.build()
+    report = read_report(app)
+    exports = {export["source"]: export for export in report["exports"]}
+    assert exports["flow.drawio"]["native"] > 0
+    assert exports["flow.drawio"]["drawio"] == 0
+    (svg,) = (Path(app.outdir) / "_images").glob("flow*.svg")
+    assert '<g><rect x="39" y="39" width="322" height="182" fill="#ffffff"/>' in (
+        svg.read_text()
+    )
+
+
+@pytest.mark.sphinx(
+    "html",
+    testroot="native",
+    srcdir="native_only",
+    confoverrides={"drawio_renderer": "native"},
+)
+def test_native_renderer_only(app_with_local_user_config: Sphinx):
+    with pytest.raises(DrawIOError) as exc:
+        app_with_local_user_config.build()
+    (message,) = exc.value.args
+    assert message.endswith("labels.drawio can't be rendered natively: HTML label")
+
+
+@pytest.mark.sphinx("html", testroot="native", srcdir="native_rebuild")
+def test_native_renderer_rebuild(
+    make_app_with_local_user_config, app_params, monkeypatch
+):
+    args, kwargs = app_params
+    make_app_with_local_user_config(*args, **kwargs).build()
+
+    # the exports the unchanged documents use are known without rendering them
+    rendered = []
+    monkeypatch.setattr(native, "render_svg", lambda *args: rendered.append(args))
+    make_app_with_local_user_config(*args, **kwargs).build()
+    assert rendered == []
@@ -0,0 +1,134 @@
+import re
+import struct
+import zlib
+
+from pathlib import Path
+from xml.etree import ElementTree as ET
+
+import pytest
+
+from conftest import read_report
+from sphinxcontrib.drawio.optimize import (
+    PNG_SIGNATURE,
+    SVG_NS,
+    _chunk,
+    optimize_png,
+    optimize_svg,
+)
+
+SVG = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN"'
+    ' "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">'
+    '<svg xmlns="http://www.w3.org/2000/svg" version="1.1" width="121px"'
+    ' height="61px" viewBox="-0.5 -0.5 121 61" content="&lt;mxfile/&gt;">'
+    "<!-- Do not edit this file with editors other than draw.io -->"
+    '<defs><linearGradient id="a"><stop offset="0.333333"/></linearGradient>'
+    '<linearGradient id="b"><stop offset="0.333333"/></linearGradient></defs>'
+    '<rect x="0.123456" y="0" width="120" height="60" fill="url(#b)"/>'
+    '<text x="59.99999" y="34.5">1.23456</text></svg>'
+)
+
+
+def test_optimize_svg(tmp_path: Path):
+    source = tmp_path / "diagram.svg"
+    source.write_text(SVG)
+    destination = tmp_path / "optimized.svg"
+    optimize_svg(source, destination, 2)
+    assert destination.read_text() == (
+        '<svg xmlns="http://www.w3.org/2000/svg" version="1.1" width="121px"'
+        ' height="61px" viewBox="-0.5 -0.5 121 61">'
+        '<defs><linearGradient id="a"><stop offset="0.33"/></linearGradient></defs>'
+        '<rect x="0.12" y="0" width="120" height="60" fill="url(#a)"/>'
+        '<text x="60" y="34.5">1.23456</text></svg>'
+    )
+
+    optimize_svg(source, destination, None)
+    assert 'x="0.123456"' in destination.read_text()
+
+
+def test_optimize_svg_namespaces(tmp_path: Path):
+    source = tmp_path / "diagram.svg"
+    source.write_text(
+        '<svg xmlns="http://www.w3.org/2000/svg"'
+        ' xmlns:xlink="http://www.w3.org/1999/xlink" width="1.2345">'
+        '<image xlink:href="data:,"/></svg>'
+    )
+    destination = tmp_path / "optimized.svg"
+    optimize_svg(source, destination, 2)
+    assert destination.read_text() == (
+        '<svg xmlns="http://www.w3.org/2000/svg"'
+        ' xmlns:xlink="http://www.w3.org/1999/xlink" width="1.23">'
+        '<image xlink:href="data:,"/></svg>'
+    )
+    # the prefixes of the rest of the process are left alone
+    assert ET.tostring(ET.Element(f"{{{SVG_NS}}}svg")).startswith(b"<ns0:svg")
+
+
+@pytest.mark.parametrize(
+    "precision, path",
+    [(2, "M1.5 0.5L1.55 0.99"), (1, "M1.5 0.5L1.6 1"), (0, "M2 0L2 1")],
+)
+def test_optimize_svg_compact_numbers(tmp_path: Path, precision: int, path: str):
+    source = tmp_path / "diagram.svg"
+    source.write_text(
+        '<svg xmlns="http://www.w3.org/2000/svg"><path d="M1.5.5L1.55.987"/></svg>'
+    )
+    destination = tmp_path / "optimized.svg"
+    optimize_svg(source, destination, precision)
+    # each number of the compact list stays a number of its own
+    assert f'd="{path}"' in destination.read_text()
+
+
+def test_optimize_png(tmp_path: Path):
+    pixels = b"".join(b"\0" + bytes(x % 7 for x in range(300)) for _ in range(100))
+    image_data = zlib.compress(pixels, 1)
+    source = tmp_path / "diagram.png"
+    source.write_bytes(
+        PNG_SIGNATURE
+        + _chunk(b"IHDR", struct.pack(">IIBBBBB", 100, 100, 8, 0, 0, 0, 0))
+        + _chunk(b"IDAT", image_data[:64])
+        + _chunk(b"IDAT", image_data[64:])
+        + _chunk(b"tEXt", b"Software\0draw.io")
+        + _chunk(b"IEND", b"")
+    )
+    destination = tmp_path / "optimized.png"
+    assert optimize_png(source, destination)
+    optimized = destination.read_bytes()
+    assert len(optimized) < source.stat().st_size
+
+    chunks = []
+    offset = len(PNG_SIGNATURE)
+    while offset < len(optimized):
+        length, type = struct.unpack(">I4s", optimized[offset : offset + 8])
+        data = optimized[offset + 8 : offset + 8 + length]
+        (crc,) = struct.unpack(
+            ">I", optimized[offset + 8 + length : offset + 12 + length]
+        )
+        assert zlib.crc32(data, zlib.crc32(type)) == crc
+        chunks.append((type, data))
+        offset += 12 + length
+    assert [type for type, _ in chunks] == [b"IHDR", b"IDAT", b"tEXt", b"IEND"]
+    assert zlib.decompress(chunks[1][1]) == pixels
+
+    # already as small as it gets
+    assert not optimize_png(destination, tmp_path / "again.png")
+    assert not (tmp_path / "again.png").exists()
+
+
+@pytest.mark.sphinx(
+    "html",
+    testroot="native",
+    srcdir="optimize_svg",
+    confoverrides={"drawio_renderer": "auto", "drawio_optimize_svg": True},
+)
+def test_optimize_build(app_with_local_user_config):
+    app = app_with_local_user_config
+    app.build()
+    report = read_report(app)
+    for export in report["exports"]:
+        assert export["outcome"] == "exported"
+        assert export["optimize"] > 0
+        svg = (Path(app.doctreedir) / export["export"]).read_text()
+        assert not re.search(r'="[^"]*\d\.\d{3}', svg)
+        assert export["bytes"] == len(svg.encode())
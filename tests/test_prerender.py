@@ -0,0 +1,43 @@
+import shutil
+from pathlib import Path
+
+from sphinxcontrib.drawio.__main__ import main, scan_directives
+
+
+def test_scan_directives():
+    text = """
+.. drawio-image:: box.drawio
+   :format: svg
+   :export-scale: 150
+
+.. note::
+
+   .. drawio-figure::
+      circle.drawio
+      :page-index: 1
+
+      Caption
+"""
+    assert list(scan_directives(text)) == [
+        (2, "image", "box.drawio", {"format": "svg", "export-scale": "150"}),
+        (8, "figure", "circle.drawio", {"page-index": "1"}),
+    ]
+
+
+def test_prerender(rootdir, tmp_path: Path, capsys):
+    srcdir = tmp_path / "src"
+    outdir = tmp_path / "out"
+    shutil.copytree(str(rootdir / "test-page-index"), str(srcdir))
+
+    assert main(["--dry-run", str(srcdir), str(outdir)]) == 0
+    stale = capsys.readouterr().out.splitlines()
+    assert len(stale) == 3
+    assert stale[0].startswith("pages.drawio (page 0) -> drawio/")
+
+    assert main(["-q", "-j", "2", str(srcdir), str(outdir)]) == 0
+    exports = sorted((outdir / ".doctrees" / "drawio").glob("*/pages.png"))
+    assert len(exports) == 3
+
+    capsys.readouterr()
+    assert main(["--dry-run", str(srcdir), str(outdir)]) == 0
+    assert capsys.readouterr().out == ""
@@ -0,0 +1,46 @@
+from pathlib import Path
+
+import pytest
+
+from conftest import read_report
+from sphinxcontrib.drawio.rasterize import is_available, svg_background
+
+SVG = '<svg xmlns="http://www.w3.org/2000/svg" width="10" height="10"{}>{}</svg>'
+
+
+def test_svg_background(tmp_path: Path):
+    path = tmp_path / "diagram.svg"
+    path.write_text(SVG.format("", "<rect/>"))
+    assert svg_background(path) == "none"
+
+    path.write_text(SVG.format(' style="background-color: #f0f0f0;"', "<rect/>"))
+    assert svg_background(path) == "#f0f0f0"
+
+    # HTML labels
+    path.write_text(SVG.format("", "<switch><foreignObject/><text/></switch>"))
+    assert svg_background(path) is None
+
+
+@pytest.mark.skipif(not is_available(), reason="cairosvg is not installed")
+@pytest.mark.sphinx("html", testroot="image", srcdir="rasterize_svg")
+def test_rasterize_svg(make_app_with_local_user_config, app_params):
+    args, kwargs = app_params
+
+    def build(format: str, rasterize_svg: bool = True) -> dict:
+        kwargs["confoverrides"] = {
+            "drawio_builder_export_format": {"html": format},
+            "drawio_rasterize_svg": rasterize_svg,
+        }
+        app = make_app_with_local_user_config(*args, **kwargs)
+        app.build(force_all=True)
+        (export,) = read_report(app)["exports"]
+        return export
+
+    assert build("svg")["outcome"] == "exported"
+    export = build("png")
+    assert export["outcome"] == "rasterized"
+    assert export["drawio"] == 0
+    # draw.io's own export isn't mistaken for the rasterized one
+    exported = build("png", rasterize_svg=False)
+    assert exported["outcome"] == "exported"
+    assert exported["key"] != export["key"]
@@ -0,0 +1,83 @@
+from pathlib import Path
+from typing import List
+from xml.etree import ElementTree as ET
+
+import pytest
+
+from conftest import ExportRequestHandler, read_report
+from sphinxcontrib.drawio import DrawIOError
+
+
+def visible_layers(xml: str) -> List[str]:
+    cells = ET.fromstring(xml).find("diagram/mxGraphModel/root")
+    return [
+        cell.get("value", "")
+        for cell in cells
+        if cell.get("parent") == "0" and cell.get("visible") != "0"
+    ]
+
+
+@pytest.mark.sphinx("html", testroot="layer-selection", srcdir="export_server")
+def test_export_server(make_app_with_local_user_config, app_params, export_server):
+    args, kwargs = app_params
+    overrides = {"drawio_export_server_url": export_server, "drawio_export_workers": 2}
+    app = make_app_with_local_user_config(*args, confoverrides=overrides, **kwargs)
+    app.build(force_all=True)
+
+    requests = ExportRequestHandler.requests
+    assert len(requests) == 5
+    assert {request["format"] for request in requests} == {"png"}
+    assert {request["from"] for request in requests} == {"0"}
+    # the selected layers are shown, the others hidden as by draw.io's --layers
+    assert sorted(visible_layers(request["xml"]) for request in requests) == [
+        [""],
+        ["", "layer 1"],
+        ["", "layer 2"],
+        ["layer 1"],
+        ["layer 2"],
+    ]
+
+    exports = read_report(app)["exports"]
+    assert {export["outcome"] for export in exports} == {"exported"}
+    assert all(export["drawio"] == 0 and export["server"] > 0 for export in exports)
+    for export in exports:
+        path = Path(app.doctreedir) / export["export"]
+        assert path.read_bytes() == b"image"
+
+
+@pytest.mark.sphinx("html", testroot="image", srcdir="export_server_error")
+def test_export_server_error(
+    make_app_with_local_user_config, app_params, export_server
+):
+    args, kwargs = app_params
+    ExportRequestHandler.status = 400
+    overrides = {"drawio_export_server_url": export_server}
+    app = make_app_with_local_user_config(*args, confoverrides=overrides, **kwargs)
+    with pytest.raises(DrawIOError, match="Error: invalid diagram"):
+        app.build(force_all=True)
+    # client errors are not retried
+    assert len(ExportRequestHandler.requests) == 1
+
+
+@pytest.mark.sphinx("html", testroot="image", srcdir="export_server_version")
+def test_export_server_version(
+    make_app_with_local_user_config, app_params, export_server
+):
+    args, kwargs = app_params
+
+    def build(version: str) -> list:
+        overrides = {
+            "drawio_export_server_url": export_server,
+            "drawio_export_server_version": version,
+        }
+        app = make_app_with_local_user_config(*args, confoverrides=overrides, **kwargs)
+        app.build(force_all=True)
+        return read_report(app)["exports"]
+
+    (export,) = build("1")
+    assert len(ExportRequestHandler.requests) == 1
+    assert build("1")[0]["key"] == export["key"]
+    # an upgraded server exports again
+    (upgraded,) = build("2")
+    assert upgraded["key"] != export["key"]
+    assert len(ExportRequestHandler.requests) == 2
@@ -0,0 +1,110 @@
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+from sphinxcontrib.drawio import MAX_LOG_SIZE, DrawIOError, run_drawio
+
+TESTS_DIR = Path(__file__).parent
+
+HANGING_DRAWIO = """#!{python}
+import os, subprocess, sys, time
+sys.path.insert(0, {tests_dir!r})
+import fake_drawio
+
+args = sys.argv[1:]
+if "--version" in args:
+    # a version of its own, so that no other test's exports are reused
+    sys.exit(print({marker!r}))
+if not os.path.exists({marker!r}):
+    open({marker!r}, "w").close()
+    # like Electron, leave a helper process behind
+    helper = subprocess.Popen(["sleep", "60"])
+    with open({pidfile!r}, "w") as fp:
+        fp.write(str(helper.pid))
+    print("hanging", flush=True)
+    time.sleep(60)
+sys.exit(fake_drawio.main(args))
+"""
+
+
+def is_running(pid: int) -> bool:
+    # the killed helper may linger for a moment before it is reaped
+    for _ in range(50):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        time.sleep(0.1)
+    return True
+
+
+@pytest.fixture()
+def hanging_drawio(tmp_path: Path) -> Path:
+    binary = tmp_path / "drawio"
+    binary.write_text(
+        HANGING_DRAWIO.format(
+            python=sys.executable,
+            tests_dir=str(TESTS_DIR),
+            marker=str(tmp_path / "hung"),
+            pidfile=str(tmp_path / "helper.pid"),
+        )
+    )
+    binary.chmod(0o755)
+    return binary
+
+
+@pytest.mark.skipif(os.name != "posix", reason="uses a shebang and sleep")
+def test_run_drawio_timeout(hanging_drawio: Path):
+    with pytest.raises(subprocess.TimeoutExpired) as exc_info:
+        run_drawio([str(hanging_drawio), "--export"], dict(os.environ), timeout=1)
+    assert exc_info.value.stdout == b"hanging\n"
+
+    pid = int((hanging_drawio.parent / "helper.pid").read_text())
+    assert not is_running(pid)
+
+
+def test_run_drawio_output(tmp_path: Path):
+    chatty = "import sys; sys.stderr.write('x' * 10**6 + 'end'); sys.exit(1)"
+    with pytest.raises(subprocess.CalledProcessError) as exc_info:
+        run_drawio([sys.executable, "-c", chatty], dict(os.environ))
+    # only the end of the output is kept
+    assert len(exc_info.value.stderr) == MAX_LOG_SIZE
+    assert exc_info.value.stderr.endswith(b"xend")
+    assert exc_info.value.stdout == b""
+
+
+@pytest.mark.skipif(os.name != "posix", reason="uses a shebang and sleep")
+@pytest.mark.sphinx("html", testroot="image")
+def test_export_retry(make_app, app_params, hanging_drawio):
+    args, kwargs = app_params
+    kwargs["confoverrides"] = {
+        "drawio_binary_path": str(hanging_drawio),
+        "drawio_headless": False,
+        "drawio_export_timeout": 1,
+        "drawio_export_retry_delay": 0,
+    }
+    app = make_app(*args, **kwargs)
+    app.build()
+
+    warnings = app._warning.getvalue()
+    assert warnings.count("timed out after 1s, retrying in 0s (1/1)") == 1
+    assert list((Path(app.doctreedir) / "drawio").glob("*/box.*"))
+
+
+@pytest.mark.skipif(os.name != "posix", reason="uses a shebang and sleep")
+@pytest.mark.sphinx("html", testroot="image")
+def test_export_timeout(make_app, app_params, hanging_drawio):
+    args, kwargs = app_params
+    kwargs["confoverrides"] = {
+        "drawio_binary_path": str(hanging_drawio),
+        "drawio_headless": False,
+        "drawio_export_timeout": 1,
+        "drawio_export_retries": 0,
+    }
+    app = make_app(*args, **kwargs)
+    with pytest.raises(DrawIOError, match="timed out after 1s and was killed"):
+        app.build()
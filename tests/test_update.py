@@ -1,6 +1,9 @@
+import os
 import shutil
+import sys
 
 from pathlib import Path
+from xml.etree import ElementTree
 
 import pytest
 
@@ -17,6 +20,8 @@ def test_image_notchanged(content: Sphinx, make_app_with_local_user_config):
     app = make_app_with_local_user_config(srcdir=content.srcdir)
     app.build()
     assert exported.stat().st_mtime == exported_timestamp
+    # draw.io was not needed, so no X server was started either
+    assert app.config._displays is None
 
 
 @pytest.mark.sphinx("html", testroot="image", srcdir="image_changed")
@@ -29,3 +34,82 @@ def test_image_changed(content: Sphinx, make_app_with_local_user_config):
     app = make_app_with_local_user_config(srcdir=content.srcdir)
     app.build()
     assert exported.stat().st_mtime > exported_timestamp
+
+
+@pytest.mark.sphinx("html", testroot="image", srcdir="image_touched")
+def test_image_touched(content: Sphinx, make_app_with_local_user_config):
+    # e.g. a fresh checkout: new mtime, same content
+    (export,) = Path(content.doctreedir, "drawio").glob("*/box.svg")
+    export_timestamp = export.stat().st_mtime
+    box = Path(content.srcdir / "box.drawio")
+    os.utime(box, (export_timestamp + 10, export_timestamp + 10))
+    app = make_app_with_local_user_config(srcdir=content.srcdir)
+    app.build()
+    assert export.stat().st_mtime == export_timestamp
+
+
+@pytest.mark.sphinx("html", testroot="page-name", srcdir="page_changed")
+def test_page_changed(content: Sphinx, make_app_with_local_user_config):
+    def exports():
+        return {
+            path.parent.name: path.stat().st_mtime
+            for path in Path(content.doctreedir, "drawio").glob("*/*.png")
+        }
+
+    first_exports = exports()
+    assert len(first_exports) == 2
+
+    # replace the second page with a copy of the first
+    pages = Path(content.srcdir / "pages.drawio")
+    root = ElementTree.parse(str(pages)).getroot()
+    root[1].text = root[0].text
+    ElementTree.ElementTree(root).write(str(pages))
+    app = make_app_with_local_user_config(srcdir=content.srcdir)
+    app.build()
+
+    # only the export of the second page was made again
+    second_exports = exports()
+    assert len(second_exports) == 3
+    assert first_exports.items() < second_exports.items()
+
+
+@pytest.mark.skipif(os.name != "posix", reason="uses a shebang")
+@pytest.mark.sphinx("html", testroot="image", srcdir="drawio_upgraded")
+def test_drawio_upgraded(make_app, app_params, tmp_path: Path, monkeypatch):
+    import sphinxcontrib.drawio
+
+    lookups = []
+    find_drawio_binary = sphinxcontrib.drawio.find_drawio_binary
+    monkeypatch.setattr(
+        sphinxcontrib.drawio,
+        "find_drawio_binary",
+        lambda config: lookups.append(config) or find_drawio_binary(config),
+    )
+
+    binary = tmp_path / "drawio"
+    fake_drawio = Path(__file__).parent / "fake_drawio.py"
+
+    def build(version: str) -> set:
+        binary.write_text(
+            "#!/bin/sh\n"
+            f'case "$*" in *--version*) echo {version}; exit;; esac\n'
+            f'exec "{sys.executable}" "{fake_drawio}" "$@"\n'
+        )
+        binary.chmod(0o755)
+        # a new modification time, as on an upgrade
+        os.utime(binary, ns=(0, len(lookups) + 1))
+
+        args, kwargs = app_params
+        kwargs["confoverrides"] = {
+            "drawio_binary_path": str(binary),
+            "drawio_headless": False,
+        }
+        app = make_app(*args, **kwargs)
+        app.build(force_all=True)
+        return {path.name for path in (app.doctreedir / "drawio").iterdir()}
+
+    exports = build("20.0.0")
+    assert len(lookups) == 1
+    # the exports made by the previous version are not reused
+    assert len(build("21.0.0") - exports) == 1
+    assert len(lookups) == 2
@@ -0,0 +1,90 @@
+import sys
+
+from pathlib import Path
+from typing import List
+
+import pytest
+
+from conftest import read_report
+
+
+def build_with_worker(make_app, app_params, command: List[str], **limits):
+    args, kwargs = app_params
+    overrides = {
+        "drawio_export_worker": command,
+        "drawio_export_workers": 2,
+        **limits,
+    }
+    app = make_app(*args, confoverrides=overrides, **kwargs)
+    app.build(force_all=True)
+
+    exports = read_report(app)["exports"]
+    assert len(exports) == 5
+    for export in exports:
+        assert export["outcome"] == "exported"
+        assert export["drawio"] == 0 and export["worker"] > 0
+        assert (Path(app.doctreedir) / export["export"]).read_bytes() == b"image"
+    return app.config._export_worker
+
+
+@pytest.mark.sphinx("html", testroot="layer-selection", srcdir="export_worker")
+def test_export_worker(make_app_with_local_user_config, app_params, export_worker):
+    worker = build_with_worker(
+        make_app_with_local_user_config,
+        app_params,
+        export_worker,
+        drawio_export_worker_max_jobs=2,
+    )
+    # the worker is recycled every other export
+    assert worker.starts == 3
+
+
+@pytest.mark.skipif(not Path("/proc").is_dir(), reason="memory is read from /proc")
+@pytest.mark.sphinx("html", testroot="layer-selection", srcdir="export_worker_memory")
+def test_export_worker_memory(
+    make_app_with_local_user_config, app_params, export_worker
+):
+    worker = build_with_worker(
+        make_app_with_local_user_config,
+        app_params,
+        export_worker,
+        drawio_export_worker_max_memory=1,
+    )
+    # the worker is recycled after every export
+    assert worker.starts == 5
+
+
+@pytest.mark.sphinx("html", testroot="image", srcdir="export_worker_fallback")
+def test_export_worker_fallback(make_app_with_local_user_config, app_params):
+    args, kwargs = app_params
+    overrides = {"drawio_export_worker": [sys.executable, "-c", "pass"]}
+    app = make_app_with_local_user_config(*args, confoverrides=overrides, **kwargs)
+    app.build(force_all=True)
+
+    assert "exporting with draw.io" in app._warning.getvalue()
+    (export,) = read_report(app)["exports"]
+    assert export["outcome"] == "exported"
+    assert export["drawio"] > 0
+
+
+@pytest.mark.sphinx("html", testroot="image", srcdir="export_worker_key")
+def test_export_worker_key(make_app_with_local_user_config, app_params, export_worker):
+    args, kwargs = app_params
+
+    def build(**overrides) -> dict:
+        app = make_app_with_local_user_config(*args, confoverrides=overrides, **kwargs)
+        app.build(force_all=True)
+        (export,) = read_report(app)["exports"]
+        return export
+
+    worker_export = build(drawio_export_worker=export_worker)
+    assert worker_export["worker"] > 0
+    # draw.io doesn't reuse the worker's export
+    electron_export = build()
+    assert electron_export["key"] != worker_export["key"]
+    assert electron_export["drawio"] > 0
+    upgraded = build(
+        drawio_export_worker=export_worker, drawio_export_worker_version="2"
+    )
+    assert upgraded["key"] != worker_export["key"]
+    assert upgraded["worker"] > 0
@@ -0,0 +1,58 @@
+import threading
+import time
+
+import pytest
+
+from sphinxcontrib.drawio.xvfb import DisplayPool, XvfbError
+
+
+def test_display_pool():
+    pool = DisplayPool(2, "640x480x24")
+    in_use = []
+    max_in_use = []
+
+    def export():
+        with pool.display() as display:
+            assert display not in in_use
+            in_use.append(display)
+            max_in_use.append(len(in_use))
+            time.sleep(0.2)
+            in_use.remove(display)
+
+    threads = [threading.Thread(target=export) for _ in range(5)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(pool.servers) == 2
+        assert max(max_in_use) == 2
+    finally:
+        pool.close()
+    assert pool.servers == []
+
+
+def test_display_pool_restart():
+    pool = DisplayPool(1, "640x480x24")
+    try:
+        with pool.display():
+            pass
+        ((xvfb, _),) = pool.servers
+        xvfb.kill()
+        xvfb.wait()
+        with pool.display():
+            pass
+        ((restarted, _),) = pool.servers
+        assert restarted is not xvfb
+        assert restarted.poll() is None
+    finally:
+        pool.close()
+
+
+def test_display_pool_without_xvfb(monkeypatch, tmp_path):
+    monkeypatch.setenv("PATH", str(tmp_path))
+    pool = DisplayPool(1, "640x480x24")
+    with pytest.raises(XvfbError, match=r"^Xvfb \(Xvfb .*\) could not be started"):
+        with pool.display():
+            pass
+    assert pool.servers == []